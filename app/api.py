@@ -1,10 +1,26 @@
-from fastapi import APIRouter, UploadFile, File, HTTPException
+from fastapi import APIRouter, Request, UploadFile, File, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
+from typing import List
+import asyncio
+import json
+import time
 
-from app.services.document_service import read_text_from_file, chunk_text
-from app.services.retrieval_service import search, compute_embeddings, add_document_to_db, rerank
-from app.services.llm_service import generate_answer, generate_query_variations
-from app.database import get_user_stats, delete_user_data, get_or_create_user
+from app.services.ingestion_service import (
+    ingest_document, update_document, submit_ingestion_job, get_ingestion_job
+)
+from app.services.admission import scheduler, OverloadedError, QUERY_QUEUE_TIMEOUT, INGEST_QUEUE_TIMEOUT
+from app.services.answer_cache import answer_cache, ANSWER_CACHE_ENABLED
+from app.services.context_service import assemble_context
+from app.services.hot_index import hot_index
+from app.services.retrieval_service import (
+    search, search_many, fuse_rankings, rerank, encode_queries, DocumentNotFoundError
+)
+from app.services.llm_client import LLMError
+from app.services.llm_service import generate_answer, stream_answer, generate_query_variations
+from app.database import get_user_stats, delete_user_data, get_or_create_user, request_scope
+from app import metrics
 
 router = APIRouter()
 
@@ -13,57 +29,241 @@ class AskRequest(BaseModel):
     question: str
 
 @router.get("/health")
-def health_check():
+async def health_check(request: Request):
+    # Пока идет прогрев моделей (WARMUP_MODELS=true), сервис не готов принимать запросы
+    if not getattr(request.app.state, "ready", True):
+        error = getattr(request.app.state, "warmup_error", None)
+        return JSONResponse(
+            status_code=503,
+            content={"status": "warm-up failed", "detail": error} if error else {"status": "warming up"}
+        )
+
     return {"status": "ok"}
 
+def _overloaded(e: OverloadedError) -> HTTPException:
+    return HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+@router.get("/metrics/summary")
+async def metrics_summary():
+    return metrics.snapshot()
+
+@router.get("/metrics")
+async def metrics_prometheus():
+    return PlainTextResponse(metrics.render_prometheus(), media_type="text/plain; version=0.0.4")
+
 @router.post("/documents")
-def upload_document(user_id: int, file: UploadFile = File(...)):
-    get_or_create_user(user_id)
-
-    text = read_text_from_file(file)
-    raw_chunks = chunk_text(text)
-    chunks = [
-        {"text": chunk, "document": file.filename, "chunk_id": i}
-        
-        for i, chunk in enumerate(raw_chunks)
-    ]
-
-    embeddings = compute_embeddings([chunk["text"] for chunk in chunks])
-    add_document_to_db(user_id, file.filename, text, raw_chunks, embeddings)
-    
-    return {
-        "filename": file.filename,
-        "num_chunks": len(chunks),
-        "chunk_preview": chunks[0]["text"][:200]
-    }
+async def upload_document(user_id: int, file: UploadFile = File(...), background: bool = False):
+    await get_or_create_user(user_id)
 
-@router.post("/ask")
-def ask_question(request: AskRequest):
-    get_or_create_user(request.user_id)
+    # Разбор файла и эмбеддинги - блокирующая CPU-работа, выполняем ее вне event loop
+    if background:
+        try:
+            job = await run_in_threadpool(submit_ingestion_job, user_id, file)
+
+        except OverloadedError as e:
+            raise _overloaded(e)
+
+        return {"job_id": job.job_id, "status": job.status}
+
+    try:
+        async with scheduler.ingest.slot(user_id, INGEST_QUEUE_TIMEOUT):
+            return await run_in_threadpool(ingest_document, user_id, file.filename, file.file)
+
+    except OverloadedError as e:
+        raise _overloaded(e)
+
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.put("/documents/{document_id}")
+async def replace_document(document_id: int, user_id: int, file: UploadFile = File(...)):
+    try:
+        async with scheduler.ingest.slot(user_id, INGEST_QUEUE_TIMEOUT):
+            return await run_in_threadpool(update_document, user_id, document_id, file.filename, file.file)
+
+    except OverloadedError as e:
+        raise _overloaded(e)
+
+    except DocumentNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/documents/jobs/{job_id}")
+async def document_job_status(job_id: str):
+    job = get_ingestion_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    return job
+
+async def _rewrite_variations(rewrite: asyncio.Task) -> List[str]:
+    """Ждет переформулировки вопроса от LLM. Если LLM недоступна, возвращает пустой список"""
+
+    # Сколько ответ ждет LLM сверх уже выполненного поиска по исходному вопросу
+    start = time.perf_counter()
+    try:
+        variations = await rewrite
+
+    except Exception as e:
+        print(f"Query rewrite failed: {e}")
+        metrics.inc("query_rewrite_failures")
+        return []
+
+    metrics.observe("query_rewrite_wait_seconds", time.perf_counter() - start)
+    return variations
+
+async def _retrieve_context(request: AskRequest):
+    """
+    Ищет контекст для вопроса и собирает его в пределах бюджета токенов.
+    Если на похожий вопрос уже есть ответ в кеше, возвращает его вместо контекста.
+
+    Поиск и rerank выполняются в полосе query. Переформулировки вопроса генерируются LLM
+    параллельно с поиском по исходному вопросу, но ждут их уже без слота и без сессии БД;
+    затем они кодируются одним батчем, ищутся одним запросом к БД в новом слоте
+    и объединяются с первым результатом через RRF. Если переформулировок нет или
+    второй слот не выдан, rerank выполняется по результатам первого поиска.
+    Генерация ответа LLM слот тоже не занимает.
+    """
+
+    generation = answer_cache.generation(request.user_id)
+    rewrite = None
+
+    try:
+        async with scheduler.query.slot(request.user_id, QUERY_QUEUE_TIMEOUT):
+            query_embedding = (await encode_queries([request.question]))[0]
+
+            if ANSWER_CACHE_ENABLED:
+                cached = answer_cache.lookup(request.user_id, query_embedding)
+                if cached is not None:
+                    return None, cached, query_embedding, generation, None
+
+            async with request_scope(request.user_id) as ctx:
+                if ctx.settings["enable_query_rewrite"]:
+                    rewrite = asyncio.create_task(generate_query_variations(request.question, num_variations=2))
+
+                retrieved = await search(ctx, request.question, query_embedding)
+                if rewrite is None:
+                    reranked = await rerank(ctx, request.question, retrieved)
+
+        if rewrite is not None:
+            variations = await _rewrite_variations(rewrite)
+            reranked = None
+
+            if variations:
+                try:
+                    async with scheduler.query.slot(request.user_id, QUERY_QUEUE_TIMEOUT):
+                        async with request_scope(request.user_id) as ctx:
+                            variant_results = await search_many(ctx, await encode_queries(variations))
+                            fused = fuse_rankings([retrieved] + variant_results, ctx.settings["retrieval_top_k"])
+                            reranked = await rerank(ctx, request.question, fused)
+
+                except OverloadedError:
+                    # Очередь переполнена: переформулировки отбрасываются, найденное по вопросу не теряется
+                    metrics.inc("query_rewrite_overloaded")
+
+            if reranked is None:
+                # rerank берет из ctx только настройки, поэтому годится контекст первого поиска
+                reranked = await rerank(ctx, request.question, retrieved)
+
+    except BaseException:
+        if rewrite is not None:
+            rewrite.cancel()
+        raise
 
+    with metrics.timed("context_assembly"):
+        context_chunks, context_stats = await run_in_threadpool(assemble_context, reranked)
+
+    return context_chunks, None, query_embedding, generation, context_stats
+
+@router.post("/ask")
+async def ask_question(request: AskRequest):
     try:
-        #questions = generate_query_variations(request.question, num_variations=2)
-        retrieved = search(request)
-        reranked = rerank(request, retrieved)
-        context_chunks = [chunk["text"] for chunk in reranked]
-        answer = generate_answer(request.question, context_chunks)
+        context_chunks, answer, query_embedding, generation, context_stats = await _retrieve_context(request)
+
+        if answer is None:
+            answer = await generate_answer(request.question, context_chunks)
+            if ANSWER_CACHE_ENABLED:
+                answer_cache.store(request.user_id, request.question, query_embedding, answer, generation)
+
+    except OverloadedError as e:
+        raise _overloaded(e)
+
+    except LLMError as e:
+        raise HTTPException(status_code=503, detail=str(e))
 
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
     return {
         "question": request.question,
-        "answer": answer
+        "answer": answer,
+        "context": context_stats
     }
 
-@router.get("/stats/{user_id}")
-def stats(user_id: int):
-    get_or_create_user(user_id)
+def _sse(data: dict, event: str = None) -> str:
+    """Кодирует событие в формате server-sent events"""
+
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data, ensure_ascii=False)}\n\n"
 
-    return get_user_stats(user_id)
+@router.post("/ask/stream")
+async def ask_question_stream(request: AskRequest):
+    started = time.perf_counter()
+
+    try:
+        context_chunks, cached, query_embedding, generation, context_stats = await _retrieve_context(request)
+
+    except OverloadedError as e:
+        raise _overloaded(e)
+
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    async def events():
+        if cached is not None:
+            metrics.observe("ask_time_to_first_token_seconds", time.perf_counter() - started)
+            yield _sse({"token": cached})
+            yield _sse({}, event="done")
+            return
+
+        first_token = True
+        tokens = []
+        try:
+            async for token in stream_answer(request.question, context_chunks):
+                if first_token:
+                    metrics.observe("ask_time_to_first_token_seconds", time.perf_counter() - started)
+                    first_token = False
+
+                tokens.append(token)
+                yield _sse({"token": token})
+
+            metrics.observe("ask_stream_total_seconds", time.perf_counter() - started)
+            if ANSWER_CACHE_ENABLED:
+                answer_cache.store(request.user_id, request.question, query_embedding, "".join(tokens), generation)
+            yield _sse({"context": context_stats}, event="done")
+
+        except Exception as e:
+            yield _sse({"detail": str(e)}, event="error")
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@router.get("/stats/{user_id}")
+async def stats(user_id: int):
+    async with request_scope(user_id) as ctx:
+        return await get_user_stats(ctx)
 
 @router.post("/reset/{user_id}")
-def reset(user_id: int):
-    get_or_create_user(user_id)
-    delete_user_data(user_id)
+async def reset(user_id: int):
+    async with request_scope(user_id) as ctx:
+        await delete_user_data(ctx)
+
+    answer_cache.invalidate(user_id)
+    hot_index.invalidate(user_id)
+
     return {"status": "user data reset"}
\ No newline at end of file
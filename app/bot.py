@@ -1,22 +1,127 @@
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional
 import asyncio
 import aiohttp
+import json
 import os
-import tempfile
 from aiogram import Bot, Dispatcher
 from aiogram.filters import Command
-from aiogram.types import Message
+from aiogram.types import Document, Message
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 API_URL = os.getenv("API_URL", "http://localhost:8000")
+# Как часто (в секундах) бот опрашивает статус загрузки документа
+JOB_POLL_INTERVAL = float(os.getenv("BOT_JOB_POLL_INTERVAL", "2"))
+JOB_POLL_TIMEOUT = float(os.getenv("BOT_JOB_POLL_TIMEOUT", "1800"))
+# Не чаще чем раз в столько секунд бот редактирует сообщение с потоковым ответом
+STREAM_EDIT_INTERVAL = float(os.getenv("BOT_STREAM_EDIT_INTERVAL", "1.0"))
+# Пул соединений с API: максимум одновременных соединений и сколько держать простаивающее соединение открытым
+HTTP_POOL_SIZE = int(os.getenv("BOT_HTTP_POOL_SIZE", "100"))
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("BOT_HTTP_KEEPALIVE_TIMEOUT", "30"))
+# Таймауты запросов к API: на установку соединения и на ожидание очередной порции ответа
+HTTP_CONNECT_TIMEOUT = float(os.getenv("BOT_HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("BOT_HTTP_READ_TIMEOUT", "300"))
+# Сколько секунд можно скачивать файл из Telegram
+DOWNLOAD_TIMEOUT = int(os.getenv("BOT_DOWNLOAD_TIMEOUT", "300"))
+# Сколько документов одного пользователя загружаются одновременно, остальные ждут своей очереди
+USER_MAX_UPLOADS = int(os.getenv("BOT_USER_MAX_UPLOADS", "1"))
+
+JOB_STATUS_TEXT = {
+    "queued": "В очереди",
+    "parsing": "Чтение файла",
+    "embedding": "Вычисление эмбеддингов",
+    "inserting": "Сохранение в базу",
+}
 
 bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher()
 
+_session: Optional[aiohttp.ClientSession] = None
+
+def api_session() -> aiohttp.ClientSession:
+    """Общая сессия для всех запросов к API: соединения переиспользуются между сообщениями"""
+
+    global _session
+
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=HTTP_POOL_SIZE, keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT),
+            timeout=aiohttp.ClientTimeout(total=None, connect=HTTP_CONNECT_TIMEOUT, sock_read=HTTP_READ_TIMEOUT)
+        )
+
+    return _session
+
+@dp.shutdown()
+async def close_api_session():
+    if _session is not None:
+        await _session.close()
+
+class UserLimiter:
+    """Ограничивает число одновременных операций одного пользователя"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        # Семафор пользователя и число операций, которые его держат или ждут
+        self._users: Dict[int, List] = {}
+
+    def busy(self, user_id: int) -> bool:
+        entry = self._users.get(user_id)
+        return entry is not None and entry[0].locked()
+
+    @asynccontextmanager
+    async def acquire(self, user_id: int):
+        entry = self._users.setdefault(user_id, [asyncio.Semaphore(self.limit), 0])
+        entry[1] += 1
+
+        try:
+            async with entry[0]:
+                yield
+
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._users[user_id]
+
+upload_limiter = UserLimiter(USER_MAX_UPLOADS)
+QUEUED_TEXT = "Документ встанет в очередь после ваших предыдущих загрузок"
+PROCESSING_TEXT = "Обработка документа может занять какое-то время..."
+
+async def telegram_file(doc: Document) -> AsyncIterator[bytes]:
+    """Скачивает файл из Telegram по частям, не сохраняя его на диск"""
+
+    file = await bot.get_file(doc.file_id)
+    url = bot.session.api.file_url(bot.token, file.file_path)
+
+    async for chunk in bot.session.stream_content(url=url, timeout=DOWNLOAD_TIMEOUT):
+        yield chunk
+
+def busy_text(resp: aiohttp.ClientResponse) -> str:
+    """Сообщение об отказе API из-за нагрузки (429) с временем из Retry-After"""
+
+    retry_after = resp.headers.get("Retry-After")
+    if retry_after and retry_after.isdigit():
+        return f"Сервис сейчас загружен, попробуйте еще раз через {retry_after} с"
+
+    return "Сервис сейчас загружен, попробуйте еще раз чуть позже"
+
+def document_form(doc: Document) -> aiohttp.FormData:
+    """Multipart-форма, в которую файл передается прямо из потока загрузки из Telegram"""
+
+    data = aiohttp.FormData()
+    data.add_field(
+        'file',
+        telegram_file(doc),
+        filename=doc.file_name,
+        content_type=doc.mime_type or "application/octet-stream"
+    )
+    return data
+
 @dp.message(Command("start"))
 async def cmd_start(message: Message):
     await message.answer(
         "Привет! Я бот для работы с документами.\n\n"
         "Отправь мне файл (.txt, .pdf, .docx) - я его проиндексирую\n"
+        "Отправь файл с подписью /update <id> - я обновлю ранее загруженный документ\n"
         "Напиши вопрос - отвечу на основе загруженных документов\n\n"
         "Команды:\n"
         "/stats - статистика базы\n"
@@ -27,78 +132,209 @@ async def cmd_start(message: Message):
 async def cmd_stats(message: Message):
     user_id = message.from_user.id
 
-    async with aiohttp.ClientSession() as session:
-        async with session.get(f"{API_URL}/stats/{user_id}") as resp:
-            stats = await resp.json()
-            answer = ''.join([f'{name}: {value}\n' for name, value in stats.items()])
-            await message.answer(f"Статистика:\n{answer}")
+    async with api_session().get(f"{API_URL}/stats/{user_id}") as resp:
+        stats = await resp.json()
+        answer = ''.join([f'{name}: {value}\n' for name, value in stats.items()])
+        await message.answer(f"Статистика:\n{answer}")
 
 @dp.message(Command("reset"))
 async def cmd_reset(message: Message):
     user_id = message.from_user.id
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(f"{API_URL}/reset/{user_id}") as resp:
-            await message.answer("База очищена!")
+    async with api_session().post(f"{API_URL}/reset/{user_id}") as resp:
+        await message.answer("База очищена!")
+
+async def wait_for_job(session: aiohttp.ClientSession, job_id: str, status_message: Message) -> dict:
+    """Опрашивает статус задачи загрузки и обновляет сообщение с прогрессом"""
+
+    last_text = None
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + JOB_POLL_TIMEOUT
+
+    while loop.time() < deadline:
+        async with session.get(f"{API_URL}/documents/jobs/{job_id}") as resp:
+            job = await resp.json()
+
+        if job["status"] in ("done", "failed"):
+            return job
+
+        text = JOB_STATUS_TEXT.get(job["status"], job["status"])
+        if job["chunks_total"]:
+            text += f": {job['chunks_embedded']}/{job['chunks_total']} чанков"
+
+        elif job["chunks_embedded"]:
+            text += f": обработано {job['chunks_embedded']} чанков"
+
+        if text != last_text:
+            await status_message.edit_text(text)
+            last_text = text
+
+        await asyncio.sleep(JOB_POLL_INTERVAL)
+
+    raise TimeoutError(f"Job {job_id} is still running")
+
+async def update_document(message: Message, document_id: str):
+    """Отправляет новую версию документа: пересчитываются только измененные чанки"""
+
+    user_id = message.from_user.id
+    doc = message.document
+
+    if not document_id.isdigit():
+        await message.answer("Укажите номер документа: /update <id>")
+        return
+
+    queued = upload_limiter.busy(user_id)
+    status_message = await message.answer(QUEUED_TEXT if queued else "Обновление документа...")
+
+    try:
+        async with upload_limiter.acquire(user_id):
+            if queued:
+                await status_message.edit_text("Обновление документа...")
+
+            async with api_session().put(
+                f"{API_URL}/documents/{document_id}",
+                params={"user_id": user_id},
+                data=document_form(doc)
+            ) as resp:
+                if resp.status == 404:
+                    await status_message.edit_text(f"Документ {document_id} не найден")
+                    return
+
+                if resp.status == 429:
+                    await status_message.edit_text(busy_text(resp))
+                    return
+
+                if resp.status != 200:
+                    error = await resp.text()
+                    print(f"Ошибка: {str(error)}")
+                    await status_message.edit_text("Извините, ошибка обработки")
+                    return
+
+                result = await resp.json()
+
+        await status_message.edit_text(
+            f"Документ {document_id} обновлен!\n"
+            f"Новых чанков: {result['chunks_added']}, удалено: {result['chunks_removed']}, "
+            f"без изменений: {result['chunks_kept']}"
+        )
+
+    except Exception as e:
+        print(f"Ошибка обработки: {str(e)}")
+        await message.answer(f"Извините, ошибка обработки")
 
 @dp.message(lambda msg: msg.document is not None)
 async def handle_document(message: Message):
     user_id = message.from_user.id
     doc = message.document
 
-    await message.answer("Обработка документа может занять какое-то время...")
-    
-    with tempfile.NamedTemporaryFile(delete=False, suffix=doc.file_name) as tmp:
-        await bot.download(doc, destination=tmp.name)
-        tmp_path = tmp.name
-    
+    caption = (message.caption or "").split()
+    if caption and caption[0] == "/update":
+        await update_document(message, caption[1] if len(caption) > 1 else "")
+        return
+
+    queued = upload_limiter.busy(user_id)
+    status_message = await message.answer(QUEUED_TEXT if queued else PROCESSING_TEXT)
+
     try:
-        async with aiohttp.ClientSession() as session:
-            with open(tmp_path, 'rb') as f:
-                data = aiohttp.FormData()
-                data.add_field('file', f, filename=doc.file_name)
-                
-                async with session.post(f"{API_URL}/documents", params={"user_id": user_id}, data=data) as resp:
-                    if resp.status == 200:
-                        result = await resp.json()
-                        await message.answer(
-                            f"Документ обработан!\n"
-                            f"Пример чанка: {result['chunk_preview']}\n"
-                            f"Всего чанков: {result['num_chunks']}"
-                        )
-                        
-                    else:
-                        error = await resp.text()
-                        print(f"Ошибка: {str(error)}")
-                        await message.answer(f"Извините, ошибка работы программы")
+        # Пока документ пользователя обрабатывается, следующие его документы ждут и не занимают очередь API
+        async with upload_limiter.acquire(user_id):
+            if queued:
+                await status_message.edit_text(PROCESSING_TEXT)
+
+            session = api_session()
+            async with session.post(
+                f"{API_URL}/documents",
+                params={"user_id": user_id, "background": "true"},
+                data=document_form(doc)
+            ) as resp:
+                if resp.status == 429:
+                    await message.answer(busy_text(resp))
+                    return
+
+                if resp.status != 200:
+                    error = await resp.text()
+                    print(f"Ошибка: {str(error)}")
+                    await message.answer(f"Извините, ошибка работы программы")
+                    return
+
+                job_id = (await resp.json())["job_id"]
+
+            job = await wait_for_job(session, job_id, status_message)
+
+        if job["status"] == "done":
+            result = job["result"]
+            await message.answer(
+                f"Документ обработан! ID: {result['document_id']}\n"
+                f"Пример чанка: {result['chunk_preview']}\n"
+                f"Всего чанков: {result['num_chunks']}"
+            )
+
+        else:
+            print(f"Ошибка: {job['error']}")
+            await message.answer(f"Извините, ошибка обработки")
 
     except Exception as e:
         print(f"Ошибка обработки: {str(e)}")
         await message.answer(f"Извините, ошибка обработки")
 
-    finally:
-        os.remove(tmp_path)
+async def read_sse(resp: aiohttp.ClientResponse):
+    """Разбирает поток server-sent events в пары (event, data)"""
+
+    event, data = "message", []
+    async for raw_line in resp.content:
+        line = raw_line.decode("utf-8").rstrip("\r\n")
+
+        if not line:
+            if data:
+                yield event, json.loads("\n".join(data))
+            event, data = "message", []
+
+        elif line.startswith("event:"):
+            event = line[len("event:"):].strip()
+
+        elif line.startswith("data:"):
+            data.append(line[len("data:"):].strip())
 
 @dp.message()
 async def handle_question(message: Message):
     user_id = message.from_user.id
     question = message.text
     
-    await message.answer("Думаю...")
+    placeholder = await message.answer("Думаю...")
     
-    async with aiohttp.ClientSession() as session:
-        async with session.post(
-            f"{API_URL}/ask",
-            json={"user_id": user_id, "question": question}
-        ) as resp:
-            if resp.status == 200:
-                result = await resp.json()
-                await message.answer(f"{result['answer']}")
-                
-            else:
-                error = await resp.text()
-                print(f'Ошибка: {error}')
-                await message.answer(f"Извините. Ошибка работы программы. Если вы не загрузили документ, то сначала сделайте это.")
+    async with api_session().post(
+        f"{API_URL}/ask/stream",
+        json={"user_id": user_id, "question": question}
+    ) as resp:
+        if resp.status == 429:
+            await placeholder.edit_text(busy_text(resp))
+            return
+
+        if resp.status != 200:
+            error = await resp.text()
+            print(f'Ошибка: {error}')
+            await placeholder.edit_text(f"Извините. Ошибка работы программы. Если вы не загрузили документ, то сначала сделайте это.")
+            return
+
+        loop = asyncio.get_running_loop()
+        answer, shown, last_edit = "", "", loop.time()
+
+        async for event, data in read_sse(resp):
+            if event == "error":
+                print(f'Ошибка: {data["detail"]}')
+                await placeholder.edit_text(f"Извините. Ошибка работы программы.")
+                return
+
+            if event == "done":
+                break
+
+            answer += data["token"]
+            if answer.strip() and answer != shown and loop.time() - last_edit >= STREAM_EDIT_INTERVAL:
+                await placeholder.edit_text(answer)
+                shown, last_edit = answer, loop.time()
+
+        if answer.strip() and answer != shown:
+            await placeholder.edit_text(answer)
 
 async def start_bot():
     await dp.start_polling(bot)
\ No newline at end of file
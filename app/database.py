@@ -1,19 +1,143 @@
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, ForeignKey, Boolean, Float
+from sqlalchemy import create_engine, event, text, select, delete, update, func, cast, literal, Column, Integer, String, Text, DateTime, ForeignKey, ForeignKeyConstraint, Boolean, Float
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
-from pgvector.sqlalchemy import Vector
-from datetime import datetime
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from pgvector.sqlalchemy import Vector, HALFVEC, BIT
+from pgvector.asyncpg import register_vector
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
 from dotenv import load_dotenv
+import numpy as np
+import hashlib
+import io
 import os
+import struct
+import threading
+import time
+
+from app import metrics
 
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL")
+# Асинхронное подключение для запросов API; по умолчанию тот же DATABASE_URL с драйвером asyncpg
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or DATABASE_URL.replace(
+    "postgresql+psycopg2://", "postgresql://", 1
+).replace("postgresql://", "postgresql+asyncpg://", 1)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+# Сколько секунд настройки пользователя живут в кеше процесса
+SETTINGS_CACHE_TTL = float(os.getenv("SETTINGS_CACHE_TTL", "60"))
+# Сколько пользователей хранится в кеше настроек; при превышении вытесняются давно не запрашивавшиеся
+SETTINGS_CACHE_MAX_USERS = int(os.getenv("SETTINGS_CACHE_MAX_USERS", "100000"))
+# Максимальный размер кеша эмбеддингов чанков (строк) и как часто проверять его размер (секунды)
+EMBEDDING_CACHE_MAX_ROWS = int(os.getenv("EMBEDDING_CACHE_MAX_ROWS", "1000000"))
+EMBEDDING_CACHE_EVICT_INTERVAL = float(os.getenv("EMBEDDING_CACHE_EVICT_INTERVAL", "600"))
+# Время использования строки кеша обновляется не чаще раза в столько секунд
+EMBEDDING_CACHE_TOUCH_INTERVAL = float(os.getenv("EMBEDDING_CACHE_TOUCH_INTERVAL", "86400"))
+
+# Индекс для приближенного поиска ближайших соседей: hnsw, ivfflat или none
+VECTOR_INDEX_TYPE = os.getenv("VECTOR_INDEX_TYPE", "hnsw")
+HNSW_M = int(os.getenv("HNSW_M", "16"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", "64"))
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", "40"))
+IVFFLAT_LISTS = int(os.getenv("IVFFLAT_LISTS", "100"))
+IVFFLAT_PROBES = int(os.getenv("IVFFLAT_PROBES", "10"))
+# Итеративный обход индекса (pgvector >= 0.8.0): off, relaxed_order или strict_order
+VECTOR_ITERATIVE_SCAN = os.getenv("VECTOR_ITERATIVE_SCAN", "relaxed_order")
+# Во сколько раз запрашивать больше кандидатов, если итеративный обход недоступен
+VECTOR_SEARCH_OVERFETCH = int(os.getenv("VECTOR_SEARCH_OVERFETCH", "4"))
+
+# Формат хранения эмбеддингов чанков (pgvector >= 0.7.0 для half и binary):
+#   full   - float32 vector (embedding)
+#   half   - float16 halfvec (embedding_half), в два раза компактнее
+#   binary - halfvec + битовая сигнатура (embedding_bits): поиск кандидатов по
+#            расстоянию Хэмминга, затем пересчет по halfvec
+VECTOR_STORAGE = os.getenv("VECTOR_STORAGE", "full")
+# Колонки embedding_half и embedding_bits есть в схеме, только если формат их использует:
+# типа halfvec нет в pgvector до 0.7.0, и формат full работает на старых версиях
+COMPACT_VECTOR_STORAGE = VECTOR_STORAGE in ("half", "binary")
+# Во сколько раз больше кандидатов отбирать по битовой сигнатуре перед пересчетом
+BINARY_RESCORE_FACTOR = int(os.getenv("BINARY_RESCORE_FACTOR", "10"))
+
+EMBEDDING_DIM = 768
+
+# Секционирование documents и embeddings по хешу user_id: поиск и удаление данных
+# пользователя затрагивают одну секцию. Существующая БД переводится командой
+# python -m app.migrations partition-tables
+PARTITIONED = os.getenv("PARTITIONED", "false").lower() == "true"
+PARTITION_COUNT = int(os.getenv("PARTITION_COUNT", "16"))
 
+# Колонка и класс операторов индекса для каждого формата хранения
+VECTOR_STORAGE_INDEX = {
+    "full": ("embedding", "vector_cosine_ops"),
+    "half": ("embedding_half", "halfvec_cosine_ops"),
+    "binary": ("embedding_bits", "bit_hamming_ops"),
+}
+
+def vector_index_name(index_type: str, storage: str = VECTOR_STORAGE) -> str:
+    return f"ix_embeddings_{VECTOR_STORAGE_INDEX[storage][0]}_{index_type}"
+
+def binary_query_signature(query_embedding):
+    """
+    Битовая сигнатура вектора запроса для сравнения с embedding_bits.
+    binary_quantize есть и для vector, и для halfvec, поэтому параметр явно приводится к halfvec
+    """
+
+    return func.binary_quantize(cast(literal(query_embedding, HALFVEC(EMBEDDING_DIM)), HALFVEC(EMBEDDING_DIM)))
+
+# Синхронный движок используется для init_db и записи документов в воркерах загрузки,
+# асинхронный - для обработки запросов API
 engine = create_engine(DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+async_engine = create_async_engine(ASYNC_DATABASE_URL, pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW)
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+@event.listens_for(async_engine.sync_engine, "connect")
+def _register_vector(dbapi_connection, connection_record):
+    dbapi_connection.run_async(register_vector)
+
+# Счетчик обращений к БД в рамках текущего запроса (см. track_round_trips)
+_round_trips: ContextVar[Optional[List[int]]] = ContextVar("db_round_trips", default=None)
+
+def _count_round_trip(*args, **kwargs):
+    counter = _round_trips.get()
+    if counter is not None:
+        counter[0] += 1
+
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    context.query_started = time.perf_counter()
+
+def _stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+    metrics.observe("db_query_seconds", time.perf_counter() - context.query_started)
+
+for _engine in (engine, async_engine.sync_engine):
+    event.listen(_engine, "before_cursor_execute", _count_round_trip)
+    event.listen(_engine, "before_cursor_execute", _start_query_timer)
+    event.listen(_engine, "after_cursor_execute", _stop_query_timer)
+    event.listen(_engine, "commit", _count_round_trip)
+
+def track_round_trips() -> List[int]:
+    """Начинает подсчет обращений к БД в текущем контексте. Значение - counter[0]"""
+
+    counter = [0]
+    _round_trips.set(counter)
+    return counter
+
 Base = declarative_base()
 
+DEFAULT_USER_SETTINGS = {
+    "enable_query_rewrite": False,
+    "rerank_top_k": 5,
+    "retrieval_top_k": 15,
+}
+
 class User(Base):
     __tablename__ = "users"
     
@@ -27,19 +151,24 @@ class UserSettings(Base):
     __tablename__ = "user_settings"
     
     user_id = Column(Integer, ForeignKey("users.user_id"), primary_key=True)
-    enable_query_rewrite = Column(Boolean, default=False)
-    rerank_top_k = Column(Integer, default=5)
-    retrieval_top_k = Column(Integer, default=15)
+    enable_query_rewrite = Column(Boolean, default=DEFAULT_USER_SETTINGS["enable_query_rewrite"])
+    rerank_top_k = Column(Integer, default=DEFAULT_USER_SETTINGS["rerank_top_k"])
+    retrieval_top_k = Column(Integer, default=DEFAULT_USER_SETTINGS["retrieval_top_k"])
     
     user = relationship("User", back_populates="settings")
 
 class Document(Base):
     __tablename__ = "documents"
+    # Первичный ключ секционированной таблицы должен включать ключ секционирования
+    __table_args__ = {"postgresql_partition_by": "HASH (user_id)"} if PARTITIONED else {}
     
-    id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey("users.user_id"))
+    id = Column(Integer, primary_key=True, autoincrement=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.user_id"), primary_key=PARTITIONED)
     filename = Column(String(255))
     content = Column(Text)
+    content_hash = Column(String(64))
+    # Режим CHUNKING_MODE, которым документ разбит на чанки; NULL у документов, загруженных до появления колонки
+    chunking_mode = Column(String(16))
     uploaded_at = Column(DateTime, default=datetime.now)
     
     user = relationship("User", back_populates="documents")
@@ -47,72 +176,457 @@ class Document(Base):
 
 class Embedding(Base):
     __tablename__ = "embeddings"
+    __table_args__ = (
+        ForeignKeyConstraint(["document_id", "user_id"], ["documents.id", "documents.user_id"], ondelete="CASCADE"),
+        {"postgresql_partition_by": "HASH (user_id)"},
+    ) if PARTITIONED else ()
     
-    id = Column(Integer, primary_key=True, index=True)
-    document_id = Column(Integer, ForeignKey("documents.id", ondelete="CASCADE"))
-    user_id = Column(Integer, ForeignKey("users.user_id"), index=True)
+    id = Column(Integer, primary_key=True, autoincrement=True, index=True)
+    document_id = Column(Integer) if PARTITIONED else Column(Integer, ForeignKey("documents.id", ondelete="CASCADE"))
+    user_id = Column(Integer, ForeignKey("users.user_id"), primary_key=PARTITIONED, index=True)
     chunk_text = Column(Text)
-    embedding = Column(Vector(768))
+    embedding = Column(Vector(EMBEDDING_DIM))
+    if COMPACT_VECTOR_STORAGE:
+        embedding_half = Column(HALFVEC(EMBEDDING_DIM))
+        embedding_bits = Column(BIT(EMBEDDING_DIM))
     chunk_index = Column(Integer)
+    # sha256 текста чанка: по нему при обновлении документа находятся неизмененные чанки
+    chunk_hash = Column(String(64))
     document_name = Column(String(255))
     
     document = relationship("Document", back_populates="embeddings")
 
+class EmbeddingCacheEntry(Base):
+    """Эмбеддинг текста чанка по ключу модели и sha256 текста, общий для всех пользователей"""
+
+    __tablename__ = "embedding_cache"
+
+    model_key = Column(String(255), primary_key=True)
+    text_hash = Column(String(64), primary_key=True)
+    embedding = Column(Vector(EMBEDDING_DIM))
+    last_used_at = Column(DateTime, default=datetime.now, index=True)
+
+def _create_partitions(table, connection, **kw):
+    """Создает PARTITION_COUNT хеш-секций сразу после создания секционированной таблицы"""
+
+    for remainder in range(PARTITION_COUNT):
+        connection.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {table.name}_p{remainder} PARTITION OF {table.name} "
+            f"FOR VALUES WITH (MODULUS {PARTITION_COUNT}, REMAINDER {remainder})"
+        ))
+
+if PARTITIONED:
+    for partitioned_table in (Document.__table__, Embedding.__table__):
+        event.listen(partitioned_table, "after_create", _create_partitions)
+
+def is_partitioned(conn, table: str) -> bool:
+    return conn.execute(
+        text("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(:table)"), {"table": table}
+    ).scalar() or False
+
 def init_db():
     """Создает все таблицы в БД"""
 
     Base.metadata.create_all(bind=engine)
 
-def get_db():
-    """Получает сессию БД"""
+    if PARTITIONED:
+        with engine.connect() as conn:
+            if not is_partitioned(conn, "embeddings"):
+                raise RuntimeError(
+                    "PARTITIONED=true, but embeddings is not partitioned: run python -m app.migrations partition-tables"
+                )
 
-    db = SessionLocal()
+    migrate_schema()
+    create_vector_index()
+
+def migrate_schema():
+    """Добавляет в существующие таблицы колонки и индексы, появившиеся после их создания"""
+
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE documents ADD COLUMN IF NOT EXISTS content_hash VARCHAR(64)"))
+        conn.execute(text("ALTER TABLE documents ADD COLUMN IF NOT EXISTS chunking_mode VARCHAR(16)"))
+        conn.execute(text(
+            "CREATE UNIQUE INDEX IF NOT EXISTS ix_documents_user_content_hash "
+            "ON documents (user_id, content_hash)"
+        ))
+        if COMPACT_VECTOR_STORAGE:
+            conn.execute(text(f"ALTER TABLE embeddings ADD COLUMN IF NOT EXISTS embedding_half halfvec({EMBEDDING_DIM})"))
+            conn.execute(text(f"ALTER TABLE embeddings ADD COLUMN IF NOT EXISTS embedding_bits bit({EMBEDDING_DIM})"))
+        conn.execute(text("ALTER TABLE embeddings ADD COLUMN IF NOT EXISTS chunk_hash VARCHAR(64)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_embeddings_document_id ON embeddings (document_id)"))
+
+def _vector_index_options():
+    """Параметры построения векторного индекса в формате pg_class.reloptions"""
+
+    if VECTOR_INDEX_TYPE == "hnsw":
+        return [f"m={HNSW_M}", f"ef_construction={HNSW_EF_CONSTRUCTION}"]
+
+    return [f"lists={IVFFLAT_LISTS}"]
+
+def create_vector_index():
+    """
+    Создает ANN-индекс по колонке эмбеддингов текущего VECTOR_STORAGE согласно настройкам.
+    Индексы другого типа или по другой колонке удаляются, индекс с устаревшими
+    параметрами перестраивается.
+    """
+
+    if VECTOR_INDEX_TYPE not in ("hnsw", "ivfflat", "none"):
+        raise ValueError(f"Unsupported VECTOR_INDEX_TYPE: {VECTOR_INDEX_TYPE}")
+
+    if VECTOR_STORAGE not in VECTOR_STORAGE_INDEX:
+        raise ValueError(f"Unsupported VECTOR_STORAGE: {VECTOR_STORAGE}")
+
+    with engine.begin() as conn:
+        _detect_iterative_scan(conn)
+
+        for index_type in ("hnsw", "ivfflat"):
+            for storage in VECTOR_STORAGE_INDEX:
+                if (index_type, storage) != (VECTOR_INDEX_TYPE, VECTOR_STORAGE):
+                    conn.execute(text(f"DROP INDEX IF EXISTS {vector_index_name(index_type, storage)}"))
+
+        if VECTOR_INDEX_TYPE == "none":
+            return
+
+        index_name = vector_index_name(VECTOR_INDEX_TYPE)
+        column, opclass = VECTOR_STORAGE_INDEX[VECTOR_STORAGE]
+        options = _vector_index_options()
+
+        # У индекса секционированной таблицы relkind = 'I', у обычного - 'i'
+        current = conn.execute(
+            text("SELECT reloptions FROM pg_class WHERE relname = :name AND relkind IN ('i', 'I')"),
+            {"name": index_name}
+        ).first()
+
+        if current is not None and sorted(current.reloptions or []) == sorted(options):
+            return
+
+        conn.execute(text(f"DROP INDEX IF EXISTS {index_name}"))
+        conn.execute(text(
+            f"CREATE INDEX {index_name} ON embeddings "
+            f"USING {VECTOR_INDEX_TYPE} ({column} {opclass}) "
+            f"WITH ({', '.join(options)})"
+        ))
+
+_iterative_scan_supported = False
+
+def _detect_iterative_scan(conn):
+    """Проверяет, поддерживает ли установленный pgvector итеративный обход индекса"""
+
+    global _iterative_scan_supported
+
+    version = conn.execute(text("SELECT extversion FROM pg_extension WHERE extname = 'vector'")).scalar()
+    parts = tuple(int(p) for p in (version or "0").split(".")[:2])
+    _iterative_scan_supported = parts >= (0, 8)
+
+def vector_search_settings(limit: int) -> List[str]:
+    """
+    Возвращает SET LOCAL команды с параметрами ANN-поиска для текущей транзакции.
+    Индекс не знает о фильтре по пользователю, поэтому без итеративного обхода
+    размер списка кандидатов увеличивается в VECTOR_SEARCH_OVERFETCH раз.
+    """
+
+    if VECTOR_INDEX_TYPE == "none":
+        return []
+
+    iterative = VECTOR_ITERATIVE_SCAN
+    if iterative not in ("relaxed_order", "strict_order") or not _iterative_scan_supported:
+        iterative = None
+
+    candidates = limit if iterative else limit * VECTOR_SEARCH_OVERFETCH
+
+    if VECTOR_INDEX_TYPE == "hnsw":
+        statements = [f"SET LOCAL hnsw.ef_search = {min(max(HNSW_EF_SEARCH, candidates), 1000)}"]
+        if iterative:
+            statements.append(f"SET LOCAL hnsw.iterative_scan = {iterative}")
+
+    else:
+        probes = IVFFLAT_PROBES if iterative else IVFFLAT_PROBES * VECTOR_SEARCH_OVERFETCH
+        statements = [f"SET LOCAL ivfflat.probes = {min(probes, IVFFLAT_LISTS)}"]
+        if iterative:
+            # ivfflat поддерживает только relaxed_order
+            statements.append("SET LOCAL ivfflat.iterative_scan = relaxed_order")
+
+    return statements
+
+# Заголовок бинарного формата COPY: сигнатура, флаги, длина расширения заголовка
+_COPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack("!ii", 0, 0)
+_COPY_TRAILER = struct.pack("!h", -1)
+
+class _CopyStream(io.RawIOBase):
+    """Файлоподобная обертка над генератором байтов для cursor.copy_expert"""
+
+    def __init__(self, parts):
+        self._parts = iter(parts)
+        self._buffer = b""
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            part = next(self._parts, None)
+            if part is None:
+                break
+            self._buffer += part
+
+        if size < 0:
+            size = len(self._buffer)
+
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+def _binary_copy_rows(document_id, user_id, document_name, chunks, embeddings, chunk_indexes):
+    """Кодирует чанки и матрицу эмбеддингов в бинарный формат COPY для колонок из _copy_columns"""
+
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    dim = embeddings.shape[1]
+
+    # vector_recv / halfvec_recv в pgvector: int16 размерность, int16 резерв, затем float4 / float2
+    if VECTOR_STORAGE == "full":
+        vectors = [np.ascontiguousarray(embeddings, dtype=">f4")]
+        vector_headers = [struct.pack("!iHH", 4 + 4 * dim, dim, 0)]
+
+    else:
+        vectors = [np.ascontiguousarray(embeddings, dtype=">f2")]
+        vector_headers = [struct.pack("!iHH", 4 + 2 * dim, dim, 0)]
+
+    # varbit_recv: int32 число бит, затем биты от старшего к младшему (как binary_quantize)
+    if VECTOR_STORAGE == "binary":
+        vectors.append(np.packbits(embeddings > 0, axis=1))
+        vector_headers.append(struct.pack("!ii", 4 + (dim + 7) // 8, dim))
+
+    field_count = struct.pack("!h", 6 + len(vectors))
+    document_field = struct.pack("!ii", 4, document_id)
+    user_field = struct.pack("!ii", 4, user_id)
+    name_bytes = document_name.encode("utf-8")
+    name_field = struct.pack("!i", len(name_bytes)) + name_bytes
+
+    yield _COPY_HEADER
+
+    for idx, (chunk, chunk_index) in enumerate(zip(chunks, chunk_indexes)):
+        chunk_bytes = chunk.encode("utf-8")
+        hash_bytes = hashlib.sha256(chunk_bytes).hexdigest().encode("ascii")
+        vector_fields = b"".join(header + matrix[idx].tobytes() for header, matrix in zip(vector_headers, vectors))
+        yield b"".join((
+            field_count,
+            document_field,
+            user_field,
+            struct.pack("!i", len(chunk_bytes)), chunk_bytes,
+            vector_fields,
+            struct.pack("!ii", 4, chunk_index),
+            struct.pack("!i", len(hash_bytes)), hash_bytes,
+            name_field,
+        ))
+
+    yield _COPY_TRAILER
+
+def _copy_columns() -> str:
+    columns = {
+        "full": "embedding",
+        "half": "embedding_half",
+        "binary": "embedding_half, embedding_bits",
+    }[VECTOR_STORAGE]
+
+    return f"document_id, user_id, chunk_text, {columns}, chunk_index, chunk_hash, document_name"
+
+def bulk_insert_embeddings(db, document_id, user_id, document_name, chunks, embeddings, start_index=0, chunk_indexes=None):
+    """
+    Записывает чанки и их эмбеддинги одним COPY в текущей транзакции сессии.
+    Векторы передаются в бинарном виде без промежуточных ORM-объектов и списков float.
+    Номера чанков идут подряд с start_index, если не переданы явно в chunk_indexes.
+    """
+
+    if chunk_indexes is None:
+        chunk_indexes = range(start_index, start_index + len(chunks))
+
+    cursor = db.connection().connection.cursor()
     try:
-        yield db
+        cursor.copy_expert(
+            f"COPY embeddings ({_copy_columns()}) FROM STDIN WITH (FORMAT binary)",
+            _CopyStream(_binary_copy_rows(document_id, user_id, document_name, chunks, embeddings, chunk_indexes))
+        )
 
     finally:
-        db.close()
+        cursor.close()
+
+def fetch_cached_embeddings(db, model_key: str, text_hashes: List[str]) -> Dict[str, np.ndarray]:
+    """
+    Возвращает найденные в кеше эмбеддинги. Время использования обновляется только
+    у строк, которые не отмечались дольше EMBEDDING_CACHE_TOUCH_INTERVAL, поэтому
+    повторные попадания не переписывают строки кеша.
+    """
+
+    if not text_hashes:
+        return {}
+
+    rows = db.execute(
+        select(EmbeddingCacheEntry.text_hash, EmbeddingCacheEntry.embedding, EmbeddingCacheEntry.last_used_at)
+        .where(EmbeddingCacheEntry.model_key == model_key, EmbeddingCacheEntry.text_hash.in_(text_hashes))
+    ).all()
+
+    touch_before = datetime.now() - timedelta(seconds=EMBEDDING_CACHE_TOUCH_INTERVAL)
+    stale = [row.text_hash for row in rows if row.last_used_at is None or row.last_used_at < touch_before]
+    if stale:
+        db.execute(
+            update(EmbeddingCacheEntry)
+            .where(EmbeddingCacheEntry.model_key == model_key, EmbeddingCacheEntry.text_hash.in_(stale))
+            .values(last_used_at=datetime.now())
+        )
+
+    return {row.text_hash: row.embedding for row in rows}
+
+_last_cache_eviction = 0.0
+
+def store_cached_embeddings(db, model_key: str, text_hashes: List[str], embeddings: np.ndarray):
+    """Сохраняет эмбеддинги в кеш и время от времени вытесняет давно не использованные"""
+
+    global _last_cache_eviction
+
+    if not text_hashes:
+        return
+
+    db.execute(
+        pg_insert(EmbeddingCacheEntry).on_conflict_do_nothing(),
+        [
+            {"model_key": model_key, "text_hash": h, "embedding": e, "last_used_at": datetime.now()}
+            for h, e in zip(text_hashes, embeddings)
+        ]
+    )
+
+    now = time.monotonic()
+    if now - _last_cache_eviction < EMBEDDING_CACHE_EVICT_INTERVAL:
+        return
+
+    _last_cache_eviction = now
+    db.execute(text("""
+        DELETE FROM embedding_cache WHERE ctid IN (
+            SELECT ctid FROM embedding_cache ORDER BY last_used_at
+            LIMIT GREATEST((SELECT count(*) FROM embedding_cache) - :max_rows, 0)
+        )
+    """), {"max_rows": EMBEDDING_CACHE_MAX_ROWS})
+
+def get_document_summary(document_id: int) -> dict:
+    """Возвращает имя, число чанков и начало первого чанка сохраненного документа"""
 
-def get_or_create_user(user_id):
-    """Получает или создает пользователя"""
     db = SessionLocal()
     try:
-        user = db.query(User).filter_by(user_id=user_id).first()
-        if not user:
-            user = User(user_id=user_id)
-            db.add(user)
-            db.commit()
-            
-            settings = UserSettings(user_id=user_id)
-            db.add(settings)
-            db.commit()
-        
-        return user_id
-    
+        doc = db.query(Document).filter_by(id=document_id).first()
+        num_chunks = db.query(func.count(Embedding.id)).filter_by(document_id=document_id).scalar()
+        first_chunk = db.query(Embedding.chunk_text).filter_by(document_id=document_id).order_by(Embedding.chunk_index).first()
+
+        return {
+            "document_id": document_id,
+            "filename": doc.filename,
+            "num_chunks": num_chunks,
+            "chunk_preview": first_chunk.chunk_text[:200] if first_chunk else ""
+        }
+
     finally:
         db.close()
 
-def get_user_settings(user_id):
-    """Получает настройки пользователя"""
+def get_db():
+    """Получает сессию БД"""
 
     db = SessionLocal()
     try:
-        settings = db.query(UserSettings).filter_by(user_id=user_id).first()
-        return {
-            "enable_query_rewrite": settings.enable_query_rewrite,
-            "rerank_top_k": settings.rerank_top_k,
-            "retrieval_top_k": settings.retrieval_top_k
-        } if settings else None
-    
+        yield db
+
     finally:
         db.close()
 
-def update_user_settings(user_id, **kwargs):
+# Создает пользователя и его настройки, если их нет, и возвращает настройки - за одно обращение к БД.
+# Для существующего пользователя строку отдает второй SELECT (он видит снимок до вставки),
+# для нового - RETURNING из new_settings.
+_UPSERT_USER_SQL = text("""
+    WITH new_user AS (
+        INSERT INTO users (user_id, created_at) VALUES (:user_id, now())
+        ON CONFLICT (user_id) DO NOTHING
+    ),
+    new_settings AS (
+        INSERT INTO user_settings (user_id, enable_query_rewrite, rerank_top_k, retrieval_top_k)
+        VALUES (:user_id, :enable_query_rewrite, :rerank_top_k, :retrieval_top_k)
+        ON CONFLICT (user_id) DO NOTHING
+        RETURNING enable_query_rewrite, rerank_top_k, retrieval_top_k
+    )
+    SELECT * FROM new_settings
+    UNION ALL
+    SELECT enable_query_rewrite, rerank_top_k, retrieval_top_k FROM user_settings WHERE user_id = :user_id
+""")
+
+_SELECT_SETTINGS_SQL = text(
+    "SELECT enable_query_rewrite, rerank_top_k, retrieval_top_k FROM user_settings WHERE user_id = :user_id"
+)
+
+_settings_cache: "OrderedDict[int, Tuple[float, dict]]" = OrderedDict()
+_settings_cache_lock = threading.Lock()
+
+def invalidate_user_settings(user_id):
+    """Удаляет настройки пользователя из кеша"""
+
+    with _settings_cache_lock:
+        _settings_cache.pop(user_id, None)
+
+async def _load_user_settings(db: AsyncSession, user_id) -> dict:
+    """
+    Возвращает настройки пользователя из кеша или создает пользователя
+    и читает настройки одним запросом
+    """
+
+    with _settings_cache_lock:
+        cached = _settings_cache.get(user_id)
+        if cached and cached[0] > time.monotonic():
+            _settings_cache.move_to_end(user_id)
+            return cached[1]
+
+    with metrics.timed("load_user"):
+        row = (await db.execute(_UPSERT_USER_SQL, {"user_id": user_id, **DEFAULT_USER_SETTINGS})).mappings().first()
+        if row is None:
+            # Пользователя одновременно создал другой запрос: его вставка не видна в снимке
+            # UPSERT, но уже зафиксирована и видна следующему запросу
+            row = (await db.execute(_SELECT_SETTINGS_SQL, {"user_id": user_id})).mappings().one()
+        await db.commit()
+    settings = dict(row)
+
+    with _settings_cache_lock:
+        _settings_cache.pop(user_id, None)
+        _settings_cache[user_id] = (time.monotonic() + SETTINGS_CACHE_TTL, settings)
+        while len(_settings_cache) > SETTINGS_CACHE_MAX_USERS:
+            _settings_cache.popitem(last=False)
+
+    return settings
+
+@dataclass
+class RequestContext:
+    """Данные одного запроса: пользователь, его настройки и общая сессия БД"""
+
+    user_id: int
+    settings: dict
+    db: AsyncSession
+
+@asynccontextmanager
+async def request_scope(user_id):
+    """
+    Открывает сессию БД на время обработки запроса и один раз загружает
+    (или создает) пользователя с настройками
+    """
+
+    async with AsyncSessionLocal() as db:
+        settings = await _load_user_settings(db, user_id)
+        yield RequestContext(user_id=user_id, settings=settings, db=db)
+
+async def get_or_create_user(user_id):
+    """Получает или создает пользователя"""
+
+    async with AsyncSessionLocal() as db:
+        await _load_user_settings(db, user_id)
+
+    return user_id
+
+async def update_user_settings(user_id, **kwargs):
     """Обновляет настройки пользователя"""
 
-    db = SessionLocal()
-    try:
-        settings = db.query(UserSettings).filter_by(user_id=user_id).first()
+    async with AsyncSessionLocal() as db:
+        settings = await db.get(UserSettings, user_id)
         if not settings:
             settings = UserSettings(user_id=user_id)
             db.add(settings)
@@ -121,37 +635,31 @@ def update_user_settings(user_id, **kwargs):
             if hasattr(settings, key):
                 setattr(settings, key, value)
         
-        db.commit()
-        return True
-    
-    finally:
-        db.close()
+        await db.commit()
 
-def get_user_stats(user_id):
+    invalidate_user_settings(user_id)
+    return True
+
+async def get_user_stats(ctx: RequestContext):
     """Получает статистику пользователя"""
 
-    db = SessionLocal()
-    try:
-        num_documents = db.query(Document).filter_by(user_id=user_id).count()
-        num_chunks = db.query(Embedding).filter_by(user_id=user_id).count()
-        
-        return {
-            "user_id": user_id,
-            "num_documents": num_documents,
-            "num_chunks": num_chunks
-        }
+    row = (await ctx.db.execute(select(
+        select(func.count()).select_from(Document).filter_by(user_id=ctx.user_id).scalar_subquery().label("num_documents"),
+        select(func.count()).select_from(Embedding).filter_by(user_id=ctx.user_id).scalar_subquery().label("num_chunks")
+    ))).one()
     
-    finally:
-        db.close()
+    return {
+        "user_id": ctx.user_id,
+        "num_documents": row.num_documents,
+        "num_chunks": row.num_chunks
+    }
 
-def delete_user_data(user_id):
+async def delete_user_data(ctx: RequestContext):
     """Удаляет все данные пользователя"""
 
-    db = SessionLocal()
-    try:
-        db.query(Document).filter_by(user_id=user_id).delete()
-        db.commit()
-        return True
-    
-    finally:
-        db.close()
\ No newline at end of file
+    # Чанки удаляются явным фильтром по user_id, а не каскадом от документов:
+    # каскад проверяет строки по одной, а с PARTITIONED фильтр затрагивает одну секцию
+    await ctx.db.execute(delete(Embedding).filter_by(user_id=ctx.user_id))
+    await ctx.db.execute(delete(Document).filter_by(user_id=ctx.user_id))
+    await ctx.db.commit()
+    return True
\ No newline at end of file
@@ -0,0 +1,191 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+import math
+import threading
+import time
+
+# Границы корзин гистограмм: для времени (метрики *_seconds) и для размеров и количеств
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+
+class Summary:
+    """Количество, сумма и максимум наблюдаемой величины и гистограмма по корзинам"""
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+        i = bisect_left(self.buckets, value)
+        if i < len(self.buckets):
+            self.bucket_counts[i] += 1
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "avg": self.sum / self.count if self.count else 0.0,
+            "max": self.max
+        }
+
+Labels = Tuple[Tuple[str, str], ...]
+
+_lock = threading.Lock()
+_counters: Dict[Tuple[str, Labels], float] = {}
+_summaries: Dict[Tuple[str, Labels], Summary] = {}
+
+# Длительности этапов текущего HTTP-запроса (см. trace_request), для заголовка Server-Timing
+_request_stages: ContextVar[Optional[List[Tuple[str, float]]]] = ContextVar("request_stages", default=None)
+# Время вложенных timed_iter в текущем потоке, чтобы этапы считались без вложенных
+_iter_stack = threading.local()
+
+def _key(name: str, labels: dict) -> Tuple[str, Labels]:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def _format_name(name: str, labels: Labels) -> str:
+    if not labels:
+        return name
+
+    return name + "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+def inc(name: str, value: float = 1, **labels):
+    """Увеличивает счетчик"""
+
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def observe(name: str, value: float, **labels):
+    """Добавляет наблюдение в сводку"""
+
+    key = _key(name, labels)
+    with _lock:
+        summary = _summaries.get(key)
+        if summary is None:
+            summary = _summaries[key] = Summary(TIME_BUCKETS if name.endswith("_seconds") else SIZE_BUCKETS)
+        summary.observe(value)
+
+def get_summary(name: str, **labels) -> Optional[dict]:
+    """Возвращает одну сводку или None, если наблюдений еще не было"""
+
+    with _lock:
+        summary = _summaries.get(_key(name, labels))
+        return summary.to_dict() if summary else None
+
+def record_stage(stage: str, seconds: float):
+    """Записывает длительность этапа обработки в stage_seconds и в трассу текущего запроса"""
+
+    observe("stage_seconds", seconds, stage=stage)
+
+    stages = _request_stages.get()
+    if stages is not None:
+        stages.append((stage, seconds))
+
+@contextmanager
+def timed(stage: str):
+    """Измеряет длительность блока как этап stage"""
+
+    start = time.perf_counter()
+    try:
+        yield
+
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+def timed_iter(iterable: Iterable, stage: str) -> Iterator:
+    """
+    Отдает элементы iterable и записывает суммарное время их получения как этап stage.
+    Время вложенных timed_iter (например, разбора файла внутри чанкера) не учитывается.
+    """
+
+    stack = _iter_stack.__dict__.setdefault("frames", [])
+    iterator = iter(iterable)
+    total = 0.0
+
+    while True:
+        start = time.perf_counter()
+        stack.append(0.0)
+        try:
+            item = next(iterator)
+
+        except StopIteration:
+            break
+
+        finally:
+            nested = stack.pop()
+            elapsed = time.perf_counter() - start
+            total += elapsed - nested
+            if stack:
+                stack[-1] += elapsed
+
+        yield item
+
+    record_stage(stage, total)
+
+def trace_request() -> List[Tuple[str, float]]:
+    """Начинает запись этапов в текущем контексте; возвращает список (этап, секунды)"""
+
+    stages = []
+    _request_stages.set(stages)
+    return stages
+
+def server_timing(stages: List[Tuple[str, float]]) -> str:
+    """Значение заголовка Server-Timing: суммарная длительность каждого этапа в мс"""
+
+    totals = {}
+    for stage, seconds in stages:
+        totals[stage] = totals.get(stage, 0.0) + seconds
+
+    return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in totals.items())
+
+def snapshot() -> dict:
+    """Возвращает текущие значения всех метрик"""
+
+    with _lock:
+        return {
+            "counters": {_format_name(*key): value for key, value in _counters.items()},
+            "summaries": {_format_name(*key): summary.to_dict() for key, summary in _summaries.items()}
+        }
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf"
+
+    return repr(float(value))
+
+def render_prometheus() -> str:
+    """Все метрики в текстовом формате Prometheus: счетчики и гистограммы"""
+
+    lines = []
+    with _lock:
+        for name in sorted({name for name, _ in _counters}):
+            lines.append(f"# TYPE {name} counter")
+            for (metric, labels), value in _counters.items():
+                if metric == name:
+                    lines.append(f"{_format_name(name, labels)} {_format_value(value)}")
+
+        for name in sorted({name for name, _ in _summaries}):
+            lines.append(f"# TYPE {name} histogram")
+            for (metric, labels), summary in _summaries.items():
+                if metric != name:
+                    continue
+
+                cumulative = 0
+                for bound, count in zip(summary.buckets + (math.inf,), summary.bucket_counts + [None]):
+                    cumulative = summary.count if count is None else cumulative + count
+                    bucket_labels = labels + (("le", _format_value(bound)),)
+                    lines.append(f"{_format_name(name + '_bucket', bucket_labels)} {cumulative}")
+
+                lines.append(f"{_format_name(name + '_sum', labels)} {_format_value(summary.sum)}")
+                lines.append(f"{_format_name(name + '_count', labels)} {summary.count}")
+
+    return "\n".join(lines) + "\n"
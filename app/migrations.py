@@ -0,0 +1,132 @@
+"""
+Миграции данных, которые не выполняются автоматически в init_db.
+
+vector-storage - добавляет и заполняет embedding_half и embedding_bits для строк,
+записанных в формате full, чтобы можно было переключить VECTOR_STORAGE на half или binary
+(нужен pgvector >= 0.7.0):
+    VECTOR_STORAGE=binary python -m app.migrations vector-storage --batch-size 5000 [--drop-full]
+
+С --drop-full исходные float32 векторы обнуляются, место возвращается после VACUUM.
+
+partition-tables - переносит documents и embeddings в таблицы, секционированные
+по хешу user_id (нужен PARTITIONED=true). Выполняется одной транзакцией, на время
+копирования запись в таблицы блокируется:
+    PARTITIONED=true python -m app.migrations partition-tables [--drop-old]
+
+Старые таблицы остаются под именами documents_unpartitioned и embeddings_unpartitioned,
+с --drop-old удаляются.
+"""
+
+import argparse
+import time
+
+from sqlalchemy import text
+
+from app.database import (
+    Base, Document, Embedding, engine, migrate_schema, create_vector_index, is_partitioned,
+    EMBEDDING_DIM, PARTITIONED, PARTITION_COUNT, COMPACT_VECTOR_STORAGE
+)
+
+def migrate_vector_storage(batch_size: int = 5000, drop_full: bool = False):
+    """Заполняет компактные колонки эмбеддингов батчами по id, каждый батч в своей транзакции"""
+
+    if not COMPACT_VECTOR_STORAGE:
+        raise SystemExit("Укажите VECTOR_STORAGE=half или binary")
+
+    with engine.connect() as conn:
+        max_id = conn.execute(text("SELECT coalesce(max(id), 0) FROM embeddings")).scalar()
+
+    updated = 0
+    start = time.perf_counter()
+
+    for low in range(0, max_id + 1, batch_size):
+        with engine.begin() as conn:
+            result = conn.execute(text(f"""
+                UPDATE embeddings
+                SET embedding_half = embedding::halfvec({EMBEDDING_DIM}),
+                    embedding_bits = binary_quantize(embedding)::bit({EMBEDDING_DIM})
+                    {", embedding = NULL" if drop_full else ""}
+                WHERE id >= :low AND id < :high
+                  AND embedding IS NOT NULL
+                  AND (embedding_half IS NULL OR embedding_bits IS NULL OR :drop_full)
+            """), {"low": low, "high": low + batch_size, "drop_full": drop_full})
+            updated += result.rowcount
+
+        print(f"id < {min(low + batch_size, max_id + 1)}: {updated} rows, {time.perf_counter() - start:.1f} s")
+
+    return updated
+
+def migrate_partitioning(drop_old: bool = False):
+    """Пересоздает documents и embeddings секционированными и копирует в них данные"""
+
+    if not PARTITIONED:
+        raise SystemExit("Укажите PARTITIONED=true")
+
+    tables = [Document.__table__, Embedding.__table__]
+
+    with engine.begin() as conn:
+        if is_partitioned(conn, "embeddings"):
+            print("Таблицы уже секционированы")
+            return
+
+        # Имена индексов уникальны в схеме, поэтому индексы старых таблиц тоже переименовываются
+        for table in reversed(tables):
+            conn.execute(text(f"LOCK TABLE {table.name} IN EXCLUSIVE MODE"))
+            index_names = conn.execute(
+                text("SELECT indexname FROM pg_indexes WHERE schemaname = current_schema() AND tablename = :table"),
+                {"table": table.name}
+            ).scalars().all()
+
+            for index_name in index_names:
+                conn.execute(text(f'ALTER INDEX "{index_name}" RENAME TO "{index_name}_unpartitioned"'))
+            conn.execute(text(f"ALTER TABLE {table.name} RENAME TO {table.name}_unpartitioned"))
+
+        Base.metadata.create_all(bind=conn, tables=tables)
+
+        for table in tables:
+            columns = ", ".join(c.name for c in table.columns)
+            start = time.perf_counter()
+            result = conn.execute(text(
+                f"INSERT INTO {table.name} ({columns}) "
+                f"SELECT {columns} FROM {table.name}_unpartitioned WHERE user_id IS NOT NULL"
+            ))
+            conn.execute(text(
+                f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+                f"(SELECT coalesce(max(id), 0) + 1 FROM {table.name}), false)"
+            ))
+            print(f"{table.name}: {result.rowcount} rows, {time.perf_counter() - start:.1f} s")
+
+        if drop_old:
+            for table in reversed(tables):
+                conn.execute(text(f"DROP TABLE {table.name}_unpartitioned"))
+
+    print(f"{len(tables)} tables partitioned into {PARTITION_COUNT} partitions")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    vector_storage = subparsers.add_parser("vector-storage", help="Заполнить halfvec и битовые эмбеддинги")
+    vector_storage.add_argument("--batch-size", type=int, default=5000)
+    vector_storage.add_argument("--drop-full", action="store_true", help="Удалить исходные float32 векторы")
+
+    partition_tables = subparsers.add_parser("partition-tables", help="Секционировать documents и embeddings по user_id")
+    partition_tables.add_argument("--drop-old", action="store_true", help="Удалить исходные таблицы после копирования")
+
+    args = parser.parse_args()
+
+    Base.metadata.create_all(bind=engine)
+    migrate_schema()
+
+    if args.command == "vector-storage":
+        migrate_vector_storage(args.batch_size, args.drop_full)
+
+    elif args.command == "partition-tables":
+        migrate_partitioning(args.drop_old)
+
+    # Индексы строятся уже по заполненным колонкам и новым таблицам
+    migrate_schema()
+    create_vector_index()
+
+if __name__ == "__main__":
+    main()
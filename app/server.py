@@ -0,0 +1,82 @@
+from contextlib import asynccontextmanager
+import asyncio
+import os
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import text
+
+from app.api import router
+from app.database import init_db, engine, track_round_trips
+from app import metrics
+
+# Добавлять в ответы заголовок Server-Timing с длительностью этапов обработки
+TIMING_HEADER_ENABLED = os.getenv("TIMING_HEADER_ENABLED", "false").lower() == "true"
+# Загрузить и прогреть модели при старте; до окончания прогрева /health отвечает 503
+WARMUP_MODELS = os.getenv("WARMUP_MODELS", "false").lower() == "true"
+
+def prepare_database():
+    with engine.connect() as conn:
+        conn.execute(text("CREATE EXTENSION IF NOT EXISTS vector"))
+        conn.commit()
+
+    init_db()
+
+def _warm_up():
+    from app.services.retrieval_service import warm_up
+
+    warm_up()
+
+async def _run_warm_up(app: FastAPI):
+    started = time.perf_counter()
+    try:
+        await run_in_threadpool(_warm_up)
+
+    except Exception as e:
+        print(f"Model warm-up failed: {e}")
+        app.state.warmup_error = str(e)
+        return
+
+    app.state.ready = True
+    print(f"Models warmed up in {time.perf_counter() - started:.1f} s")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Без прогрева модели загружаются при первом запросе, который их использует
+    app.state.ready = not WARMUP_MODELS
+    app.state.warmup_error = None
+    warm_up_task = asyncio.create_task(_run_warm_up(app)) if WARMUP_MODELS else None
+
+    yield
+
+    if warm_up_task is not None:
+        warm_up_task.cancel()
+
+app = FastAPI(
+    title="Document QA Service",
+    description="Question answering over uploaded documents",
+    version="1.0.0",
+    lifespan=lifespan
+)
+
+app.include_router(router)
+
+@app.middleware("http")
+async def instrument_requests(request: Request, call_next):
+    started = time.perf_counter()
+    counter = track_round_trips()
+    stages = metrics.trace_request()
+
+    response = await call_next(request)
+
+    route = request.scope.get("route")
+    labels = {"method": request.method, "route": route.path if route else "unmatched"}
+    metrics.observe("http_request_seconds", time.perf_counter() - started, **labels)
+    metrics.observe("db_round_trips_per_request", counter[0])
+
+    if TIMING_HEADER_ENABLED:
+        stages.append(("total", time.perf_counter() - started))
+        response.headers["Server-Timing"] = metrics.server_timing(stages)
+
+    return response
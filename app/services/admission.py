@@ -0,0 +1,237 @@
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from contextlib import asynccontextmanager
+from typing import Callable, Deque, Optional
+import asyncio
+import math
+import os
+import threading
+import time
+
+from app import metrics
+
+# Сколько вопросов (поиск, rerank, сборка контекста) обрабатывается одновременно и сколько может ждать
+QUERY_CONCURRENCY = int(os.getenv("QUERY_CONCURRENCY", "8"))
+QUERY_QUEUE_SIZE = int(os.getenv("QUERY_QUEUE_SIZE", "64"))
+QUERY_QUEUE_TIMEOUT = float(os.getenv("QUERY_QUEUE_TIMEOUT", "10"))
+# Сколько документов обрабатывается одновременно (синхронные и фоновые загрузки вместе) и сколько может ждать
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "20"))
+INGEST_QUEUE_TIMEOUT = float(os.getenv("INGEST_QUEUE_TIMEOUT", "60"))
+# Сколько запросов одного пользователя может ждать в очереди каждой полосы
+ADMISSION_MAX_QUEUED_PER_USER = int(os.getenv("ADMISSION_MAX_QUEUED_PER_USER", "8"))
+# Сколько миллисекунд загрузка документа ждет между батчами эмбеддингов, пока обрабатываются вопросы
+INGEST_YIELD_MS = float(os.getenv("INGEST_YIELD_MS", "200"))
+
+class OverloadedError(Exception):
+    """Полоса перегружена: запрос отклонен, повторить его стоит через retry_after секунд"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class Lane:
+    """
+    Полоса обработки с ограниченным числом одновременных запросов и ограниченной очередью.
+    Очередь справедливая: свободный слот получают пользователи по кругу, поэтому
+    пользователь с множеством запросов не задерживает остальных.
+    Слот выдается через Future, поэтому ждать его можно и из event loop, и из потока.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        concurrency: int,
+        max_queue: int,
+        max_queued_per_user: int,
+        can_start: Callable[[], bool] = lambda: True,
+        on_drained: Optional[Callable[[], None]] = None,
+    ):
+        self.name = name
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.max_queued_per_user = max_queued_per_user
+        self._can_start = can_start
+        self._on_drained = on_drained
+        self._active = 0
+        self._queued = 0
+        # Ожидающие слота по пользователям в порядке обхода: (Future, время постановки в очередь)
+        self._users: "OrderedDict[int, Deque[tuple]]" = OrderedDict()
+        # Скользящее среднее времени удержания слота, для оценки Retry-After
+        self._hold_seconds = 1.0
+        self._lock = threading.Lock()
+        # Установлено, когда в полосе нет ни выполняющихся, ни ожидающих запросов
+        self.idle = threading.Event()
+        self.idle.set()
+
+    def has_waiting(self) -> bool:
+        # Чтение одного int без блокировки: вызывается из can_start другой полосы под ее блокировкой
+        return self._queued > 0
+
+    def retry_after(self) -> int:
+        """Примерное время в секундах, через которое освободится место в очереди"""
+
+        return max(1, min(60, math.ceil(self._hold_seconds * (self._queued + 1) / self.concurrency)))
+
+    def _reject(self, reason: str) -> OverloadedError:
+        metrics.inc("admission_rejected", lane=self.name, reason=reason)
+        return OverloadedError(f"Too many {self.name} requests, try again later", self.retry_after())
+
+    def submit(self, user_id: int) -> Future:
+        """
+        Запрашивает слот для пользователя. Future завершается, когда слот выдан;
+        после работы слот нужно вернуть через release.
+        Если очередь полосы или пользователя заполнена, бросает OverloadedError.
+        """
+
+        future = Future()
+        with self._lock:
+            if self._active < self.concurrency and not self._queued and self._can_start():
+                self._active += 1
+                self.idle.clear()
+                granted = True
+
+            else:
+                waiters = self._users.get(user_id)
+                if self._queued >= self.max_queue:
+                    raise self._reject("queue_full")
+                if waiters is not None and len(waiters) >= self.max_queued_per_user:
+                    raise self._reject("user_queue_full")
+
+                if waiters is None:
+                    waiters = self._users[user_id] = deque()
+                waiters.append((future, time.perf_counter()))
+                self._queued += 1
+                self.idle.clear()
+                granted = False
+
+        if granted:
+            metrics.observe("admission_queue_wait_seconds", 0.0, lane=self.name)
+            future.set_result(None)
+
+        return future
+
+    def cancel(self, future: Future) -> bool:
+        """Убирает заявку из очереди. False, если слот уже выдан и его нужно вернуть"""
+
+        with self._lock:
+            found = next(
+                ((user_id, waiters, waiter) for user_id, waiters in self._users.items()
+                 for waiter in waiters if waiter[0] is future),
+                None
+            )
+            if found is None:
+                return False
+
+            user_id, waiters, waiter = found
+            waiters.remove(waiter)
+            if not waiters:
+                del self._users[user_id]
+
+            self._queued -= 1
+            self._update_idle()
+            drained = not self._queued
+
+        if drained and self._on_drained:
+            self._on_drained()
+        return True
+
+    def release(self, held_seconds: float):
+        """Возвращает слот и выдает его следующему ожидающему"""
+
+        with self._lock:
+            self._active -= 1
+            self._hold_seconds = 0.9 * self._hold_seconds + 0.1 * held_seconds
+            self._update_idle()
+
+        self.dispatch()
+
+    def dispatch(self):
+        """Выдает свободные слоты ожидающим, обходя пользователей по кругу"""
+
+        granted = []
+        with self._lock:
+            while self._queued and self._active < self.concurrency and self._can_start():
+                user_id, waiters = next(iter(self._users.items()))
+                future, enqueued = waiters.popleft()
+                if waiters:
+                    self._users.move_to_end(user_id)
+                else:
+                    del self._users[user_id]
+
+                self._queued -= 1
+                self._active += 1
+                granted.append((future, enqueued))
+
+            drained = bool(granted) and not self._queued
+
+        now = time.perf_counter()
+        for future, enqueued in granted:
+            metrics.observe("admission_queue_wait_seconds", now - enqueued, lane=self.name)
+            future.set_result(None)
+
+        if drained and self._on_drained:
+            self._on_drained()
+
+    def _update_idle(self):
+        """Вызывается под self._lock"""
+
+        if not self._active and not self._queued:
+            self.idle.set()
+
+    @asynccontextmanager
+    async def slot(self, user_id: int, timeout: float):
+        """Ждет слот не дольше timeout секунд, иначе бросает OverloadedError"""
+
+        future = self.submit(user_id)
+        try:
+            # shield: при отмене ожидания Future не отменяется, заявка снимается через cancel
+            await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), timeout)
+
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if not self.cancel(future):
+                self.release(0.0)
+
+            if isinstance(e, asyncio.TimeoutError):
+                raise self._reject("timeout")
+            raise
+
+        started = time.perf_counter()
+        try:
+            yield
+
+        finally:
+            self.release(time.perf_counter() - started)
+
+class AdmissionScheduler:
+    """
+    Две полосы: query для вопросов и ingest для загрузки документов.
+    У вопросов приоритет: новая загрузка не начинается, пока вопросы ждут в очереди,
+    а идущая загрузка уступает процессор между батчами эмбеддингов (yield_to_queries).
+    """
+
+    def __init__(self):
+        self.query = Lane(
+            "query", QUERY_CONCURRENCY, QUERY_QUEUE_SIZE, ADMISSION_MAX_QUEUED_PER_USER,
+            on_drained=self._queries_drained
+        )
+        self.ingest = Lane(
+            "ingest", INGEST_WORKERS, INGEST_QUEUE_SIZE, ADMISSION_MAX_QUEUED_PER_USER,
+            can_start=lambda: not self.query.has_waiting()
+        )
+
+    def _queries_drained(self):
+        # Загрузки, которые ждали из-за очереди вопросов, можно запускать
+        self.ingest.dispatch()
+
+    def yield_to_queries(self):
+        """Пауза загрузки документа, пока обрабатываются вопросы, но не дольше INGEST_YIELD_MS"""
+
+        if self.query.idle.is_set():
+            return
+
+        started = time.perf_counter()
+        self.query.idle.wait(INGEST_YIELD_MS / 1000)
+        metrics.observe("ingest_yield_seconds", time.perf_counter() - started)
+
+scheduler = AdmissionScheduler()
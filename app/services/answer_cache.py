@@ -0,0 +1,105 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Optional
+import itertools
+import os
+import threading
+import time
+
+import numpy as np
+
+from app import metrics
+
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+# Минимальная косинусная близость вопросов, при которой ответ берется из кеша
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))
+ANSWER_CACHE_MAX_PER_USER = int(os.getenv("ANSWER_CACHE_MAX_PER_USER", "100"))
+ANSWER_CACHE_MAX_USERS = int(os.getenv("ANSWER_CACHE_MAX_USERS", "1000"))
+
+@dataclass
+class CachedAnswer:
+    question: str
+    embedding: np.ndarray
+    answer: str
+    expires_at: float
+
+class SemanticAnswerCache:
+    """
+    Кеш ответов по смыслу вопроса: для каждого пользователя хранит эмбеддинги
+    заданных вопросов и ответы на них. Вытеснение - LRU по пользователям и по
+    записям внутри пользователя, плюс TTL.
+    """
+
+    def __init__(self, threshold: float, ttl: float, max_per_user: int, max_users: int):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_per_user = max_per_user
+        self.max_users = max_users
+        self._users: "OrderedDict[int, OrderedDict[int, CachedAnswer]]" = OrderedDict()
+        # Поколение данных пользователя: растет при каждой инвалидации
+        self._generations: Dict[int, int] = {}
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+
+    def generation(self, user_id: int) -> int:
+        with self._lock:
+            return self._generations.get(user_id, 0)
+
+    def lookup(self, user_id: int, embedding: np.ndarray) -> Optional[str]:
+        """Возвращает сохраненный ответ на достаточно похожий вопрос"""
+
+        now = time.monotonic()
+        with self._lock:
+            entries = self._users.get(user_id)
+            if entries:
+                for key in [k for k, e in entries.items() if e.expires_at <= now]:
+                    del entries[key]
+
+            if not entries:
+                metrics.inc("answer_cache_misses")
+                return None
+
+            keys = list(entries.keys())
+            similarities = np.stack([entries[k].embedding for k in keys]) @ embedding
+            best = int(np.argmax(similarities))
+
+            if similarities[best] < self.threshold:
+                metrics.inc("answer_cache_misses")
+                return None
+
+            self._users.move_to_end(user_id)
+            entries.move_to_end(keys[best])
+            metrics.inc("answer_cache_hits")
+            return entries[keys[best]].answer
+
+    def store(self, user_id: int, question: str, embedding: np.ndarray, answer: str, generation: int):
+        """
+        Сохраняет ответ. Если после начала обработки вопроса данные пользователя
+        изменились (generation устарел), ответ не сохраняется.
+        """
+
+        with self._lock:
+            if self._generations.get(user_id, 0) != generation:
+                return
+
+            entries = self._users.setdefault(user_id, OrderedDict())
+            self._users.move_to_end(user_id)
+            entries[next(self._ids)] = CachedAnswer(question, embedding, answer, time.monotonic() + self.ttl)
+
+            while len(entries) > self.max_per_user:
+                entries.popitem(last=False)
+
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        """Сбрасывает ответы пользователя (после загрузки документа или очистки)"""
+
+        with self._lock:
+            self._users.pop(user_id, None)
+            self._generations[user_id] = self._generations.get(user_id, 0) + 1
+
+answer_cache = SemanticAnswerCache(
+    ANSWER_CACHE_THRESHOLD, ANSWER_CACHE_TTL, ANSWER_CACHE_MAX_PER_USER, ANSWER_CACHE_MAX_USERS
+)
@@ -0,0 +1,153 @@
+from typing import List, Optional, Tuple
+import os
+import threading
+
+from app import metrics
+from app.services.document_service import CHUNK_OVERLAP_CHARS
+from app.services.model_backend import EMBEDDING_MODEL_NAME
+
+# Токенайзер для подсчета токенов контекста. По умолчанию токенайзер модели эмбеддингов:
+# он уже есть локально, а токенайзер LLM может требовать скачивания и доступа к закрытому репозиторию.
+# Если токенайзер недоступен, число токенов оценивается по длине текста
+CONTEXT_TOKENIZER = os.getenv("CONTEXT_TOKENIZER", EMBEDDING_MODEL_NAME)
+# Сколько токенов контекста можно передать в промпт
+CONTEXT_MAX_TOKENS = int(os.getenv("CONTEXT_MAX_TOKENS", "1500"))
+# Часть блока короче этого числа токенов в остаток бюджета не добавляется
+CONTEXT_MIN_TAIL_TOKENS = int(os.getenv("CONTEXT_MIN_TAIL_TOKENS", "32"))
+# Максимальная длина перекрытия соседних чанков в символах и минимальная, которая считается перекрытием
+MAX_OVERLAP_CHARS = int(os.getenv("MAX_OVERLAP_CHARS", "400"))
+MIN_OVERLAP_CHARS = 8
+
+# Примерное число символов на токен для оценки без токенайзера
+_CHARS_PER_TOKEN = 3.5
+
+_tokenizer = None
+_tokenizer_loaded = False
+_tokenizer_lock = threading.Lock()
+
+def _get_tokenizer():
+    """Загружает токенайзер CONTEXT_TOKENIZER один раз; None, если он недоступен"""
+
+    global _tokenizer, _tokenizer_loaded
+
+    with _tokenizer_lock:
+        if not _tokenizer_loaded:
+            try:
+                from transformers import AutoTokenizer
+                _tokenizer = AutoTokenizer.from_pretrained(CONTEXT_TOKENIZER, token=os.getenv("HF_TOKEN"))
+
+            except Exception as e:
+                print(f"Context tokenizer is not available, token counts are estimated: {e}")
+
+            _tokenizer_loaded = True
+
+        return _tokenizer
+
+def count_tokens(texts: List[str]) -> List[int]:
+    tokenizer = _get_tokenizer()
+    if tokenizer is None:
+        return [int(len(t) / _CHARS_PER_TOKEN) + 1 for t in texts]
+
+    return [len(ids) for ids in tokenizer(texts, add_special_tokens=False)["input_ids"]]
+
+def _truncate(text: str, max_tokens: int) -> str:
+    tokenizer = _get_tokenizer()
+    if tokenizer is None:
+        return text[:int(max_tokens * _CHARS_PER_TOKEN)]
+
+    offsets = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)["offset_mapping"]
+    return text[:offsets[max_tokens - 1][1]] if len(offsets) > max_tokens else text
+
+def _overlap(left: str, right: str) -> int:
+    """
+    Длина перекрытия конца left с началом right. Сначала проверяется перекрытие,
+    с которым режет чанки CHUNKING_MODE=chars, иначе берется самое короткое совпадение
+    суффикса с префиксом: на повторяющемся тексте самое длинное совпадение
+    отрезало бы часть содержимого.
+    """
+
+    if len(left) >= CHUNK_OVERLAP_CHARS and right.startswith(left[-CHUNK_OVERLAP_CHARS:]):
+        return CHUNK_OVERLAP_CHARS
+
+    for size in range(MIN_OVERLAP_CHARS, min(len(left), len(right), MAX_OVERLAP_CHARS) + 1):
+        if right.startswith(left[-size:]):
+            return size
+
+    return 0
+
+def _merge(texts: List[str]) -> str:
+    """Склеивает тексты соседних чанков, убирая перекрытие"""
+
+    merged = texts[0]
+    for text in texts[1:]:
+        size = _overlap(merged, text)
+        merged += text[size:] if size else "\n" + text
+
+    return merged
+
+def assemble_context(chunks: List[dict], max_tokens: Optional[int] = None) -> Tuple[List[str], dict]:
+    """
+    Собирает контекст для LLM из отранжированных чанков: соседние чанки одного
+    документа склеиваются без перекрытия, блоки идут в порядке лучшего чанка
+    и добавляются, пока не исчерпан бюджет токенов.
+    Возвращает тексты блоков и число токенов до и после сборки.
+    """
+
+    max_tokens = max_tokens or CONTEXT_MAX_TOKENS
+
+    # Группы подряд идущих чанков одного документа, в каждой запоминается лучшая позиция в ранжировании
+    positioned = sorted(
+        enumerate(chunks),
+        key=lambda item: (item[1].get("document_id") is None, item[1].get("document_id"), item[1].get("chunk_index") or 0)
+    )
+    groups = []
+    for rank, chunk in positioned:
+        last = groups[-1] if groups else None
+        if (
+            last is not None
+            and chunk.get("document_id") is not None
+            and chunk.get("document_id") == last["document_id"]
+            and chunk.get("chunk_index") is not None
+            and chunk["chunk_index"] - last["chunk_index"] <= 1
+        ):
+            if chunk["chunk_index"] != last["chunk_index"]:
+                last["texts"].append(chunk["text"])
+            last["chunk_index"] = chunk["chunk_index"]
+            last["rank"] = min(last["rank"], rank)
+
+        else:
+            groups.append({
+                "document_id": chunk.get("document_id"),
+                "chunk_index": chunk.get("chunk_index"),
+                "texts": [chunk["text"]],
+                "rank": rank,
+            })
+
+    blocks = [_merge(group["texts"]) for group in sorted(groups, key=lambda group: group["rank"])]
+
+    tokens_before = sum(count_tokens([chunk["text"] for chunk in chunks])) if chunks else 0
+    block_tokens = count_tokens(blocks) if blocks else []
+
+    context, used = [], 0
+    for block, tokens in zip(blocks, block_tokens):
+        if used + tokens <= max_tokens:
+            context.append(block)
+            used += tokens
+            continue
+
+        remaining = max_tokens - used
+        if remaining >= CONTEXT_MIN_TAIL_TOKENS:
+            context.append(_truncate(block, remaining))
+            used = max_tokens
+        break
+
+    stats = {
+        "chunks": len(chunks),
+        "blocks": len(context),
+        "tokens": used,
+        "tokens_saved": max(tokens_before - used, 0),
+    }
+    metrics.observe("context_tokens", used)
+    metrics.observe("context_tokens_saved", stats["tokens_saved"])
+
+    return context, stats
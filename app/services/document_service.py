@@ -1,75 +1,401 @@
-from typing import List
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from typing import Iterable, Iterator, List, Tuple
 from fastapi import UploadFile
-import io
+import codecs
+import math
+import multiprocessing
+import os
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
 import pdfplumber
 from unstructured.partition.docx import partition_docx
 
+from app import metrics
+
+# Процессы для параллельного извлечения текста из страниц PDF
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", str(os.cpu_count() or 1)))
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "16"))
+# Максимальное время разбора одного PDF в секундах
+PDF_PARSE_TIMEOUT = float(os.getenv("PDF_PARSE_TIMEOUT", "300"))
+
+# Способ разбиения на чанки: chars (фиксированные окна символов), tokens (по токенайзеру модели)
+# или cdc (границы по скользящему хешу содержимого)
+CHUNKING_MODE = os.getenv("CHUNKING_MODE", "chars")
+# Размер чанка и перекрытие соседних чанков в символах для CHUNKING_MODE=chars
+CHUNK_SIZE_CHARS = 500
+CHUNK_OVERLAP_CHARS = 100
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "24"))
+# Сколько символов текста токенизируется за один вызов токенайзера
+TOKEN_CHUNK_BUFFER_CHARS = int(os.getenv("TOKEN_CHUNK_BUFFER_CHARS", "20000"))
+# Минимальный, средний и максимальный размер чанка в символах для CHUNKING_MODE=cdc
+CDC_MIN_CHARS = int(os.getenv("CDC_MIN_CHARS", "200"))
+CDC_AVG_CHARS = int(os.getenv("CDC_AVG_CHARS", "500"))
+CDC_MAX_CHARS = int(os.getenv("CDC_MAX_CHARS", "800"))
+
+# Таблица gear-хеша: фиксированное зерно, чтобы границы чанков не менялись между запусками
+_GEAR = [random.Random(0x5EED + i).getrandbits(32) for i in range(256)]
+
+_PARAGRAPH_RE = re.compile(r"\n\s*\n")
+_SENTENCE_RE = re.compile(r"(?<=[.!?…])\s+|\n")
+
+_pdf_pool = None
+_pdf_pool_lock = threading.Lock()
+
 def read_text_from_file(file: UploadFile) -> str:
     """
     Читает загруженный файл и возвращает текст.
     Поддерживаются .txt, .pdf, .docx
     """
+
+    return "\n".join(iter_text_from_file(file))
+
+def iter_text_from_file(file: UploadFile) -> Iterator[str]:
+    """
+    Читает загруженный файл по частям (страницам, абзацам, блокам) без
+    загрузки всего текста в память.
+    """
     filename = file.filename.lower()
 
     for extension, parser in PARSERS.items():
         if filename.endswith(extension):
-            return parser(file)
+            return metrics.timed_iter(parser(file), "parse")
 
     raise ValueError(f"Unsupported file type: {file.filename}")
 
-def parse_txt(file: UploadFile) -> str:
+def parse_txt(file: UploadFile, block_size: int = 1 << 16) -> Iterator[str]:
     """
     Работает с .txt
     """
-    
-    content_bytes = file.file.read()
-    return content_bytes.decode("utf-8")
 
-def parse_pdf(file: UploadFile) -> str:
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    text = ""
+
+    for block in iter(lambda: file.file.read(block_size), b""):
+        text += decoder.decode(block)
+        # Отдаем текст до последнего перевода строки, чтобы части совпадали со строками файла
+        cut = text.rfind("\n")
+        if cut >= 0:
+            yield text[:cut]
+            text = text[cut + 1:]
+
+    text += decoder.decode(b"", final=True)
+    if text:
+        yield text
+
+def _extract_pdf_pages(path: str, start: int, end: int) -> List[str]:
+    """Извлекает текст страниц [start, end) в отдельном процессе"""
+
+    with pdfplumber.open(path) as pdf:
+        texts = []
+        for page in pdf.pages[start:end]:
+            texts.append(page.extract_text() or "")
+            # Освобождаем разобранные объекты страницы сразу
+            page.flush_cache()
+
+        return texts
+
+def _count_pdf_pages(path: str) -> int:
+    with pdfplumber.open(path) as pdf:
+        return len(pdf.pages)
+
+def _get_pdf_pool() -> ProcessPoolExecutor:
+    global _pdf_pool
+
+    with _pdf_pool_lock:
+        if _pdf_pool is None:
+            # spawn: в процессе уже работают потоки моделей, fork для них небезопасен
+            _pdf_pool = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+        return _pdf_pool
+
+def _recycle_pdf_pool(pool: ProcessPoolExecutor):
+    """
+    Останавливает процессы пула, включая зависшие на разборе, чтобы они не занимали
+    воркеры навсегда. Следующий _get_pdf_pool создаст новый пул.
+    """
+
+    global _pdf_pool
+
+    with _pdf_pool_lock:
+        if _pdf_pool is not pool:
+            return
+        _pdf_pool = None
+
+    # У ProcessPoolExecutor нет публичного способа прервать выполняющиеся задачи
+    processes = list((pool._processes or {}).values())
+    pool.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+        process.terminate()
+
+    metrics.inc("pdf_pool_recycled")
+
+def parse_pdf(file: UploadFile) -> Iterator[str]:
     """
     Работает с .pdf
+    Подсчет страниц и разбор страниц диапазонами выполняются в пуле процессов
+    (даже для коротких PDF), в работе одновременно не больше 2 * PDF_WORKERS диапазонов.
+    Если разбор не уложился в PDF_PARSE_TIMEOUT, процессы пула останавливаются
+    и пул создается заново.
     """
 
-    text_pages = []
-    with pdfplumber.open(file.file) as pdf:
-        for page in pdf.pages:
-            page_text = page.extract_text()
-            if page_text:
-                text_pages.append(page_text)
+    with tempfile.NamedTemporaryFile(suffix=".pdf") as tmp:
+        shutil.copyfileobj(file.file, tmp)
+        tmp.flush()
+
+        deadline = time.monotonic() + PDF_PARSE_TIMEOUT
+        pool = _get_pdf_pool()
+
+        for attempt in range(2):
+            try:
+                num_pages = pool.submit(_count_pdf_pages, tmp.name).result(timeout=max(deadline - time.monotonic(), 0))
+                break
+
+            except FutureTimeoutError:
+                _recycle_pdf_pool(pool)
+                raise ValueError(f"PDF parsing timed out: {file.filename}")
+
+            except BrokenProcessPool:
+                # Пул остановлен из-за зависшего разбора другого документа: страницы считаются в новом
+                _recycle_pdf_pool(pool)
+                if attempt:
+                    raise ValueError(f"PDF parsing failed: {file.filename}")
+                pool = _get_pdf_pool()
+
+        ranges = [(start, min(start + PDF_PAGES_PER_TASK, num_pages)) for start in range(0, num_pages, PDF_PAGES_PER_TASK)]
+        # (Future, диапазон страниц) в порядке страниц
+        pending = []
+        next_range = 0
+        restarted = False
+
+        try:
+            while pending or next_range < len(ranges):
+                try:
+                    while next_range < len(ranges) and len(pending) < 2 * PDF_WORKERS:
+                        page_range = ranges[next_range]
+                        pending.append((pool.submit(_extract_pdf_pages, tmp.name, *page_range), page_range))
+                        next_range += 1
 
-    return "\n".join(text_pages)
+                    page_texts = pending[0][0].result(timeout=max(deadline - time.monotonic(), 0))
 
-def parse_docx(file: UploadFile) -> str:
+                except FutureTimeoutError:
+                    _recycle_pdf_pool(pool)
+                    raise ValueError(f"PDF parsing timed out: {file.filename}")
+
+                except BrokenProcessPool:
+                    # Процесс пула упал или пул остановлен из-за зависшего разбора другого документа:
+                    # незавершенные диапазоны один раз отправляются в новый пул
+                    _recycle_pdf_pool(pool)
+                    if restarted:
+                        raise ValueError(f"PDF parsing failed: {file.filename}")
+
+                    restarted = True
+                    pool = _get_pdf_pool()
+                    pending = [
+                        (pool.submit(_extract_pdf_pages, tmp.name, *page_range), page_range)
+                        for _, page_range in pending
+                    ]
+                    continue
+
+                pending.pop(0)
+                for page_text in page_texts:
+                    if page_text:
+                        yield page_text
+
+        finally:
+            for future, _ in pending:
+                future.cancel()
+
+def parse_docx(file: UploadFile) -> Iterator[str]:
     """
     Работает с .docx
     """
 
-    content = file.file.read()
-    elements = partition_docx(file=io.BytesIO(content))
-    text_parts = [str(el) for el in elements]
-    
-    return "\n".join(text_parts)
+    for element in partition_docx(file=file.file):
+        yield str(element)
 
-def chunk_text(text: str, chunk_size: int = 500, overlap: int = 100) -> List[str]:
+def iter_chunks(parts: Iterable[str], chunk_size: int = CHUNK_SIZE_CHARS, overlap: int = CHUNK_OVERLAP_CHARS) -> Iterator[str]:
     """
-    Разбивает текст на чанки фиксированного размера с перекрытием
+    Разбивает поток частей текста (соединенных через перевод строки) на чанки
+    фиксированного размера с перекрытием. Результат совпадает с chunk_text
+    для целого текста, но в памяти держится только хвост текущего окна.
     """
 
     if overlap >= chunk_size:
         raise ValueError("overlap must be smaller than chunk_size")
 
-    chunks = []
+    step = chunk_size - overlap
+    buffer = ""
     start = 0
-    text_length = len(text)
+    first = True
+
+    for part in parts:
+        buffer += part if first else "\n" + part
+        first = False
+
+        while len(buffer) - start >= chunk_size:
+            yield buffer[start:start + chunk_size]
+            start += step
+
+        buffer = buffer[start:]
+        start = 0
+
+    while start < len(buffer):
+        yield buffer[start:start + chunk_size]
+        start += step
 
-    while start < text_length:
-        end = start + chunk_size
-        chunk = text[start:end]
-        chunks.append(chunk)
+def _boundary_tokens(text: str, token_starts: List[int], pattern: re.Pattern) -> List[int]:
+    """Индексы токенов, с которых начинается новый абзац или предложение"""
 
-        start = end - overlap
+    return sorted({bisect_left(token_starts, match.end()) for match in pattern.finditer(text)})
+
+def _last_boundary(boundaries: List[int], low: int, high: int):
+    """Последняя граница в диапазоне (low, high] или None"""
+
+    i = bisect_left(boundaries, high + 1) - 1
+    return boundaries[i] if i >= 0 and boundaries[i] > low else None
+
+def _token_windows(text: str, tokenizer, max_tokens: int, overlap: int, final: bool) -> Tuple[List[str], int]:
+    """
+    Режет текст на чанки не длиннее max_tokens токенов, по возможности по границам
+    абзацев и предложений. Возвращает чанки и позицию в тексте, с которой
+    начинается необработанный хвост (если final=False).
+    """
+
+    offsets = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)["offset_mapping"]
+    token_starts = [start for start, _ in offsets]
+    paragraphs = _boundary_tokens(text, token_starts, _PARAGRAPH_RE)
+    sentences = _boundary_tokens(text, token_starts, _SENTENCE_RE)
+
+    chunks = []
+    n = len(offsets)
+    pos = 0
+
+    # Пока текст не закончился, режем только окна, за которыми есть продолжение:
+    # иначе граница могла бы оказаться в следующей порции текста
+    while n - pos > max_tokens or (final and pos < n):
+        limit = pos + max_tokens
+        if limit >= n:
+            end = n
+
+        else:
+            half = pos + max_tokens // 2
+            end = _last_boundary(paragraphs, half, limit) or _last_boundary(sentences, half, limit) or limit
+
+        chunk = text[offsets[pos][0]:offsets[end - 1][1]].strip()
+        if chunk:
+            chunks.append(chunk)
+
+        if end >= n:
+            pos = n
+            break
+
+        # Перекрытие начинаем с начала предложения, если оно попадает в окно перекрытия
+        next_pos = max(end - overlap, pos + 1)
+        pos = _last_boundary(sentences, next_pos - 1, end - 1) or next_pos
+
+    return chunks, offsets[pos][0] if pos < n else len(text)
+
+def iter_token_chunks(parts: Iterable[str], tokenizer, max_tokens: int, overlap: int = CHUNK_OVERLAP_TOKENS) -> Iterator[str]:
+    """
+    Разбивает поток частей текста на чанки по числу токенов модели.
+    Текст токенизируется порциями по TOKEN_CHUNK_BUFFER_CHARS символов
+    (одним вызовом быстрого токенайзера с offset mapping на порцию).
+    """
+
+    if overlap >= max_tokens:
+        raise ValueError("overlap must be smaller than max_tokens")
+
+    buffer = ""
+    first = True
+
+    for part in parts:
+        buffer += part if first else "\n" + part
+        first = False
+
+        if len(buffer) >= TOKEN_CHUNK_BUFFER_CHARS:
+            chunks, rest = _token_windows(buffer, tokenizer, max_tokens, overlap, final=False)
+            yield from chunks
+            buffer = buffer[rest:]
+
+    if buffer:
+        chunks, _ = _token_windows(buffer, tokenizer, max_tokens, overlap, final=True)
+        yield from chunks
+
+def iter_cdc_chunks(
+    parts: Iterable[str],
+    min_size: int = CDC_MIN_CHARS,
+    avg_size: int = CDC_AVG_CHARS,
+    max_size: int = CDC_MAX_CHARS
+) -> Iterator[str]:
+    """
+    Разбивает поток частей текста на чанки с границами, зависящими от содержимого
+    (gear-хеш по последним ~32 символам). Граница ставится после пробельного символа,
+    если младшие биты хеша равны нулю, поэтому вставка или удаление фрагмента меняет
+    только соседние чанки, а остальные совпадают с прежними и не пересчитываются.
+    """
+
+    if not 0 < min_size < avg_size < max_size:
+        raise ValueError("CDC sizes must satisfy 0 < min_size < avg_size < max_size")
+
+    # Хеш проверяется только на пробельных символах (примерно каждый шестой символ текста).
+    # Берутся старшие биты: младшие зависят лишь от нескольких последних символов
+    bits = max(1, round(math.log2(max(avg_size - min_size, 6) / 6)))
+    mask = ((1 << bits) - 1) << (32 - bits)
+
+    chunk = []
+    size = 0
+    h = 0
+    first = True
+
+    for part in parts:
+        for char in (part if first else "\n" + part):
+            chunk.append(char)
+            size += 1
+            h = ((h << 1) + _GEAR[ord(char) & 0xFF]) & 0xFFFFFFFF
+
+            if size >= max_size or (size >= min_size and char.isspace() and not h & mask):
+                text = "".join(chunk).strip()
+                if text:
+                    yield text
+                chunk, size, h = [], 0, 0
+
+        first = False
+
+    text = "".join(chunk).strip()
+    if text:
+        yield text
+
+def split_into_chunks(parts: Iterable[str], tokenizer=None, max_tokens: int = None, mode: str = None) -> Iterator[str]:
+    """Разбивает текст на чанки способом mode, по умолчанию из CHUNKING_MODE"""
+
+    mode = mode or CHUNKING_MODE
+
+    if mode == "tokens":
+        chunks = iter_token_chunks(parts, tokenizer, max_tokens)
+
+    elif mode == "cdc":
+        chunks = iter_cdc_chunks(parts)
+
+    elif mode == "chars":
+        chunks = iter_chunks(parts)
+
+    else:
+        raise ValueError(f"Unsupported CHUNKING_MODE: {mode}")
+
+    return metrics.timed_iter(chunks, "chunk")
+
+def chunk_text(text: str, chunk_size: int = CHUNK_SIZE_CHARS, overlap: int = CHUNK_OVERLAP_CHARS) -> List[str]:
+    """
+    Разбивает текст на чанки фиксированного размера с перекрытием
+    """
 
-    return chunks
+    return list(iter_chunks([text], chunk_size, overlap))
 
 PARSERS = {
     ".txt": parse_txt,
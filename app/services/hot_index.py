@@ -0,0 +1,173 @@
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Deque, Dict, List, Optional, Tuple
+import os
+import threading
+import time
+
+import numpy as np
+
+from app import metrics
+
+HOT_INDEX_ENABLED = os.getenv("HOT_INDEX_ENABLED", "true").lower() == "true"
+# Сколько памяти могут занимать матрицы эмбеддингов всех пользователей
+HOT_INDEX_MAX_MB = float(os.getenv("HOT_INDEX_MAX_MB", "256"))
+# Пользователи с большим числом чанков ищутся только в Postgres
+HOT_INDEX_MAX_CHUNKS = int(os.getenv("HOT_INDEX_MAX_CHUNKS", "10000"))
+# Пользователь попадает в индекс после HOT_INDEX_MIN_QUERIES поисков за HOT_INDEX_WINDOW секунд,
+# до этого его запросы идут в Postgres
+HOT_INDEX_MIN_QUERIES = int(os.getenv("HOT_INDEX_MIN_QUERIES", "3"))
+HOT_INDEX_WINDOW = float(os.getenv("HOT_INDEX_WINDOW", "300"))
+# float32 или float16 (в два раза меньше памяти, при поиске строки приводятся к float32 блоками)
+HOT_INDEX_DTYPE = os.getenv("HOT_INDEX_DTYPE", "float32")
+
+@dataclass
+class UserMatrix:
+    """Нормированные эмбеддинги чанков пользователя одной непрерывной матрицей"""
+
+    ids: np.ndarray
+    matrix: np.ndarray
+
+    @property
+    def nbytes(self) -> int:
+        return self.ids.nbytes + self.matrix.nbytes
+
+    # Сколько строк float16-матрицы приводится к float32 за один шаг поиска
+    BLOCK_ROWS = 4096
+
+    def scores(self, queries: np.ndarray) -> np.ndarray:
+        """Косинусная близость запросов ко всем чанкам: матрица (число запросов, число чанков) в float32"""
+
+        queries = np.asarray(queries, dtype=np.float32)
+        if self.matrix.dtype == np.float32:
+            return queries @ self.matrix.T
+
+        # float16 умножается блоками строк с накоплением в float32, без копии всей матрицы
+        scores = np.empty((len(queries), len(self.matrix)), dtype=np.float32)
+        for start in range(0, len(self.matrix), self.BLOCK_ROWS):
+            block = self.matrix[start:start + self.BLOCK_ROWS].astype(np.float32)
+            scores[:, start:start + len(block)] = queries @ block.T
+
+        return scores
+
+    def top_k(self, queries: np.ndarray, k: int) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """Для каждого запроса возвращает id и косинусную близость k ближайших чанков по убыванию близости"""
+
+        hits = []
+        for scores in self.scores(queries):
+            n = min(k, len(scores))
+            best = np.argpartition(-scores, n - 1)[:n] if n < len(scores) else np.arange(len(scores))
+            best = best[np.argsort(-scores[best])]
+            hits.append((self.ids[best], scores[best]))
+
+        return hits
+
+class HotTenantIndex:
+    """
+    Матрицы эмбеддингов активных пользователей в памяти процесса: поиск по ним -
+    одно матричное умножение вместо ORDER BY cosine_distance в Postgres.
+    Пользователь загружается в индекс, только когда ищет часто (min_queries поисков
+    за window секунд), поэтому редкие запросы не вытесняют активных пользователей.
+    Вытеснение - LRU по пользователям при превышении лимита памяти.
+    """
+
+    # Сколько пользователей вне индекса отслеживается для подсчета частоты поисков
+    MAX_TRACKED_USERS = 100_000
+
+    def __init__(self, max_bytes: int, max_chunks: int, min_queries: int = 1, window: float = 0.0):
+        self.max_bytes = max_bytes
+        self.max_chunks = max_chunks
+        self.min_queries = min_queries
+        self.window = window
+        self._users: "OrderedDict[int, UserMatrix]" = OrderedDict()
+        self._nbytes = 0
+        # Пользователи, у которых чанков больше max_chunks, с поколением на момент проверки
+        self._too_large: Dict[int, int] = {}
+        # Поколение данных пользователя: растет при каждой инвалидации
+        self._generations: Dict[int, int] = {}
+        # Время недавних поисков пользователей, которых нет в индексе
+        self._recent: "OrderedDict[int, Deque[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def generation(self, user_id: int) -> int:
+        with self._lock:
+            return self._generations.get(user_id, 0)
+
+    def lookup(self, user_id: int) -> Optional[UserMatrix]:
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None:
+                metrics.inc("hot_index_misses")
+                return None
+
+            self._users.move_to_end(user_id)
+            metrics.inc("hot_index_hits")
+            return entry
+
+    def should_load(self, user_id: int) -> bool:
+        """
+        Учитывает поиск пользователя, которого нет в индексе. True, если он ищет достаточно
+        часто, чтобы загрузить его матрицу; False, если он пока холодный или его данные
+        уже оказались слишком большими для индекса.
+        """
+
+        now = time.monotonic()
+        with self._lock:
+            if self._too_large.get(user_id) == self._generations.get(user_id, 0):
+                return False
+
+            recent = self._recent.pop(user_id, None) or deque()
+            recent.append(now)
+            while recent and now - recent[0] > self.window:
+                recent.popleft()
+
+            if len(recent) >= self.min_queries:
+                return True
+
+            self._recent[user_id] = recent
+            while len(self._recent) > self.MAX_TRACKED_USERS:
+                self._recent.popitem(last=False)
+
+            metrics.inc("hot_index_cold_searches")
+            return False
+
+    def store(self, user_id: int, entry: Optional[UserMatrix], generation: int):
+        """
+        Сохраняет матрицу пользователя (None - у пользователя слишком много чанков).
+        Если данные пользователя изменились после начала загрузки, ничего не сохраняется.
+        """
+
+        with self._lock:
+            if self._generations.get(user_id, 0) != generation:
+                return
+
+            if entry is None or entry.nbytes > self.max_bytes:
+                self._too_large[user_id] = generation
+                return
+
+            old = self._users.pop(user_id, None)
+            if old is not None:
+                self._nbytes -= old.nbytes
+
+            self._users[user_id] = entry
+            self._nbytes += entry.nbytes
+
+            while self._nbytes > self.max_bytes:
+                _, evicted = self._users.popitem(last=False)
+                self._nbytes -= evicted.nbytes
+                metrics.inc("hot_index_evictions")
+
+    def invalidate(self, user_id: int):
+        """Сбрасывает матрицу пользователя (после загрузки документа или очистки)"""
+
+        with self._lock:
+            entry = self._users.pop(user_id, None)
+            if entry is not None:
+                self._nbytes -= entry.nbytes
+                # Активный пользователь загружается заново при следующем же поиске
+                self._recent[user_id] = deque([time.monotonic()] * (self.min_queries - 1))
+
+            self._too_large.pop(user_id, None)
+            self._generations[user_id] = self._generations.get(user_id, 0) + 1
+
+hot_index = HotTenantIndex(int(HOT_INDEX_MAX_MB * 2**20), HOT_INDEX_MAX_CHUNKS, HOT_INDEX_MIN_QUERIES, HOT_INDEX_WINDOW)
@@ -0,0 +1,241 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import BinaryIO, Callable, Dict, Iterable, Iterator, List, Optional
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+from fastapi import UploadFile
+
+from app.database import get_document_summary
+from app.services.admission import scheduler, OverloadedError, INGEST_WORKERS
+from app.services.answer_cache import answer_cache
+from app.services.document_service import iter_text_from_file, split_into_chunks, CHUNKING_MODE
+from app.services.retrieval_service import compute_embeddings, chunk_tokenizer, reindex_document, DocumentWriter
+
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "64"))
+# Сколько секунд хранить статус завершенной задачи
+INGEST_JOB_TTL = int(os.getenv("INGEST_JOB_TTL", "3600"))
+
+@dataclass
+class IngestionJob:
+    job_id: str
+    user_id: int
+    filename: str
+    content_hash: str
+    status: str = "queued"
+    chunks_total: int = 0
+    chunks_embedded: int = 0
+    result: Optional[dict] = None
+    error: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "failed")
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.job_id,
+            "user_id": self.user_id,
+            "filename": self.filename,
+            "status": self.status,
+            "chunks_total": self.chunks_total,
+            "chunks_embedded": self.chunks_embedded,
+            "result": self.result,
+            "error": self.error,
+        }
+
+_executor = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix="ingest")
+_jobs: Dict[str, IngestionJob] = {}
+_jobs_lock = threading.Lock()
+
+def file_sha256(file: BinaryIO) -> str:
+    """Считает sha256 содержимого файла блоками и возвращает указатель в начало"""
+
+    digest = hashlib.sha256()
+    for block in iter(lambda: file.read(1 << 20), b""):
+        digest.update(block)
+
+    file.seek(0)
+    return digest.hexdigest()
+
+def _batched(items: Iterable[str], size: int) -> Iterator[List[str]]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+def ingest_document(
+    user_id: int,
+    filename: str,
+    file: BinaryIO,
+    content_hash: Optional[str] = None,
+    progress: Optional[Callable[..., None]] = None,
+) -> dict:
+    """
+    Разбирает файл, разбивает на чанки, считает эмбеддинги и сохраняет документ.
+    Все шаги работают потоком: части текста идут в чанкер, чанки - батчами
+    по EMBED_BATCH_SIZE в энкодер и сразу в БД.
+    Повторный вызов для того же содержимого не создает дубликат документа.
+    """
+
+    def report(status, **counts):
+        if progress:
+            progress(status, **counts)
+
+    if content_hash is None:
+        content_hash = file_sha256(file)
+
+    with DocumentWriter(user_id, filename, content_hash, CHUNKING_MODE) as writer:
+        existing_id = writer.begin()
+        if existing_id:
+            return get_document_summary(existing_id)
+
+        def parts():
+            for part in iter_text_from_file(UploadFile(file=file, filename=filename)):
+                writer.add_content(part)
+                yield part
+
+        report("parsing")
+        chunk_preview = None
+        tokenizer, max_tokens = chunk_tokenizer()
+
+        for batch in _batched(split_into_chunks(parts(), tokenizer, max_tokens), EMBED_BATCH_SIZE):
+            if chunk_preview is None:
+                chunk_preview = batch[0][:200]
+
+            scheduler.yield_to_queries()
+            writer.write(batch, compute_embeddings(batch))
+            report("embedding", chunks_embedded=writer.num_chunks)
+
+        if not writer.num_chunks:
+            raise ValueError(f"Document is empty: {filename}")
+
+        report("inserting", chunks_total=writer.num_chunks)
+        document_id = writer.commit()
+
+    answer_cache.invalidate(user_id)
+
+    return {
+        "document_id": document_id,
+        "filename": filename,
+        "num_chunks": writer.num_chunks,
+        "chunk_preview": chunk_preview
+    }
+
+def update_document(user_id: int, document_id: int, filename: str, file: BinaryIO) -> dict:
+    """
+    Заменяет содержимое документа новой версией файла. Текст идет потоком и
+    разбивается на чанки тем же режимом, что и при загрузке документа, поэтому
+    неизмененные чанки совпадают с сохраненными, и эмбеддинги считаются только
+    для измененных. С CHUNKING_MODE=cdc после правки совпадает большая часть чанков.
+    """
+
+    content_hash = file_sha256(file)
+    tokenizer, max_tokens = chunk_tokenizer()
+
+    def chunker(parts, chunking_mode):
+        # У документов, загруженных до появления documents.chunking_mode, режим не сохранен
+        return split_into_chunks(parts, tokenizer, max_tokens, chunking_mode or CHUNKING_MODE)
+
+    result = reindex_document(
+        user_id, document_id, filename, iter_text_from_file(UploadFile(file=file, filename=filename)),
+        chunker, content_hash, EMBED_BATCH_SIZE
+    )
+    answer_cache.invalidate(user_id)
+
+    return result
+
+def _prune_jobs():
+    """Удаляет давно завершенные задачи. Вызывается под _jobs_lock"""
+
+    deadline = time.time() - INGEST_JOB_TTL
+    for job_id in [j.job_id for j in _jobs.values() if j.finished and j.finished_at < deadline]:
+        del _jobs[job_id]
+
+def _run_job(job: IngestionJob, file: BinaryIO):
+    """Выполняет задачу в воркере; слот полосы ingest уже выдан и возвращается по завершении"""
+
+    started = time.perf_counter()
+
+    def progress(status, **counts):
+        with _jobs_lock:
+            job.status = status
+            for name, value in counts.items():
+                setattr(job, name, value)
+
+    try:
+        result = ingest_document(job.user_id, job.filename, file, job.content_hash, progress)
+        with _jobs_lock:
+            job.result = result
+            job.status = "done"
+            job.finished_at = time.time()
+
+    except Exception as e:
+        with _jobs_lock:
+            job.error = str(e)
+            job.status = "failed"
+            job.finished_at = time.time()
+
+    finally:
+        file.close()
+        scheduler.ingest.release(time.perf_counter() - started)
+
+def submit_ingestion_job(user_id: int, upload: UploadFile) -> IngestionJob:
+    """
+    Ставит загрузку документа в очередь и сразу возвращает задачу.
+    Задача запускается, когда полоса ingest выдаст ей слот (пользователи обслуживаются по кругу).
+    Если такой же файл этого пользователя уже обрабатывается, возвращается существующая задача.
+    Если очередь заполнена, бросает OverloadedError.
+    """
+
+    # Загрузка живет только в рамках запроса, поэтому копируем ее во временный файл
+    file = tempfile.TemporaryFile()
+    shutil.copyfileobj(upload.file, file)
+    file.seek(0)
+    content_hash = file_sha256(file)
+
+    with _jobs_lock:
+        _prune_jobs()
+
+        for job in _jobs.values():
+            if job.user_id == user_id and job.content_hash == content_hash and not job.finished:
+                file.close()
+                return job
+
+        job = IngestionJob(
+            job_id=uuid.uuid4().hex,
+            user_id=user_id,
+            filename=upload.filename,
+            content_hash=content_hash
+        )
+
+        try:
+            slot = scheduler.ingest.submit(user_id)
+
+        except OverloadedError:
+            file.close()
+            raise
+
+        _jobs[job.job_id] = job
+
+    slot.add_done_callback(lambda _: _executor.submit(_run_job, job, file))
+    return job
+
+def get_ingestion_job(job_id: str) -> Optional[dict]:
+    """Возвращает состояние задачи загрузки"""
+
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        return job.to_dict() if job else None
@@ -0,0 +1,303 @@
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Deque, Dict, List, Optional
+import asyncio
+import math
+import os
+import random
+import threading
+
+from dotenv import load_dotenv
+
+from app import metrics
+
+load_dotenv()
+
+LLM_MODEL = os.getenv("LLM_MODEL", "meta-llama/Llama-3.1-8B-Instruct")
+# OpenAI-совместимый сервер вместо провайдера Hugging Face (например, локальная заглушка для бенчмарков)
+LLM_BASE_URL = os.getenv("LLM_BASE_URL")
+# Провайдер Hugging Face Inference Providers, если LLM_BASE_URL не задан
+LLM_PROVIDER = os.getenv("LLM_PROVIDER", "novita")
+HF_ROUTER_URL = "https://router.huggingface.co/v1"
+
+# Сколько вызовов LLM выполняется одновременно; остальные ждут в пределах своего дедлайна
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+# Дедлайн одного вызова в секундах, включая ожидание, повторы и дублирующие запросы
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "30"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+# Повторы при таймаутах, ошибках соединения, 429 и 5xx: экспоненциальная задержка со случайным разбросом
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "0.5"))
+# Дублирующий запрос, если ответа нет дольше этого перцентиля недавних задержек (0 - выключено)
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "0"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+# Максимальная пауза между частями потокового ответа
+LLM_STREAM_IDLE_TIMEOUT = float(os.getenv("LLM_STREAM_IDLE_TIMEOUT", "30"))
+
+class LLMError(Exception):
+    """Вызов LLM не удался: истек дедлайн или закончились повторы"""
+
+class LatencyTracker:
+    """Задержки последних успешных запросов для выбора момента дублирующего запроса"""
+
+    def __init__(self, size: int = 200):
+        self._samples: Deque[float] = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, q: float, min_samples: int) -> Optional[float]:
+        with self._lock:
+            if len(self._samples) < min_samples:
+                return None
+
+            samples = sorted(self._samples)
+
+        return samples[min(len(samples) - 1, math.ceil(q / 100 * len(samples)) - 1)]
+
+def _retry_after(error: Exception) -> Optional[float]:
+    """Минимальная задержка перед повтором или None, если ошибку повторять бессмысленно"""
+
+    import openai
+
+    if isinstance(error, (asyncio.TimeoutError, openai.APIConnectionError)):
+        return 0.0
+
+    if isinstance(error, openai.APIStatusError):
+        if error.status_code not in (408, 409, 429) and error.status_code < 500:
+            return None
+
+        header = error.response.headers.get("retry-after")
+        try:
+            return float(header) if header else 0.0
+
+        except ValueError:
+            return 0.0
+
+    return None
+
+class LLMClient:
+    """
+    Клиент OpenAI-совместимого API чата поверх одного долгоживущего пула соединений.
+    Каждый вызов ограничен дедлайном, число одновременных вызовов - семафором.
+    Временные ошибки повторяются с экспоненциальной задержкой и случайным разбросом,
+    а если ответ задерживается дольше hedge_percentile недавних задержек, параллельно
+    отправляется дублирующий запрос и используется первый успешный ответ.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        api_key: Optional[str],
+        model: str,
+        max_concurrency: int = LLM_MAX_CONCURRENCY,
+        timeout: float = LLM_TIMEOUT,
+        max_retries: int = LLM_MAX_RETRIES,
+        retry_base_delay: float = LLM_RETRY_BASE_DELAY,
+        hedge_percentile: float = LLM_HEDGE_PERCENTILE,
+    ):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.model = model
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.hedge_percentile = hedge_percentile
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._latency: Dict[str, LatencyTracker] = {}
+        self._client = None
+
+    def _openai(self):
+        """Создает клиент при первом вызове: соединения переиспользуются всеми вызовами"""
+
+        if self._client is None:
+            from openai import AsyncOpenAI, Timeout
+
+            self._client = AsyncOpenAI(
+                base_url=self.base_url,
+                api_key=self.api_key or "-",
+                timeout=Timeout(self.timeout, connect=LLM_CONNECT_TIMEOUT),
+                max_retries=0
+            )
+
+        return self._client
+
+    def _tracker(self, call: str) -> LatencyTracker:
+        return self._latency.setdefault(call, LatencyTracker())
+
+    @asynccontextmanager
+    async def _slot(self, call: str, deadline: float):
+        """Место среди LLM_MAX_CONCURRENCY одновременных вызовов; ожидание не дольше дедлайна"""
+
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        await asyncio.wait_for(self._semaphore.acquire(), max(deadline - started, 0))
+        metrics.observe("llm_concurrency_wait_seconds", loop.time() - started, call=call)
+
+        try:
+            yield
+
+        finally:
+            self._semaphore.release()
+
+    async def _attempt(self, call: str, messages: List[dict], params: dict, deadline: float):
+        loop = asyncio.get_running_loop()
+        async with self._slot(call, deadline):
+            started = loop.time()
+            try:
+                completion = await self._openai().chat.completions.create(
+                    model=self.model,
+                    messages=messages,
+                    timeout=max(deadline - started, 0.001),
+                    **params
+                )
+
+            except Exception:
+                metrics.inc("llm_attempts", call=call, outcome="error")
+                raise
+
+        self._tracker(call).add(loop.time() - started)
+        metrics.inc("llm_attempts", call=call, outcome="ok")
+        return completion
+
+    async def _hedged(self, call: str, messages: List[dict], params: dict, deadline: float):
+        """Запрос и, если он задерживается, дублирующий запрос; возвращает первый успешный ответ"""
+
+        loop = asyncio.get_running_loop()
+        pending = {asyncio.ensure_future(self._attempt(call, messages, params, deadline))}
+        primary = next(iter(pending))
+        error = None
+
+        try:
+            hedge_delay = None
+            if self.hedge_percentile:
+                hedge_delay = self._tracker(call).percentile(self.hedge_percentile, LLM_HEDGE_MIN_SAMPLES)
+
+            if hedge_delay is not None and hedge_delay < deadline - loop.time():
+                done, _ = await asyncio.wait(pending, timeout=hedge_delay)
+                # Дублирующий запрос отправляется, только если есть свободное место: при перегрузке он бы ее усилил
+                if not done and not self._semaphore.locked():
+                    metrics.inc("llm_hedges", call=call)
+                    pending.add(asyncio.ensure_future(self._attempt(call, messages, params, deadline)))
+
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, timeout=max(deadline - loop.time(), 0), return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    raise asyncio.TimeoutError()
+
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            metrics.inc("llm_hedge_wins", call=call)
+                        return task.result()
+
+                    error = task.exception()
+
+            raise error
+
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _backoff(self, call: str, error: Exception, attempt: int, deadline: float):
+        """Ждет перед повтором или бросает LLMError, если повторять нельзя или не успеть до дедлайна"""
+
+        retry_after = _retry_after(error)
+        remaining = deadline - asyncio.get_running_loop().time()
+        delay = None
+        if retry_after is not None and attempt < self.max_retries:
+            delay = max(retry_after, random.uniform(0, self.retry_base_delay * 2 ** attempt))
+
+        if delay is None or delay >= remaining:
+            metrics.inc("llm_failures", call=call)
+            raise LLMError(f"LLM call {call} failed: {error!r}") from error
+
+        metrics.inc("llm_retries", call=call)
+        await asyncio.sleep(delay)
+
+    async def chat(self, call: str, messages: List[dict], timeout: Optional[float] = None, **params):
+        """
+        Выполняет chat completion не дольше timeout секунд (по умолчанию LLM_TIMEOUT).
+        call - имя вызова для метрик и статистики задержек.
+        """
+
+        deadline = asyncio.get_running_loop().time() + (timeout or self.timeout)
+        attempt = 0
+        while True:
+            try:
+                return await self._hedged(call, messages, params, deadline)
+
+            except Exception as e:
+                await self._backoff(call, e, attempt, deadline)
+                attempt += 1
+
+    async def stream(self, call: str, messages: List[dict], timeout: Optional[float] = None, **params) -> AsyncIterator:
+        """
+        Потоковый chat completion. Дедлайн и повторы действуют до первой части ответа,
+        дальше пауза между частями не должна превышать LLM_STREAM_IDLE_TIMEOUT.
+        """
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (timeout or self.timeout)
+        attempt = 0
+
+        while True:
+            async with self._slot(call, deadline):
+                stream = None
+                try:
+                    stream = await self._openai().chat.completions.create(
+                        model=self.model,
+                        messages=messages,
+                        stream=True,
+                        timeout=max(deadline - loop.time(), 0.001),
+                        **params
+                    )
+                    chunks = stream.__aiter__()
+                    first = await asyncio.wait_for(chunks.__anext__(), max(deadline - loop.time(), 0))
+
+                except StopAsyncIteration:
+                    await stream.close()
+                    return
+
+                except Exception as e:
+                    if stream is not None:
+                        await stream.close()
+                    error = e
+
+                else:
+                    try:
+                        yield first
+                        while True:
+                            try:
+                                chunk = await asyncio.wait_for(chunks.__anext__(), LLM_STREAM_IDLE_TIMEOUT)
+
+                            except StopAsyncIteration:
+                                break
+
+                            yield chunk
+
+                    finally:
+                        await stream.close()
+
+                    return
+
+            # Перед повтором место среди одновременных вызовов освобождается
+            await self._backoff(call, error, attempt, deadline)
+            attempt += 1
+
+def _base_url() -> str:
+    if not LLM_BASE_URL:
+        return HF_ROUTER_URL
+
+    base_url = LLM_BASE_URL.rstrip("/")
+    return base_url if base_url.endswith("/v1") else base_url + "/v1"
+
+llm_client = LLMClient(
+    _base_url(),
+    os.getenv("HF_TOKEN"),
+    LLM_MODEL if LLM_BASE_URL else f"{LLM_MODEL}:{LLM_PROVIDER}"
+)
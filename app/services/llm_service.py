@@ -1,50 +1,95 @@
-from typing import List
+from typing import AsyncIterator, List
 
 import os
-from huggingface_hub import InferenceClient
-from dotenv import load_dotenv
+import re
+import time
 
-load_dotenv()
+from app import metrics
+from app.services.llm_client import llm_client
 
-client = InferenceClient(
-    provider="novita",
-    api_key=os.environ["HF_TOKEN"],
-)
+# Дедлайн переформулировки вопроса: без нее поиск все равно работает, поэтому ждем меньше, чем ответа
+LLM_REWRITE_TIMEOUT = float(os.getenv("LLM_REWRITE_TIMEOUT", "10"))
 
-def generate_answer(question: str, context_chunks: List[str]) -> str:
+def _answer_messages(question: str, context_chunks: List[str]) -> List[dict]:
+    """Собирает промпт для ответа на вопрос по контексту"""
+
+    context = "\n".join(context_chunks)
+
+    return [
+        {"role": "system", 
+        "content": "Ты - полезный ассистент. Отвечай на вопросы ТОЛЬКО на основе предоставленного контекста. "
+        "Если ответа нет в контексте, скажи, что не можешь найти ответа на вопрос в документе."},
+        {"role": "user", "content": f"""Контекст: {context} 
+        Вопрос: {question} Ответ (только на основе контекста):"""
+        }
+    ]
+
+def _record_usage(completion, call: str):
+    """Записывает число токенов промпта и ответа, если провайдер их вернул"""
+
+    usage = getattr(completion, "usage", None)
+    if usage is None:
+        return
+
+    if usage.prompt_tokens is not None:
+        metrics.observe("llm_prompt_tokens", usage.prompt_tokens, call=call)
+    if usage.completion_tokens is not None:
+        metrics.observe("llm_completion_tokens", usage.completion_tokens, call=call)
+
+async def generate_answer(question: str, context_chunks: List[str]) -> str:
     """
     Генерирует ответ на вопрос, используя контекст из чанков.
-    Использует API Llama-3.1-8B-Instruct.
+    Использует API LLM_MODEL (по умолчанию Llama-3.1-8B-Instruct).
+    Если LLM не ответила за LLM_TIMEOUT с учетом повторов, бросает LLMError.
     """
 
-    context = "\n".join(context_chunks)
-    
-    completion = client.chat.completions.create(
-        model="meta-llama/Llama-3.1-8B-Instruct",
-        messages=[
-            {"role": "system", 
-            "content": "Ты - полезный ассистент. Отвечай на вопросы ТОЛЬКО на основе предоставленного контекста. "
-            "Если ответа нет в контексте, скажи, что не можешь найти ответа на вопрос в документе."},
-            {"role": "user", "content": f"""Контекст: {context} 
-            Вопрос: {question} Ответ (только на основе контекста):"""
-            }
-        ],
+    with metrics.timed("llm_generate"):
+        completion = await llm_client.chat(
+            "answer",
+            _answer_messages(question, context_chunks),
+            temperature=0.1,
+            max_tokens=200
+        )
+
+    _record_usage(completion, "answer")
+    answer = completion.choices[0].message.content
+
+    return answer
+
+async def stream_answer(question: str, context_chunks: List[str]) -> AsyncIterator[str]:
+    """
+    Генерирует ответ так же, как generate_answer, но отдает его по частям
+    по мере получения токенов от модели.
+    """
+
+    started = time.perf_counter()
+    stream = llm_client.stream(
+        "answer_stream",
+        _answer_messages(question, context_chunks),
         temperature=0.1,
         max_tokens=200
     )
 
-    answer = completion.choices[0].message.content
+    # В потоке провайдер не возвращает usage, поэтому считаем полученные части ответа
+    completion_tokens = 0
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            completion_tokens += 1
+            yield chunk.choices[0].delta.content
 
-    return answer
+    metrics.record_stage("llm_stream", time.perf_counter() - started)
+    metrics.observe("llm_completion_tokens", completion_tokens, call="answer_stream")
 
-def generate_query_variations(original_query: str, num_variations: int = 2) -> List[str]:
+async def generate_query_variations(original_query: str, num_variations: int = 2) -> List[str]:
     """
     Генерирует переформулировки запроса для улучшения поиска.
+    Возвращает не больше num_variations строк без исходного запроса.
     """
 
-    completion = client.chat.completions.create(
-        model="meta-llama/Llama-3.1-8B-Instruct",
-        messages=[
+    started = time.perf_counter()
+    completion = await llm_client.chat(
+        "query_rewrite",
+        [
             {"role": "system", 
              "content": "Ты помогаешь улучшить поиск по документам. "
                        "Перефразируй вопрос несколькими способами, сохраняя смысл. "
@@ -55,10 +100,20 @@ def generate_query_variations(original_query: str, num_variations: int = 2) -> L
              "content": f"Перефразируй этот вопрос {num_variations} разными способами:\n\n{original_query}"
             }
         ],
+        timeout=LLM_REWRITE_TIMEOUT,
         temperature=0.7,
         max_tokens=150
     )
+    metrics.record_stage("llm_query_rewrite", time.perf_counter() - started)
+    _record_usage(completion, "query_rewrite")
     
     response_text = completion.choices[0].message.content.strip()
-    
-    return original_query + '\n' + response_text
\ No newline at end of file
+
+    # Модель иногда нумерует строки или повторяет исходный вопрос
+    variations = []
+    for line in response_text.splitlines():
+        line = re.sub(r"^\s*(?:\d+[.)]|[-*•])\s*", "", line).strip()
+        if line and line != original_query and line not in variations:
+            variations.append(line)
+
+    return variations[:num_variations]
\ No newline at end of file
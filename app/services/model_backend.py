@@ -0,0 +1,126 @@
+from typing import TYPE_CHECKING, Callable
+import os
+import threading
+import time
+
+from app import metrics
+
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer, CrossEncoder
+
+EMBEDDING_MODEL_NAME = "sentence-transformers/paraphrase-multilingual-mpnet-base-v2"
+RERANKER_MODEL_NAME = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+
+# Бэкенд инференса на CPU: torch, torch-int8, onnx или onnx-int8
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "torch")
+# Куда один раз сохраняются сконвертированные модели
+MODEL_CACHE_DIR = os.getenv("MODEL_CACHE_DIR", ".model_cache")
+# Набор инструкций для int8-квантизации ONNX: arm64, avx2, avx512 или avx512_vnni
+ONNX_QUANTIZATION_CONFIG = os.getenv("ONNX_QUANTIZATION_CONFIG", "avx2")
+
+BACKENDS = ("torch", "torch-int8", "onnx", "onnx-int8")
+
+def _cache_path(model_name: str, backend: str) -> str:
+    return os.path.join(MODEL_CACHE_DIR, backend, model_name.replace("/", "__"))
+
+def _quantized_file_name() -> str:
+    return f"onnx/model_qint8_{ONNX_QUANTIZATION_CONFIG}.onnx"
+
+def _quantize_torch(module):
+    """Динамическая int8-квантизация линейных слоев PyTorch-модели"""
+
+    import torch
+
+    return torch.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8)
+
+def _load(model_cls, model_name: str, backend: str):
+    """
+    Загружает модель с нужным бэкендом.
+    ONNX-версии экспортируются при первой загрузке и дальше читаются из MODEL_CACHE_DIR.
+    """
+
+    if backend not in BACKENDS:
+        raise ValueError(f"Unsupported INFERENCE_BACKEND: {backend}")
+
+    if backend == "torch":
+        return model_cls(model_name)
+
+    if backend == "torch-int8":
+        from sentence_transformers import CrossEncoder
+
+        model = model_cls(model_name)
+        if isinstance(model, CrossEncoder):
+            model.model = _quantize_torch(model.model)
+            return model
+
+        return _quantize_torch(model)
+
+    onnx_path = _cache_path(model_name, "onnx")
+    if not os.path.isdir(onnx_path):
+        model_cls(model_name, backend="onnx").save(onnx_path)
+
+    if backend == "onnx":
+        return model_cls(onnx_path, backend="onnx")
+
+    from sentence_transformers import export_dynamic_quantized_onnx_model
+
+    int8_path = _cache_path(model_name, "onnx-int8")
+    file_name = _quantized_file_name()
+    if not os.path.isfile(os.path.join(int8_path, file_name)):
+        model = model_cls(onnx_path, backend="onnx")
+        model.save(int8_path)
+        export_dynamic_quantized_onnx_model(model, ONNX_QUANTIZATION_CONFIG, int8_path)
+
+    return model_cls(int8_path, backend="onnx", model_kwargs={"file_name": file_name})
+
+def model_cache_key(model_name: str, backend: str = None) -> str:
+    """Ключ модели для кеша эмбеддингов: результаты разных бэкендов немного отличаются"""
+
+    backend = backend or INFERENCE_BACKEND
+    if backend == "onnx-int8":
+        backend = f"{backend}-{ONNX_QUANTIZATION_CONFIG}"
+
+    return f"{model_name}:{backend}"
+
+def load_embedding_model(model_name: str, backend: str = None) -> "SentenceTransformer":
+    """Загружает SentenceTransformer с выбранным бэкендом"""
+
+    from sentence_transformers import SentenceTransformer
+
+    return _load(SentenceTransformer, model_name, backend or INFERENCE_BACKEND)
+
+def load_reranker(model_name: str, backend: str = None) -> "CrossEncoder":
+    """Загружает CrossEncoder с выбранным бэкендом"""
+
+    from sentence_transformers import CrossEncoder
+
+    return _load(CrossEncoder, model_name, backend or INFERENCE_BACKEND)
+
+class LazyModel:
+    """
+    Модель, которая загружается при первом обращении, а не при импорте.
+    Одновременные первые обращения из разных потоков ждут одну и ту же загрузку.
+    """
+
+    def __init__(self, model_name: str, loader: Callable):
+        self.model_name = model_name
+        self._loader = loader
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._model is not None
+
+    def get(self):
+        model = self._model
+        if model is not None:
+            return model
+
+        with self._lock:
+            if self._model is None:
+                started = time.perf_counter()
+                self._model = self._loader(self.model_name)
+                metrics.observe("model_load_seconds", time.perf_counter() - started, model=self.model_name)
+
+            return self._model
@@ -1,90 +1,701 @@
-from typing import List
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Iterable, List, Optional
+import asyncio
+import hashlib
+import os
+import queue
+import threading
+import time
 import numpy as np
-from sentence_transformers import SentenceTransformer, CrossEncoder
+from pgvector.sqlalchemy import Vector
+from sqlalchemy import cast, func, literal, select, text, union_all
+from sqlalchemy.exc import IntegrityError
 
-from app.database import SessionLocal, Document, Embedding, get_user_settings
+from app import metrics
+from app.database import (
+    SessionLocal, RequestContext, Document, Embedding, vector_search_settings, bulk_insert_embeddings,
+    fetch_cached_embeddings, store_cached_embeddings, binary_query_signature,
+    VECTOR_STORAGE, BINARY_RESCORE_FACTOR, EMBEDDING_DIM
+)
+from app.services.context_service import count_tokens
+from app.services.hot_index import hot_index, UserMatrix, HOT_INDEX_ENABLED, HOT_INDEX_DTYPE
+from app.services.model_backend import (
+    EMBEDDING_MODEL_NAME, RERANKER_MODEL_NAME, LazyModel, load_embedding_model, load_reranker, model_cache_key
+)
 
-model = SentenceTransformer("sentence-transformers/paraphrase-multilingual-mpnet-base-v2")
-reranker = CrossEncoder('cross-encoder/ms-marco-MiniLM-L-6-v2')
+# Модели загружаются при первом запросе или при прогреве (warm_up), а не при импорте
+embedding_model = LazyModel(EMBEDDING_MODEL_NAME, load_embedding_model)
+reranker_model = LazyModel(RERANKER_MODEL_NAME, load_reranker)
+
+# Объединение одновременных запросов к моделям в общий батч
+INFERENCE_BATCHING = os.getenv("INFERENCE_BATCHING", "true").lower() == "true"
+INFERENCE_MAX_WAIT_MS = float(os.getenv("INFERENCE_MAX_WAIT_MS", "5"))
+ENCODE_MAX_BATCH_SIZE = int(os.getenv("ENCODE_MAX_BATCH_SIZE", "32"))
+RERANK_MAX_BATCH_SIZE = int(os.getenv("RERANK_MAX_BATCH_SIZE", "128"))
+# Потоки для инференса запросов, когда батчинг выключен
+INFERENCE_THREADS = int(os.getenv("INFERENCE_THREADS", "2"))
+
+# Кеш эмбеддингов чанков по sha256 текста: повторные и общие документы не кодируются заново
+EMBEDDING_CACHE_ENABLED = os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() == "true"
+EMBEDDING_CACHE_KEY = model_cache_key(EMBEDDING_MODEL_NAME)
+
+# Константа k в reciprocal rank fusion результатов поиска по переформулировкам вопроса
+RRF_K = int(os.getenv("RRF_K", "60"))
+
+_inference_executor = ThreadPoolExecutor(max_workers=INFERENCE_THREADS, thread_name_prefix="inference")
+
+class BatchScheduler:
+    """
+    Собирает конкурентные вызовы модели в один батч.
+    Батч отправляется, когда набрано max_batch_size элементов или первый запрос
+    в нем прождал max_wait_ms. Каждый вызывающий получает свой срез результата.
+    """
+
+    def __init__(self, name: str, fn: Callable[[list], np.ndarray], max_batch_size: int, max_wait_ms: float):
+        self.name = name
+        self.fn = fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._loop, name=f"batch-{name}", daemon=True)
+        self._thread.start()
+
+    def submit(self, items: list) -> Future:
+        future = Future()
+        self._queue.put((items, future, time.perf_counter()))
+        return future
+
+    def __call__(self, items: list) -> np.ndarray:
+        return self.submit(items).result()
+
+    def _collect(self) -> list:
+        """Ждет первый запрос и добирает к нему остальные до лимита размера или времени"""
+
+        first = self._queue.get()
+        batch = [first]
+        size = len(first[0])
+        deadline = first[2] + self.max_wait
+
+        while size < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+
+            try:
+                request = self._queue.get(timeout=timeout)
+
+            except queue.Empty:
+                break
+
+            batch.append(request)
+            size += len(request[0])
+
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            started = time.perf_counter()
+            inputs = [item for items, _, _ in batch for item in items]
+
+            metrics.observe(f"{self.name}_batch_size", len(inputs))
+            metrics.observe(f"{self.name}_batch_requests", len(batch))
+            for _, _, enqueued in batch:
+                metrics.observe(f"{self.name}_queue_wait_seconds", started - enqueued)
+
+            try:
+                outputs = self.fn(inputs)
+
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+
+            metrics.observe(f"{self.name}_inference_seconds", time.perf_counter() - started)
+
+            offset = 0
+            for items, future, _ in batch:
+                future.set_result(outputs[offset:offset + len(items)])
+                offset += len(items)
+
+def _encode(texts: List[str]) -> np.ndarray:
+    return embedding_model.get().encode(texts, convert_to_numpy=True, normalize_embeddings=True)
+
+def _predict(pairs: List[List[str]]) -> np.ndarray:
+    return reranker_model.get().predict(pairs)
+
+if INFERENCE_BATCHING:
+    _encode_scheduler = BatchScheduler("encode", _encode, ENCODE_MAX_BATCH_SIZE, INFERENCE_MAX_WAIT_MS)
+    _rerank_scheduler = BatchScheduler("rerank", _predict, RERANK_MAX_BATCH_SIZE, INFERENCE_MAX_WAIT_MS)
+
+else:
+    _encode_scheduler = _rerank_scheduler = None
+
+async def _run_inference(scheduler: Optional[BatchScheduler], fn: Callable, items: list) -> np.ndarray:
+    """Выполняет инференс вне event loop: через планировщик батчей или в отдельном пуле потоков"""
+
+    if scheduler is not None:
+        return await asyncio.wrap_future(scheduler.submit(items))
+
+    return await asyncio.get_running_loop().run_in_executor(_inference_executor, fn, items)
+
+async def encode_queries(texts: List[str]) -> np.ndarray:
+    """Считает нормализованные эмбеддинги запросов"""
+
+    with metrics.timed("encode_query"):
+        return await _run_inference(_encode_scheduler, _encode, texts)
+
+async def predict_scores(pairs: List[List[str]]) -> np.ndarray:
+    """Считает оценки CrossEncoder для пар (вопрос, чанк)"""
+
+    return await _run_inference(_rerank_scheduler, _predict, pairs)
+
+def warm_up():
+    """
+    Загружает модели и прогоняет через них пробные батчи разного размера,
+    чтобы первые запросы не ждали загрузки весов и компиляции графа.
+    """
+
+    with metrics.timed("warm_up"):
+        for size in sorted({1, min(8, ENCODE_MAX_BATCH_SIZE), ENCODE_MAX_BATCH_SIZE}):
+            _encode(["Прогрев модели эмбеддингов"] * size)
+
+        for size in sorted({1, min(16, RERANK_MAX_BATCH_SIZE)}):
+            _predict([["Прогрев", "Прогрев модели переранжирования"]] * size)
+
+        # Токенайзер сборки контекста загружается заранее, а не на первом /ask
+        count_tokens(["Прогрев токенайзера контекста"])
+
+def chunk_tokenizer():
+    """Токенайзер модели эмбеддингов и максимальная длина чанка в токенах (без служебных токенов)"""
+
+    model = embedding_model.get()
+    return model.tokenizer, model.max_seq_length - 2
+
+def _text_hash(chunk: str) -> str:
+    return hashlib.sha256(chunk.encode("utf-8")).hexdigest()
 
 def compute_embeddings(chunks: List[str]) -> np.ndarray:
-    """Преобразует список чанков в векторы"""
+    """
+    Преобразует список чанков в векторы.
+    Уже известные тексты берутся из кеша эмбеддингов, кодируются только промахи.
+    """
 
-    embeddings = model.encode(chunks, convert_to_numpy=True, normalize_embeddings=True)
-    return embeddings
+    if not EMBEDDING_CACHE_ENABLED:
+        with metrics.timed("embed_chunks"):
+            return embedding_model.get().encode(chunks, convert_to_numpy=True, normalize_embeddings=True)
 
-def add_document_to_db(user_id: int, filename: str, content: str, chunks: List[str], embeddings: np.ndarray):
-    """Сохраняет документ и embeddings в БД"""
+    if not chunks:
+        return np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+
+    hashes = [_text_hash(chunk) for chunk in chunks]
+    unique = list(dict.fromkeys(hashes))
 
     db = SessionLocal()
+    try:
+        vectors = fetch_cached_embeddings(db, EMBEDDING_CACHE_KEY, unique)
+        misses = [h for h in unique if h not in vectors]
+        texts = {h: chunk for h, chunk in zip(hashes, chunks)}
+
+        if misses:
+            started = time.perf_counter()
+            encoded = embedding_model.get().encode([texts[h] for h in misses], convert_to_numpy=True, normalize_embeddings=True)
+            elapsed = time.perf_counter() - started
+            metrics.record_stage("embed_chunks", elapsed)
+            metrics.observe("embedding_encode_seconds_per_chunk", elapsed / len(misses))
+
+            vectors.update(zip(misses, encoded))
+            store_cached_embeddings(db, EMBEDDING_CACHE_KEY, misses, encoded)
+
+        db.commit()
+
+    except Exception:
+        db.rollback()
+        raise
+
+    finally:
+        db.close()
+
+    hits = len(unique) - len(misses)
+    metrics.inc("embedding_cache_hits", hits)
+    metrics.inc("embedding_cache_misses", len(misses))
+    encode_time = metrics.get_summary("embedding_encode_seconds_per_chunk")
+    if hits and encode_time:
+        metrics.inc("embedding_cache_encoder_seconds_saved", hits * encode_time["avg"])
+
+    return np.vstack([np.asarray(vectors[h], dtype=np.float32) for h in hashes])
+
+# Сколько символов текста документа накапливается в памяти перед дописыванием в documents.content
+DOCUMENT_CONTENT_FLUSH_CHARS = 1 << 20
+
+class _ContentAppender:
+    """
+    Дописывает текст документа в documents.content порциями в транзакции сессии,
+    поэтому текст целиком в памяти не держится. Части соединяются через перевод строки.
+    """
+
+    def __init__(self, db, document_id: int, user_id: int):
+        self.db = db
+        self.document_id = document_id
+        self.user_id = user_id
+        self._parts: List[str] = []
+        self._chars = 0
+        self._written = False
+
+    def add(self, part: str):
+        self._parts.append(part)
+        self._chars += len(part)
+        if self._chars >= DOCUMENT_CONTENT_FLUSH_CHARS:
+            self.flush()
+
+    def flush(self):
+        if not self._parts:
+            return
+
+        part = "\n".join(self._parts)
+        self.db.execute(
+            text("UPDATE documents SET content = content || :part WHERE id = :id AND user_id = :user_id"),
+            {"part": "\n" + part if self._written else part, "id": self.document_id, "user_id": self.user_id}
+        )
+        self._parts, self._chars = [], 0
+        self._written = True
+
+class DocumentWriter:
+    """
+    Записывает документ и его чанки порциями в одной транзакции:
+    begin() -> write() для каждого батча и add_content() для каждой части текста -> commit().
+    Текст документа дописывается в БД порциями через _ContentAppender.
+    Если документ с таким content_hash у пользователя уже есть, begin() возвращает его id.
+    """
+
+    def __init__(
+        self, user_id: int, filename: str, content_hash: Optional[str] = None, chunking_mode: Optional[str] = None
+    ):
+        self.user_id = user_id
+        self.filename = filename
+        self.content_hash = content_hash
+        self.chunking_mode = chunking_mode
+        self.num_chunks = 0
+        self.db = SessionLocal()
+        self.doc = None
+        self._content = None
+
+    def _existing_id(self) -> Optional[int]:
+        if not self.content_hash:
+            return None
+
+        existing = self.db.query(Document.id).filter_by(user_id=self.user_id, content_hash=self.content_hash).first()
+        return existing.id if existing else None
+
+    def begin(self) -> Optional[int]:
+        existing_id = self._existing_id()
+        if existing_id:
+            return existing_id
+
+        self.doc = Document(
+            user_id=self.user_id,
+            filename=self.filename,
+            content="",
+            content_hash=self.content_hash,
+            chunking_mode=self.chunking_mode
+        )
+        self.db.add(self.doc)
+
+        try:
+            self.db.flush()
+
+        except IntegrityError:
+            # Тот же документ параллельно сохранила другая задача
+            self.db.rollback()
+            existing_id = self._existing_id()
+            if existing_id is None:
+                raise
+            return existing_id
+
+        self._content = _ContentAppender(self.db, self.doc.id, self.user_id)
+        return None
+
+    def write(self, chunks: List[str], embeddings: np.ndarray):
+        with metrics.timed("insert_chunks"):
+            bulk_insert_embeddings(
+                self.db, self.doc.id, self.user_id, self.filename, chunks, embeddings, start_index=self.num_chunks
+            )
+        self.num_chunks += len(chunks)
+
+    def add_content(self, part: str):
+        """Добавляет часть текста документа; части соединяются через перевод строки"""
+
+        self._content.add(part)
+
+    def commit(self) -> int:
+        self._content.flush()
+        with metrics.timed("insert_commit"):
+            self.db.commit()
+        hot_index.invalidate(self.user_id)
+        return self.doc.id
+
+    def close(self):
+        self.db.rollback()
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def add_document_to_db(
+    user_id: int,
+    filename: str,
+    content: str,
+    chunks: List[str],
+    embeddings: np.ndarray,
+    content_hash: Optional[str] = None
+):
+    """
+    Сохраняет документ и embeddings в БД одной транзакцией.
+    Если документ с таким content_hash у пользователя уже есть, возвращает его id.
+    """
+
+    with DocumentWriter(user_id, filename, content_hash) as writer:
+        existing_id = writer.begin()
+        if existing_id:
+            return existing_id
 
+        writer.add_content(content)
+        writer.write(chunks, embeddings)
+        return writer.commit()
+
+class DocumentNotFoundError(Exception):
+    """Документ не найден у пользователя"""
+
+def reindex_document(
+    user_id: int,
+    document_id: int,
+    filename: str,
+    parts: Iterable[str],
+    chunker: Callable[[Iterable[str], Optional[str]], Iterable[str]],
+    content_hash: Optional[str] = None,
+    batch_size: int = 64
+) -> dict:
+    """
+    Заменяет содержимое документа одной транзакцией, пересчитывая только изменившиеся чанки.
+    Части текста идут потоком: дописываются в documents.content и передаются в
+    chunker(parts, chunking_mode) вместе с режимом, которым документ был разбит при загрузке.
+    Новые чанки сопоставляются с сохраненными по sha256 текста: совпавшие строки
+    остаются (меняется только номер чанка), новые кодируются батчами по batch_size
+    и вставляются, лишние удаляются.
+    """
+
+    db = SessionLocal()
     try:
-        doc = Document(
-            user_id=user_id,
-            filename=filename,
-            content=content
+        doc = db.query(Document).filter_by(id=document_id, user_id=user_id).with_for_update().first()
+        if doc is None:
+            raise DocumentNotFoundError(f"Document {document_id} not found")
+
+        if content_hash and content_hash != doc.content_hash:
+            duplicate = db.query(Document.id).filter(
+                Document.user_id == user_id, Document.content_hash == content_hash, Document.id != document_id
+            ).first()
+            if duplicate:
+                raise ValueError(f"Document with the same content already exists: {duplicate.id}")
+
+        # Для строк, записанных до появления chunk_hash, хеш считается в БД
+        stored_hash = func.coalesce(
+            Embedding.chunk_hash, func.encode(func.sha256(func.convert_to(Embedding.chunk_text, "UTF8")), "hex")
         )
+        stored = db.execute(
+            select(Embedding.id, Embedding.chunk_index, stored_hash.label("chunk_hash"))
+            .filter(Embedding.user_id == user_id, Embedding.document_id == document_id)
+        ).all()
 
-        db.add(doc)
-        db.commit()
-        db.refresh(doc)
-        
-        for idx, (chunk, emb) in enumerate(zip(chunks, embeddings)):
-            embedding = Embedding(
-                document_id=doc.id,
-                user_id=user_id,
-                chunk_text=chunk,
-                embedding=emb.tolist(),
-                chunk_index=idx,
-                document_name=filename
+        ids_by_hash = {}
+        for row in stored:
+            ids_by_hash.setdefault(row.chunk_hash, []).append(row)
+
+        if filename != doc.filename:
+            db.execute(
+                text("UPDATE embeddings SET document_name = :name WHERE user_id = :user_id AND document_id = :doc"),
+                {"name": filename, "user_id": user_id, "doc": document_id}
             )
 
-            db.add(embedding)
-        
+        db.execute(
+            text("UPDATE documents SET content = '' WHERE id = :id AND user_id = :user_id"),
+            {"id": document_id, "user_id": user_id}
+        )
+        content = _ContentAppender(db, document_id, user_id)
+
+        def tracked_parts():
+            for part in parts:
+                content.add(part)
+                yield part
+
+        def insert_new():
+            bulk_insert_embeddings(
+                db, document_id, user_id, filename, new_chunks, compute_embeddings(new_chunks),
+                chunk_indexes=new_indexes
+            )
+            new_chunks.clear()
+            new_indexes.clear()
+
+        kept_ids, kept_indexes = [], []
+        new_chunks, new_indexes = [], []
+        num_chunks = chunks_added = 0
+        for chunk_index, chunk in enumerate(chunker(tracked_parts(), doc.chunking_mode)):
+            num_chunks += 1
+            same = ids_by_hash.get(_text_hash(chunk))
+            if same:
+                row = same.pop()
+                if row.chunk_index != chunk_index:
+                    kept_ids.append(row.id)
+                    kept_indexes.append(chunk_index)
+
+            else:
+                new_chunks.append(chunk)
+                new_indexes.append(chunk_index)
+                chunks_added += 1
+                if len(new_chunks) == batch_size:
+                    insert_new()
+
+        if not num_chunks:
+            raise ValueError(f"Document is empty: {filename}")
+
+        if new_chunks:
+            insert_new()
+
+        removed_ids = [row.id for rows in ids_by_hash.values() for row in rows]
+
+        if removed_ids:
+            db.execute(
+                text("DELETE FROM embeddings WHERE user_id = :user_id AND id = ANY(:ids)"),
+                {"user_id": user_id, "ids": removed_ids}
+            )
+
+        if kept_ids:
+            db.execute(text("""
+                UPDATE embeddings SET chunk_index = v.chunk_index
+                FROM unnest(CAST(:ids AS integer[]), CAST(:indexes AS integer[])) AS v(id, chunk_index)
+                WHERE embeddings.user_id = :user_id AND embeddings.id = v.id
+            """), {"user_id": user_id, "ids": kept_ids, "indexes": kept_indexes})
+
+        content.flush()
+        doc.filename = filename
+        doc.content_hash = content_hash
+        doc.uploaded_at = datetime.now()
         db.commit()
-        return doc.id
-    
+
     finally:
+        db.rollback()
         db.close()
 
-def search(request) -> List[dict]:
-    """Находит похожие чанки для пользователя"""
+    hot_index.invalidate(user_id)
 
-    db = SessionLocal()
-    try:
-        settings = get_user_settings(request.user_id)
-        top_k = settings.get("retrieval_top_k", 15) if settings else 15
-        
-        query_embedding = model.encode([request.question], convert_to_numpy=True, normalize_embeddings=True)[0]
-        
-        results = db.query(
-            Embedding.chunk_text,
-            Embedding.document_name,
-            Embedding.embedding.cosine_distance(query_embedding).label('distance')
-        ).filter(Embedding.user_id == request.user_id).order_by('distance').limit(top_k).all()
-        
-        if not results:
-            raise ValueError("No documents indexed yet")
-        
-        return [
+    return {
+        "document_id": document_id,
+        "filename": filename,
+        "num_chunks": num_chunks,
+        "chunks_added": chunks_added,
+        "chunks_removed": len(removed_ids),
+        "chunks_kept": num_chunks - chunks_added,
+    }
+
+def _build_user_matrix(rows) -> UserMatrix:
+    return UserMatrix(
+        ids=np.array([r.id for r in rows], dtype=np.int64),
+        matrix=np.ascontiguousarray(
+            np.stack([r.vector for r in rows]) if rows else np.empty((0, EMBEDDING_DIM)),
+            dtype=HOT_INDEX_DTYPE
+        )
+    )
+
+async def _load_user_matrix(ctx: RequestContext) -> Optional[UserMatrix]:
+    """Читает все эмбеддинги пользователя в матрицу для hot_index"""
+
+    generation = hot_index.generation(ctx.user_id)
+
+    if VECTOR_STORAGE == "full":
+        column = Embedding.embedding
+    else:
+        column = cast(Embedding.embedding_half, Vector(EMBEDDING_DIM))
+
+    rows = (await ctx.db.execute(
+        select(Embedding.id, column.label("vector"))
+        .filter(Embedding.user_id == ctx.user_id, column.isnot(None))
+        .order_by(Embedding.id)
+        .limit(hot_index.max_chunks + 1)
+    )).all()
+
+    if len(rows) > hot_index.max_chunks:
+        hot_index.store(ctx.user_id, None, generation)
+        return None
+
+    entry = await asyncio.get_running_loop().run_in_executor(_inference_executor, _build_user_matrix, rows)
+    hot_index.store(ctx.user_id, entry, generation)
+    return entry
+
+async def _hot_search(ctx: RequestContext, query_embeddings: np.ndarray, top_k: int) -> Optional[List[List[dict]]]:
+    """Поиск по матрице пользователя в памяти; None, если пользователя нет в hot_index"""
+
+    entry = hot_index.lookup(ctx.user_id)
+    if entry is None:
+        if not hot_index.should_load(ctx.user_id):
+            return None
+
+        with metrics.timed("hot_index_load"):
+            entry = await _load_user_matrix(ctx)
+        if entry is None:
+            return None
+
+    if not len(entry.ids):
+        return [[] for _ in query_embeddings]
+
+    # Умножение на матрицу пользователя выполняется вне event loop
+    with metrics.timed("hot_index_search"):
+        hits = await asyncio.get_running_loop().run_in_executor(
+            _inference_executor, entry.top_k, query_embeddings, top_k
+        )
+
+    # Из БД читаются только тексты победивших чанков, для всех запросов сразу
+    ids = {i for found_ids, _ in hits for i in found_ids.tolist()}
+    rows = (await ctx.db.execute(
+        select(Embedding.id, Embedding.document_id, Embedding.chunk_index, Embedding.chunk_text, Embedding.document_name)
+        .filter(Embedding.user_id == ctx.user_id, Embedding.id.in_(ids))
+    )).all()
+    by_id = {r.id: r for r in rows}
+
+    return [
+        [
             {
-                "text": r.chunk_text,
-                "document": r.document_name,
-                "score": 1 - r.distance
+                "id": i,
+                "document_id": by_id[i].document_id,
+                "chunk_index": by_id[i].chunk_index,
+                "text": by_id[i].chunk_text,
+                "document": by_id[i].document_name,
+                "score": float(score)
             }
-            for r in results
+            for i, score in zip(found_ids.tolist(), scores) if i in by_id
         ]
-    finally:
-        db.close()
+        for found_ids, scores in hits
+    ]
+
+def _nearest_chunks_query(ctx: RequestContext, query_embedding: np.ndarray, top_k: int):
+    """SELECT ближайших к вектору чанков пользователя с учетом VECTOR_STORAGE"""
+
+    if VECTOR_STORAGE == "binary":
+        # Кандидаты отбираются по расстоянию Хэмминга между битовыми сигнатурами
+        # (по индексу), затем пересчитываются по halfvec и обрезаются до top_k
+        candidates = select(
+            Embedding.id,
+            Embedding.document_id,
+            Embedding.chunk_index,
+            Embedding.chunk_text,
+            Embedding.document_name,
+            Embedding.embedding_half
+        ).filter(Embedding.user_id == ctx.user_id).order_by(
+            Embedding.embedding_bits.hamming_distance(binary_query_signature(query_embedding))
+        ).limit(top_k * BINARY_RESCORE_FACTOR).subquery()
+
+        return select(
+            candidates.c.id,
+            candidates.c.document_id,
+            candidates.c.chunk_index,
+            candidates.c.chunk_text,
+            candidates.c.document_name,
+            candidates.c.embedding_half.cosine_distance(query_embedding).label('distance')
+        ).order_by('distance').limit(top_k)
+
+    column = Embedding.embedding_half if VECTOR_STORAGE == "half" else Embedding.embedding
+    return select(
+        Embedding.id,
+        Embedding.document_id,
+        Embedding.chunk_index,
+        Embedding.chunk_text,
+        Embedding.document_name,
+        column.cosine_distance(query_embedding).label('distance')
+    ).filter(Embedding.user_id == ctx.user_id).order_by('distance').limit(top_k)
+
+async def _database_search(ctx: RequestContext, query_embeddings: np.ndarray, top_k: int) -> List[List[dict]]:
+    """Поиск ближайших чанков в Postgres по ANN-индексу: все запросы одним UNION ALL"""
+
+    candidates_limit = top_k * BINARY_RESCORE_FACTOR if VECTOR_STORAGE == "binary" else top_k
+    for statement in vector_search_settings(candidates_limit):
+        await ctx.db.execute(text(statement))
+
+    queries = [_nearest_chunks_query(ctx, query_embedding, top_k).subquery() for query_embedding in query_embeddings]
+    statement = union_all(*[
+        select(literal(n).label("query_index"), *query.c) for n, query in enumerate(queries)
+    ]) if len(queries) > 1 else select(literal(0).label("query_index"), *queries[0].c)
+
+    with metrics.timed("vector_search"):
+        rows = (await ctx.db.execute(statement)).all()
+
+    metrics.observe("vector_search_queries", len(query_embeddings))
+    results = [[] for _ in query_embeddings]
+    for r in rows:
+        results[r.query_index].append({
+            "id": r.id,
+            "document_id": r.document_id,
+            "chunk_index": r.chunk_index,
+            "text": r.chunk_text,
+            "document": r.document_name,
+            "score": 1 - r.distance
+        })
+
+    # Порядок строк внутри UNION ALL не гарантирован
+    for found in results:
+        found.sort(key=lambda chunk: chunk["score"], reverse=True)
+
+    return results
+
+async def search_many(ctx: RequestContext, query_embeddings: np.ndarray) -> List[List[dict]]:
+    """Находит похожие чанки пользователя для нескольких векторов запроса сразу"""
+
+    top_k = ctx.settings["retrieval_top_k"]
+
+    results = await _hot_search(ctx, query_embeddings, top_k) if HOT_INDEX_ENABLED else None
+    if results is None:
+        results = await _database_search(ctx, query_embeddings, top_k)
+
+    return results
+
+async def search(ctx: RequestContext, question: str, query_embedding: Optional[np.ndarray] = None) -> List[dict]:
+    """Находит похожие чанки для пользователя"""
+
+    if query_embedding is None:
+        query_embedding = (await encode_queries([question]))[0]
+
+    results = (await search_many(ctx, np.asarray([query_embedding])))[0]
+        
+    if not results:
+        raise ValueError("No documents indexed yet")
+    
+    return results
+
+def fuse_rankings(rankings: List[List[dict]], top_k: int, k: int = RRF_K) -> List[dict]:
+    """
+    Объединяет результаты поиска по нескольким формулировкам вопроса методом
+    reciprocal rank fusion: чанк получает сумму 1 / (k + позиция) по всем спискам.
+    Дубликаты схлопываются, возвращается top_k чанков с наибольшей суммой.
+    """
+
+    fused = {}
+    for ranking in rankings:
+        for rank, chunk in enumerate(ranking):
+            entry = fused.setdefault(chunk["id"], {**chunk, "rrf_score": 0.0})
+            entry["rrf_score"] += 1 / (k + rank + 1)
+            entry["score"] = max(entry["score"], chunk["score"])
+
+    return sorted(fused.values(), key=lambda chunk: chunk["rrf_score"], reverse=True)[:top_k]
 
-def rerank(request, chunks: List[dict]) -> List[dict]:
+async def rerank(ctx: RequestContext, question: str, chunks: List[dict]) -> List[dict]:
     """Находит из предложенных чанков top_k похожих на вопрос"""
     
-    settings = get_user_settings(request.user_id)
-    top_k = settings.get("rerank_top_k", 5) if settings else 5
+    top_k = ctx.settings["rerank_top_k"]
     
-    pairs = [[request.question, chunk["text"]] for chunk in chunks]
-    scores = reranker.predict(pairs)
+    pairs = [[question, chunk["text"]] for chunk in chunks]
+    with metrics.timed("rerank"):
+        scores = await predict_scores(pairs)
     ranked_indices = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)
     
     return [chunks[i] for i in ranked_indices[:top_k]]
\ No newline at end of file
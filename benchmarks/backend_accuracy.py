@@ -0,0 +1,102 @@
+"""
+Проверка точности бэкенда инференса относительно PyTorch (float32).
+
+Сравнивает эмбеддинги (косинусная близость к эталону) и порядок rerank
+(совпадение top-k и лучшего фрагмента), а также время инференса.
+
+Запуск:
+    python -m benchmarks.backend_accuracy --backend onnx-int8
+    python -m benchmarks.backend_accuracy --backend onnx --texts my_chunks.txt
+
+Код возврата 1, если точность ниже порогов --min-cosine / --min-overlap.
+"""
+
+import argparse
+import sys
+import time
+
+import numpy as np
+
+from app.services.model_backend import (
+    BACKENDS, EMBEDDING_MODEL_NAME, RERANKER_MODEL_NAME, load_embedding_model, load_reranker
+)
+
+SAMPLE_TEXTS = [
+    "Случайная величина называется непрерывной, если ее функция распределения непрерывна.",
+    "Математическое ожидание суммы случайных величин равно сумме их математических ожиданий.",
+    "Дисперсия характеризует разброс значений случайной величины относительно среднего.",
+    "Закон больших чисел утверждает сходимость выборочного среднего к математическому ожиданию.",
+    "Центральная предельная теорема описывает распределение суммы независимых величин.",
+    "Банахово пространство - это полное нормированное линейное пространство.",
+    "Гильбертово пространство является банаховым пространством со скалярным произведением.",
+    "Линейный оператор ограничен тогда и только тогда, когда он непрерывен.",
+    "Теорема Хана-Банаха позволяет продолжать линейные функционалы с сохранением нормы.",
+    "A compact operator maps bounded sets to relatively compact sets.",
+    "Retrieval-augmented generation combines document search with a language model.",
+    "Для загрузки документа отправьте файл боту в формате .txt, .pdf или .docx.",
+]
+
+SAMPLE_QUESTIONS = [
+    "Что такое дисперсия?",
+    "Какое пространство называется банаховым?",
+    "Когда линейный оператор непрерывен?",
+    "What is retrieval-augmented generation?",
+]
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", choices=[b for b in BACKENDS if b != "torch"], required=True)
+    parser.add_argument("--texts", help="Файл с фрагментами, по одному на строку")
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--min-cosine", type=float, default=0.98)
+    parser.add_argument("--min-overlap", type=float, default=0.8)
+    args = parser.parse_args()
+
+    texts = SAMPLE_TEXTS
+    if args.texts:
+        with open(args.texts, encoding="utf-8") as f:
+            texts = [line.strip() for line in f if line.strip()]
+
+    encode = lambda m, t: m.encode(t, convert_to_numpy=True, normalize_embeddings=True)
+
+    baseline_model = load_embedding_model(EMBEDDING_MODEL_NAME, "torch")
+    candidate_model = load_embedding_model(EMBEDDING_MODEL_NAME, args.backend)
+    baseline_emb, baseline_time = timed(encode, baseline_model, texts)
+    candidate_emb, candidate_time = timed(encode, candidate_model, texts)
+
+    cosine = np.sum(baseline_emb * candidate_emb, axis=1)
+    print(f"Embeddings: cosine mean={cosine.mean():.4f} min={cosine.min():.4f}")
+    print(f"Embeddings time: torch={baseline_time:.3f}s {args.backend}={candidate_time:.3f}s")
+
+    baseline_reranker = load_reranker(RERANKER_MODEL_NAME, "torch")
+    candidate_reranker = load_reranker(RERANKER_MODEL_NAME, args.backend)
+
+    overlaps, top1, baseline_rerank_time, candidate_rerank_time = [], [], 0.0, 0.0
+    for question in SAMPLE_QUESTIONS:
+        pairs = [[question, t] for t in texts]
+        baseline_scores, elapsed = timed(baseline_reranker.predict, pairs)
+        baseline_rerank_time += elapsed
+        candidate_scores, elapsed = timed(candidate_reranker.predict, pairs)
+        candidate_rerank_time += elapsed
+
+        baseline_order = np.argsort(-np.asarray(baseline_scores))[:args.top_k]
+        candidate_order = np.argsort(-np.asarray(candidate_scores))[:args.top_k]
+        overlaps.append(len(set(baseline_order) & set(candidate_order)) / args.top_k)
+        top1.append(baseline_order[0] == candidate_order[0])
+
+    print(f"Rerank: top-{args.top_k} overlap={np.mean(overlaps):.3f} top-1 agreement={np.mean(top1):.3f}")
+    print(f"Rerank time: torch={baseline_rerank_time:.3f}s {args.backend}={candidate_rerank_time:.3f}s")
+
+    if cosine.min() < args.min_cosine or np.mean(overlaps) < args.min_overlap:
+        print("FAILED: точность ниже порогов")
+        sys.exit(1)
+
+    print("OK")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Сравнение разбиения на чанки по символам (chars) и по токенам модели (tokens).
+
+Для каждого режима считает число чанков, долю чанков длиннее max_seq_length
+модели (их хвост энкодер обрезает), время кодирования и качество поиска.
+Качество оценивается без разметки: вопросами служат случайные предложения
+документа, релевантным считается чанк, целиком содержащий предложение
+(recall@k и MRR по косинусной близости).
+
+Запуск (БД не нужна):
+    python -m benchmarks.chunking docs/conspect.pdf docs/manual.txt --queries 200
+"""
+
+import argparse
+import re
+import time
+
+import numpy as np
+from fastapi import UploadFile
+
+from app.services.document_service import read_text_from_file, iter_chunks, iter_token_chunks
+from app.services.model_backend import EMBEDDING_MODEL_NAME, load_embedding_model
+
+def normalize(text: str) -> str:
+    return " ".join(text.split())
+
+def read_documents(paths):
+    texts = []
+    for path in paths:
+        with open(path, "rb") as f:
+            texts.append(read_text_from_file(UploadFile(file=f, filename=path)))
+
+    return texts
+
+def sample_questions(texts, count, rng):
+    sentences = [
+        normalize(s) for text in texts for s in re.split(r"(?<=[.!?…])\s+", text)
+        if 40 <= len(normalize(s)) <= 300
+    ]
+    if not sentences:
+        raise SystemExit("В документах нет подходящих предложений")
+
+    return [sentences[i] for i in rng.choice(len(sentences), size=min(count, len(sentences)), replace=False)]
+
+def evaluate(name, chunks, model, questions, top_k):
+    tokenizer = model.tokenizer
+    max_tokens = model.max_seq_length - 2
+    lengths = [len(ids) for ids in tokenizer(chunks, add_special_tokens=False)["input_ids"]]
+
+    start = time.perf_counter()
+    chunk_emb = model.encode(chunks, convert_to_numpy=True, normalize_embeddings=True, batch_size=64)
+    encode_time = time.perf_counter() - start
+
+    normalized = [normalize(c) for c in chunks]
+    query_emb = model.encode(questions, convert_to_numpy=True, normalize_embeddings=True)
+    ranking = np.argsort(-(query_emb @ chunk_emb.T), axis=1)
+
+    hits, reciprocal_ranks = 0, []
+    for question, order in zip(questions, ranking):
+        relevant = {i for i, c in enumerate(normalized) if question in c}
+        rank = next((r for r, i in enumerate(order) if i in relevant), None)
+        hits += rank is not None and rank < top_k
+        reciprocal_ranks.append(1 / (rank + 1) if rank is not None else 0.0)
+
+    print(
+        f"{name:>7} {len(chunks):>7} {np.mean(lengths):>10.1f} "
+        f"{np.mean(np.array(lengths) > max_tokens):>10.1%} {encode_time:>9.2f} "
+        f"{hits / len(questions):>10.3f} {np.mean(reciprocal_ranks):>7.3f}"
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    model = load_embedding_model(EMBEDDING_MODEL_NAME)
+    texts = read_documents(args.files)
+    questions = sample_questions(texts, args.queries, np.random.default_rng(args.seed))
+    max_tokens = model.max_seq_length - 2
+
+    print(f"model={EMBEDDING_MODEL_NAME} max_tokens={max_tokens} questions={len(questions)}")
+    print(f"{'mode':>7} {'chunks':>7} {'avg tokens':>10} {'truncated':>10} {'encode s':>9} {'recall@' + str(args.top_k):>10} {'MRR':>7}")
+
+    evaluate("chars", [c for text in texts for c in iter_chunks([text])], model, questions, args.top_k)
+    evaluate(
+        "tokens",
+        [c for text in texts for c in iter_token_chunks([text], model.tokenizer, max_tokens)],
+        model, questions, args.top_k
+    )
+
+if __name__ == "__main__":
+    main()
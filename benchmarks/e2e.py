@@ -0,0 +1,361 @@
+"""
+Сквозной бенчмарк загрузки документов и ответов на вопросы через HTTP API.
+
+Генерирует синтетический многоязычный корпус (русский, английский, немецкий
+тексты с заданным сидом), запускает приложение и заглушку LLM
+(benchmarks.stub_llm) в этом же процессе и отправляет запросы так же, как
+Telegram-бот: POST /documents и POST /ask (или /ask/stream). Длительность
+этапов берется из заголовка Server-Timing каждого ответа.
+
+Выводит пропускную способность и p50/p95/p99 задержки запросов и каждого
+этапа и сохраняет результат в JSON вместе с коммитом и настройками, чтобы
+сравнивать запуски на разных коммитах (--compare предыдущий.json).
+
+Запуск (нужна БД из DATABASE_URL с расширением vector; HF_TOKEN не нужен):
+    python -m benchmarks.e2e --users 4 --docs-per-user 5 --doc-chars 20000 --questions 200 --concurrency 8
+
+Для холодной загрузки без кеша эмбеддингов и ответов:
+    EMBEDDING_CACHE_ENABLED=false ANSWER_CACHE_ENABLED=false python -m benchmarks.e2e
+
+Данные тестовых пользователей удаляются через /reset до и после запуска.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import time
+from datetime import datetime, timezone
+
+import aiohttp
+import numpy as np
+
+FIRST_USER_ID = 2_000_200_000
+
+VOCABULARY = {
+    "ru": (
+        "система", "документ", "пользователь", "данные", "запрос", "ответ", "модель", "поиск",
+        "значение", "процесс", "результат", "таблица", "индекс", "время", "память", "сервер",
+        "обрабатывает", "хранит", "возвращает", "использует", "содержит", "быстро", "точно",
+        "каждый", "новый", "основной", "векторный", "текстовый", "полный", "отдельный",
+    ),
+    "en": (
+        "system", "document", "user", "data", "request", "answer", "model", "search",
+        "value", "process", "result", "table", "index", "time", "memory", "server",
+        "handles", "stores", "returns", "uses", "contains", "quickly", "accurately",
+        "each", "new", "main", "vector", "textual", "complete", "separate",
+    ),
+    "de": (
+        "System", "Dokument", "Benutzer", "Daten", "Anfrage", "Antwort", "Modell", "Suche",
+        "Wert", "Prozess", "Ergebnis", "Tabelle", "Index", "Zeit", "Speicher", "Server",
+        "verarbeitet", "speichert", "liefert", "nutzt", "enthält", "schnell", "genau",
+        "jeder", "neuer", "wichtiger", "vektorieller", "vollständiger", "getrennter", "eigener",
+    ),
+}
+
+# Переменные окружения, от которых зависят результаты; сохраняются вместе с ними
+RECORDED_ENV = (
+    "VECTOR_INDEX_TYPE", "VECTOR_STORAGE", "PARTITIONED", "HOT_INDEX_ENABLED", "CHUNKING_MODE",
+    "INFERENCE_BACKEND", "INFERENCE_BATCHING", "EMBEDDING_CACHE_ENABLED", "ANSWER_CACHE_ENABLED",
+    "EMBED_BATCH_SIZE", "CONTEXT_MAX_TOKENS", "DB_POOL_SIZE",
+)
+
+def make_sentence(rng: random.Random, language: str) -> str:
+    words = rng.choices(VOCABULARY[language], k=rng.randint(8, 16))
+    return " ".join(words).capitalize() + rng.choice((".", ".", ".", "?", "!"))
+
+def make_document(rng: random.Random, chars: int) -> str:
+    """Абзацы из случайных предложений; язык меняется от абзаца к абзацу"""
+
+    paragraphs, size = [], 0
+    while size < chars:
+        language = rng.choice(tuple(VOCABULARY))
+        paragraph = " ".join(make_sentence(rng, language) for _ in range(rng.randint(3, 6)))
+        paragraphs.append(paragraph)
+        size += len(paragraph) + 2
+
+    return "\n\n".join(paragraphs)
+
+def make_corpus(users: int, docs_per_user: int, chars: int, seed: int) -> dict:
+    rng = random.Random(seed)
+    return {
+        FIRST_USER_ID + u: [make_document(rng, chars) for _ in range(docs_per_user)]
+        for u in range(users)
+    }
+
+def make_questions(corpus: dict, count: int, seed: int) -> list:
+    """Вопросы - предложения из документов пользователя"""
+
+    rng = random.Random(seed + 1)
+    user_ids = sorted(corpus)
+    questions = []
+    for _ in range(count):
+        user_id = rng.choice(user_ids)
+        sentences = re.split(r"(?<=[.!?])\s+", rng.choice(corpus[user_id]))
+        questions.append((user_id, rng.choice(sentences)))
+
+    return questions
+
+def parse_server_timing(header: str) -> dict:
+    stages = {}
+    for part in filter(None, (p.strip() for p in (header or "").split(","))):
+        name, _, params = part.partition(";")
+        match = re.search(r"dur=([\d.]+)", params)
+        if match:
+            stages[name.strip()] = float(match.group(1))
+
+    return stages
+
+def latency_stats(values) -> dict:
+    if not values:
+        return {"count": 0}
+
+    return {
+        "count": len(values),
+        "mean": float(np.mean(values)),
+        "p50": float(np.percentile(values, 50)),
+        "p95": float(np.percentile(values, 95)),
+        "p99": float(np.percentile(values, 99)),
+    }
+
+def summarize(samples: list, wall: float) -> dict:
+    """samples: список {"ms", "stages", "ok", ...} по каждому запросу"""
+
+    ok = [s for s in samples if s["ok"]]
+    stage_names = sorted({stage for s in ok for stage in s["stages"]})
+
+    return {
+        "requests": len(samples),
+        "errors": len(samples) - len(ok),
+        "wall_seconds": wall,
+        "throughput_rps": len(ok) / wall if wall else 0.0,
+        "latency_ms": latency_stats([s["ms"] for s in ok]),
+        "stages_ms": {
+            stage: latency_stats([s["stages"][stage] for s in ok if stage in s["stages"]])
+            for stage in stage_names
+        },
+    }
+
+async def run_concurrently(jobs: list, concurrency: int) -> tuple:
+    """Выполняет корутины не больше concurrency одновременно; возвращает результаты и общее время"""
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited(job):
+        async with semaphore:
+            return await job
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(limited(job) for job in jobs))
+    return results, time.perf_counter() - start
+
+async def upload(session: aiohttp.ClientSession, api_url: str, user_id: int, name: str, text: str) -> dict:
+    form = aiohttp.FormData()
+    form.add_field("file", text.encode("utf-8"), filename=name, content_type="text/plain")
+
+    start = time.perf_counter()
+    async with session.post(f"{api_url}/documents", params={"user_id": user_id}, data=form) as response:
+        body = await response.json()
+        return {
+            "ok": response.status == 200,
+            "ms": (time.perf_counter() - start) * 1000,
+            "stages": parse_server_timing(response.headers.get("Server-Timing")),
+            "chunks": body.get("num_chunks", 0) if response.status == 200 else 0,
+            "bytes": len(text.encode("utf-8")),
+        }
+
+async def ask(session: aiohttp.ClientSession, api_url: str, user_id: int, question: str, stream: bool) -> dict:
+    payload = {"user_id": user_id, "question": question}
+    start = time.perf_counter()
+
+    if not stream:
+        async with session.post(f"{api_url}/ask", json=payload) as response:
+            await response.read()
+            return {
+                "ok": response.status == 200,
+                "ms": (time.perf_counter() - start) * 1000,
+                "stages": parse_server_timing(response.headers.get("Server-Timing")),
+            }
+
+    # Заголовки потокового ответа отправляются до генерации, поэтому в Server-Timing только поиск
+    first_token_ms, ok = None, False
+    async with session.post(f"{api_url}/ask/stream", json=payload) as response:
+        stages = parse_server_timing(response.headers.get("Server-Timing"))
+        async for line in response.content:
+            line = line.decode("utf-8").strip()
+            if line.startswith("data:") and '"token"' in line and first_token_ms is None:
+                first_token_ms = (time.perf_counter() - start) * 1000
+            elif line == "event: done":
+                ok = True
+            elif line == "event: error":
+                break
+
+    if first_token_ms is not None:
+        stages["first_token"] = first_token_ms
+
+    return {"ok": ok and response.status == 200, "ms": (time.perf_counter() - start) * 1000, "stages": stages}
+
+async def reset(session: aiohttp.ClientSession, api_url: str, user_ids):
+    for user_id in user_ids:
+        async with session.post(f"{api_url}/reset/{user_id}") as response:
+            await response.read()
+
+async def run_benchmark(args, api_url: str) -> dict:
+    corpus = make_corpus(args.users, args.docs_per_user, args.doc_chars, args.seed)
+    questions = make_questions(corpus, args.warmup + args.questions, args.seed)
+
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        await reset(session, api_url, corpus)
+
+        try:
+            jobs = [
+                upload(session, api_url, user_id, f"bench_{i}.txt", text)
+                for user_id, texts in corpus.items() for i, text in enumerate(texts)
+            ]
+            uploads, upload_wall = await run_concurrently(jobs, args.concurrency)
+
+            ingest = summarize(uploads, upload_wall)
+            ingest["chunks"] = sum(u["chunks"] for u in uploads)
+            ingest["chunks_per_second"] = ingest["chunks"] / upload_wall
+            ingest["mb_per_second"] = sum(u["bytes"] for u in uploads if u["ok"]) / 2**20 / upload_wall
+
+            warmup = questions[:args.warmup]
+            await run_concurrently([ask(session, api_url, u, q, args.stream) for u, q in warmup], args.concurrency)
+
+            measured = questions[args.warmup:]
+            asks, ask_wall = await run_concurrently(
+                [ask(session, api_url, u, q, args.stream) for u, q in measured], args.concurrency
+            )
+
+            async with session.get(f"{api_url}/metrics/summary") as response:
+                server_metrics = await response.json()
+
+        finally:
+            await reset(session, api_url, corpus)
+
+    return {"ingest": ingest, "ask": summarize(asks, ask_wall), "server_metrics": server_metrics}
+
+def git_revision() -> dict:
+    def git(*command):
+        try:
+            return subprocess.run(
+                ["git", *command], capture_output=True, text=True, check=True
+            ).stdout.strip()
+
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    status = git("status", "--porcelain", "--untracked-files=no")
+    return {"commit": git("rev-parse", "HEAD"), "dirty": bool(status) if status is not None else None}
+
+def print_phase(name: str, phase: dict):
+    latency = phase["latency_ms"]
+    print(
+        f"\n{name}: {phase['requests']} requests, {phase['errors']} errors, "
+        f"{phase['throughput_rps']:.2f} req/s"
+    )
+    if latency["count"]:
+        print(f"{'stage':>22} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+        rows = [("request", latency)] + list(phase["stages_ms"].items())
+        for stage, stats in rows:
+            print(f"{stage:>22} {stats['count']:>6} {stats['p50']:>9.1f} {stats['p95']:>9.1f} {stats['p99']:>9.1f}")
+
+def print_comparison(previous: dict, current: dict):
+    """Изменение p50 и p95 по запросам и этапам относительно предыдущего запуска"""
+
+    print(f"\ncompared with {(previous['meta']['git'].get('commit') or '?')[:10]}:")
+    for phase in ("ingest", "ask"):
+        old, new = previous[phase], current[phase]
+        rows = [("request", old["latency_ms"], new["latency_ms"])] + [
+            (stage, old["stages_ms"][stage], stats)
+            for stage, stats in new["stages_ms"].items() if stage in old["stages_ms"]
+        ]
+        for stage, before, after in rows:
+            if not before.get("count") or not after.get("count"):
+                continue
+
+            changes = " ".join(
+                f"{q}={after[q]:.1f}ms ({(after[q] - before[q]) / before[q] * 100:+.0f}%)" if before[q] else ""
+                for q in ("p50", "p95")
+            )
+            print(f"{phase:>7} {stage:>22} {changes}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=4)
+    parser.add_argument("--docs-per-user", type=int, default=5)
+    parser.add_argument("--doc-chars", type=int, default=20_000, help="Примерный размер документа в символах")
+    parser.add_argument("--questions", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=10, help="Вопросы перед замером, в результат не входят")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--stream", action="store_true", help="Спрашивать через /ask/stream")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=300, help="Таймаут одного запроса в секундах")
+    parser.add_argument("--port", type=int, default=8765, help="Порт приложения")
+    parser.add_argument("--llm-url", help="Внешний OpenAI-совместимый сервер вместо заглушки")
+    parser.add_argument("--llm-port", type=int, default=8766)
+    parser.add_argument("--llm-ttft-ms", type=float, default=300)
+    parser.add_argument("--llm-token-ms", type=float, default=20)
+    parser.add_argument("--llm-tokens", type=int, default=60)
+    parser.add_argument("--llm-jitter", type=float, default=0.0)
+    parser.add_argument("--output", help="Файл результата (по умолчанию benchmarks/results/e2e-<коммит>-<время>.json)")
+    parser.add_argument("--compare", help="JSON предыдущего запуска для сравнения")
+    args = parser.parse_args()
+
+    from benchmarks.stub_llm import create_app, start_in_thread
+
+    if args.llm_url is None:
+        llm = create_app(args.llm_ttft_ms, args.llm_token_ms, args.llm_tokens, args.llm_jitter, args.seed)
+        start_in_thread(llm, "127.0.0.1", args.llm_port)
+        args.llm_url = f"http://127.0.0.1:{args.llm_port}"
+
+    # Настройки читаются при импорте модулей приложения, поэтому задаются до него
+    os.environ["LLM_BASE_URL"] = args.llm_url
+    os.environ["TIMING_HEADER_ENABLED"] = "true"
+
+    from app.server import app, prepare_database
+
+    prepare_database()
+
+    start_in_thread(app, "127.0.0.1", args.port)
+    results = asyncio.run(run_benchmark(args, f"http://127.0.0.1:{args.port}"))
+
+    git = git_revision()
+    results["meta"] = {
+        "git": git,
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "args": vars(args),
+        "env": {name: os.environ[name] for name in RECORDED_ENV if name in os.environ},
+    }
+
+    print_phase("ingest", results["ingest"])
+    print(
+        f"{results['ingest']['chunks']} chunks, {results['ingest']['chunks_per_second']:.1f} chunks/s, "
+        f"{results['ingest']['mb_per_second']:.2f} MB/s"
+    )
+    print_phase("ask", results["ask"])
+
+    output = args.output
+    if output is None:
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        output = os.path.join("benchmarks", "results", f"e2e-{(git['commit'] or 'unknown')[:10]}-{stamp}.json")
+
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"\nsaved to {output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            print_comparison(json.load(f), results)
+
+if __name__ == "__main__":
+    main()
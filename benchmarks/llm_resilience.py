@@ -0,0 +1,104 @@
+"""
+Устойчивость клиента LLM (app.services.llm_client) к сбоям и хвосту задержек.
+
+Запускает заглушку LLM (benchmarks.stub_llm) с заданной долей ответов 500, 429
+и медленных ответов и выполняет одни и те же вызовы клиентом с разными
+настройками: без повторов, с повторами и с повторами плюс дублирующими
+запросами. Для каждой выводит долю успешных вызовов, p50/p95/p99 задержки,
+число повторов и дублирующих запросов.
+
+Запуск (БД и HF_TOKEN не нужны):
+    python -m benchmarks.llm_resilience --calls 300 --concurrency 16 --error-rate 0.05 --slow-rate 0.05
+"""
+
+import argparse
+import asyncio
+import time
+
+import numpy as np
+
+from app import metrics
+from app.services.llm_client import LLMClient, LLMError
+from benchmarks.stub_llm import create_app, start_in_thread
+
+MESSAGES = [{"role": "user", "content": "Что такое RAG?"}]
+
+async def run_calls(client: LLMClient, call: str, count: int, concurrency: int, timeout: float) -> list:
+    """Задержки вызовов в мс; None для неудачных"""
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await client.chat(call, MESSAGES, timeout=timeout, max_tokens=20)
+
+            except LLMError:
+                return None
+
+            return (time.perf_counter() - start) * 1000
+
+    return await asyncio.gather(*(one() for _ in range(count)))
+
+def counter(name: str, call: str) -> float:
+    return metrics.snapshot()["counters"].get(f'{name}{{call="{call}"}}', 0)
+
+async def run(args, base_url: str):
+    configs = [
+        ("no retries", dict(max_retries=0, hedge_percentile=0)),
+        ("retries", dict(max_retries=args.retries, hedge_percentile=0)),
+        (f"retries+hedge p{args.hedge_percentile:g}", dict(max_retries=args.retries, hedge_percentile=args.hedge_percentile)),
+    ]
+
+    print(f"{'client':>22} {'success':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'retries':>8} {'hedges':>7}")
+    for name, options in configs:
+        client = LLMClient(base_url, None, "stub", max_concurrency=args.max_concurrency, **options)
+
+        # Прогрев набирает статистику задержек, по которой выбирается момент дублирующего запроса
+        await run_calls(client, name, args.warmup, args.concurrency, args.timeout)
+        retries, hedges = counter("llm_retries", name), counter("llm_hedges", name)
+
+        latencies = await run_calls(client, name, args.calls, args.concurrency, args.timeout)
+        ok = [latency for latency in latencies if latency is not None] or [float("nan")]
+
+        print(
+            f"{name:>22} {sum(latency is not None for latency in latencies) / len(latencies):>8.1%} "
+            f"{np.percentile(ok, 50):>8.0f} {np.percentile(ok, 95):>8.0f} {np.percentile(ok, 99):>8.0f} "
+            f"{counter('llm_retries', name) - retries:>8.0f} {counter('llm_hedges', name) - hedges:>7.0f}"
+        )
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=300)
+    parser.add_argument("--warmup", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--max-concurrency", type=int, default=32, help="Ограничение одновременных вызовов в клиенте")
+    parser.add_argument("--timeout", type=float, default=10, help="Дедлайн одного вызова в секундах")
+    parser.add_argument("--retries", type=int, default=2)
+    parser.add_argument("--hedge-percentile", type=float, default=90)
+    parser.add_argument("--port", type=int, default=8767)
+    parser.add_argument("--ttft-ms", type=float, default=200)
+    parser.add_argument("--token-ms", type=float, default=10)
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--error-rate", type=float, default=0.05)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.02)
+    parser.add_argument("--slow-rate", type=float, default=0.05)
+    parser.add_argument("--slow-ms", type=float, default=3000)
+    args = parser.parse_args()
+
+    stub = create_app(
+        args.ttft_ms, args.token_ms, 20, args.jitter,
+        error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate,
+        slow_rate=args.slow_rate, slow_ms=args.slow_ms
+    )
+    start_in_thread(stub, "127.0.0.1", args.port)
+
+    print(
+        f"stub: ttft={args.ttft_ms:g}ms errors={args.error_rate:.0%} 429={args.rate_limit_rate:.0%} "
+        f"slow={args.slow_rate:.0%} (+{args.slow_ms:g}ms) calls={args.calls} concurrency={args.concurrency}"
+    )
+    asyncio.run(run(args, f"http://127.0.0.1:{args.port}/v1"))
+
+if __name__ == "__main__":
+    main()
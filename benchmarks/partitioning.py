@@ -0,0 +1,170 @@
+"""
+Бенчмарк поиска и удаления данных пользователя (/reset) при большом числе
+пользователей в общей таблице embeddings.
+
+Меряет текущую схему БД, поэтому для сравнения запускается дважды на разных
+базах: с PARTITIONED=false и с PARTITIONED=true. Для каждого из --resets
+пользователей удаляет его чанки и документы так же, как delete_user_data,
+и выводит время удаления, число затронутых страниц (shared buffers) и время
+VACUUM после всех удалений. Также проверяет, что повторный init_db не
+перестраивает ANN-индекс (в том числе индекс секционированной таблицы).
+
+Запуск (нужна БД из DATABASE_URL с расширением vector):
+    PARTITIONED=true python -m benchmarks.partitioning --users 200 --chunks 2000 --queries 50
+
+Данные создаются для тестовых пользователей и удаляются в конце.
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+from sqlalchemy import text
+
+from app import database
+from app.database import (
+    SessionLocal, Embedding, engine, init_db, create_vector_index, vector_index_name, vector_search_settings
+)
+from benchmarks.vector_search import DIM, percentile
+
+FIRST_USER_ID = 2_000_100_000
+
+def fill(users: int, chunks: int):
+    """Создает пользователей с одним документом и chunks случайными векторами каждый"""
+
+    with engine.begin() as conn:
+        for user_id in range(FIRST_USER_ID, FIRST_USER_ID + users):
+            conn.execute(text("INSERT INTO users (user_id) VALUES (:uid) ON CONFLICT DO NOTHING"), {"uid": user_id})
+            document_id = conn.execute(text(
+                "INSERT INTO documents (user_id, filename, content) VALUES (:uid, 'bench', '') RETURNING id"
+            ), {"uid": user_id}).scalar()
+            conn.execute(text(f"""
+                INSERT INTO embeddings (document_id, user_id, chunk_text, embedding, chunk_index, document_name)
+                SELECT :doc, :uid, 'bench ' || i,
+                       (SELECT array_agg(random() - 0.5) FROM generate_series(1, {DIM}) WHERE i > 0)::vector({DIM}),
+                       i, 'bench'
+                FROM generate_series(1, :rows) AS i
+            """), {"doc": document_id, "uid": user_id, "rows": chunks})
+
+def cleanup(users: int):
+    with engine.begin() as conn:
+        params = {"low": FIRST_USER_ID, "high": FIRST_USER_ID + users}
+        conn.execute(text("DELETE FROM embeddings WHERE user_id >= :low AND user_id < :high"), params)
+        conn.execute(text("DELETE FROM documents WHERE user_id >= :low AND user_id < :high"), params)
+        conn.execute(text("DELETE FROM users WHERE user_id >= :low AND user_id < :high"), params)
+
+def run_searches(queries, users: int, top_k: int):
+    latencies = []
+    rng = np.random.default_rng(1)
+
+    for query in queries:
+        user_id = FIRST_USER_ID + int(rng.integers(users))
+        db = SessionLocal()
+        try:
+            start = time.perf_counter()
+            for statement in vector_search_settings(top_k):
+                db.execute(text(statement))
+
+            db.query(Embedding.id).filter(Embedding.user_id == user_id).order_by(
+                Embedding.embedding.cosine_distance(query)
+            ).limit(top_k).all()
+            latencies.append((time.perf_counter() - start) * 1000)
+
+        finally:
+            db.close()
+
+    return latencies
+
+def run_resets(count: int):
+    """Удаляет данные первых count тестовых пользователей и возвращает время и число страниц"""
+
+    latencies, pages = [], []
+    for user_id in range(FIRST_USER_ID, FIRST_USER_ID + count):
+        with engine.begin() as conn:
+            start = time.perf_counter()
+            plan = conn.execute(
+                text("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) DELETE FROM embeddings WHERE user_id = :uid"),
+                {"uid": user_id}
+            ).scalar()
+            conn.execute(text("DELETE FROM documents WHERE user_id = :uid"), {"uid": user_id})
+            latencies.append((time.perf_counter() - start) * 1000)
+
+        plan = plan if isinstance(plan, list) else json.loads(plan)
+        root = plan[0]["Plan"]
+        pages.append(root.get("Shared Hit Blocks", 0) + root.get("Shared Read Blocks", 0))
+
+    return latencies, pages
+
+def check_index_kept():
+    """Повторное создание индекса с теми же параметрами не должно его перестраивать"""
+
+    if database.VECTOR_INDEX_TYPE == "none":
+        return
+
+    query = text("SELECT oid FROM pg_class WHERE relname = :name")
+    params = {"name": vector_index_name(database.VECTOR_INDEX_TYPE)}
+
+    with engine.connect() as conn:
+        before = conn.execute(query, params).scalar()
+
+    start = time.perf_counter()
+    create_vector_index()
+    seconds = time.perf_counter() - start
+
+    with engine.connect() as conn:
+        after = conn.execute(query, params).scalar()
+
+    if before is None or before != after:
+        raise SystemExit(f"vector index was rebuilt on init_db ({seconds:.2f} s)")
+
+    print(f"vector index kept on init_db: {seconds * 1000:.1f} ms")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--chunks", type=int, default=2000, help="Число чанков на пользователя")
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--resets", type=int, default=10)
+    parser.add_argument("--top-k", type=int, default=15)
+    args = parser.parse_args()
+
+    init_db()
+    cleanup(args.users)
+
+    rng = np.random.default_rng(0)
+    queries = [q / np.linalg.norm(q) for q in rng.standard_normal((args.queries, DIM)).astype(np.float32)]
+
+    print(
+        f"partitioned={database.PARTITIONED} partitions={database.PARTITION_COUNT} "
+        f"users={args.users} chunks/user={args.chunks} index={database.VECTOR_INDEX_TYPE}"
+    )
+
+    try:
+        start = time.perf_counter()
+        fill(args.users, args.chunks)
+        with engine.begin() as conn:
+            conn.execute(text("ANALYZE embeddings"))
+        print(f"fill: {time.perf_counter() - start:.1f} s")
+
+        check_index_kept()
+
+        search = run_searches(queries, args.users, args.top_k)
+        print(f"search ms: p50={percentile(search, 50):.2f} p95={percentile(search, 95):.2f}")
+
+        resets, pages = run_resets(min(args.resets, args.users))
+        print(
+            f"reset ms: p50={percentile(resets, 50):.2f} p95={percentile(resets, 95):.2f} "
+            f"pages touched: avg={np.mean(pages):.0f}"
+        )
+
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            start = time.perf_counter()
+            conn.execute(text("VACUUM embeddings"))
+            print(f"vacuum: {time.perf_counter() - start:.2f} s")
+
+    finally:
+        cleanup(args.users)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""
+Время запуска и память процесса в каждом режиме app.main.
+
+1. Импорт: в отдельном интерпретаторе импортирует модули режима (api - app.server,
+   bot - app.bot) и выводит время импорта, пиковый RSS и загружен ли ML-стек
+   (torch, sentence_transformers, huggingface_hub).
+2. Запуск API (--serve): запускает python -m app.main --mode api с прогревом
+   моделей и без него (WARMUP_MODELS) и меряет время до ответа 200 на /health и
+   задержку первого запроса к модели (POST /ask пользователя без документов:
+   кодирование вопроса и поиск, без LLM).
+
+Запуск (для --serve нужна БД из DATABASE_URL):
+    python -m benchmarks.startup --modes api bot --repeats 3 --serve
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+import numpy as np
+
+BENCH_USER_ID = 2_000_300_000
+# Бот проверяет формат токена при импорте, сам Telegram в бенчмарке не нужен
+FAKE_BOT_TOKEN = "123456789:" + "A" * 35
+
+MODE_MODULES = {"api": ["app.server"], "bot": ["app.bot"], "both": ["app.server", "app.bot"]}
+ML_MODULES = ("torch", "sentence_transformers", "huggingface_hub")
+
+IMPORT_SNIPPET = """
+import importlib, json, resource, sys, time
+start = time.perf_counter()
+for module in sys.argv[1:]:
+    importlib.import_module(module)
+print(json.dumps({
+    "seconds": time.perf_counter() - start,
+    "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "ml_modules": [m for m in %r if m in sys.modules],
+}))
+""" % (ML_MODULES,)
+
+def child_env(**extra) -> dict:
+    env = dict(os.environ)
+    env.setdefault("BOT_TOKEN", FAKE_BOT_TOKEN)
+    env.update(extra)
+    return env
+
+def measure_import(mode: str) -> dict:
+    result = subprocess.run(
+        [sys.executable, "-c", IMPORT_SNIPPET, *MODE_MODULES[mode]],
+        capture_output=True, text=True, env=child_env(), check=True
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def request(url: str, data: dict = None, timeout: float = 600) -> int:
+    body = json.dumps(data).encode("utf-8") if data is not None else None
+    req = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"})
+
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as response:
+            return response.status
+
+    except urllib.error.HTTPError as e:
+        return e.code
+
+def measure_serve(port: int, warmup: bool, timeout: float) -> dict:
+    """Время до готовности /health и задержка первого запроса, который использует модель"""
+
+    api_url = f"http://127.0.0.1:{port}"
+    env = child_env(API_PORT=str(port), WARMUP_MODELS="true" if warmup else "false")
+
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "app.main", "--mode", "api"],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+
+    try:
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError(f"API exited with code {process.returncode}")
+
+            if time.perf_counter() - start > timeout:
+                raise RuntimeError("API did not become ready in time")
+
+            try:
+                if request(f"{api_url}/health", timeout=1) == 200:
+                    break
+
+            except (urllib.error.URLError, OSError):
+                pass
+
+            time.sleep(0.05)
+
+        ready = time.perf_counter() - start
+
+        request_start = time.perf_counter()
+        request(f"{api_url}/ask", {"user_id": BENCH_USER_ID, "question": "Проверка запуска"})
+        first_request = time.perf_counter() - request_start
+
+        request(f"{api_url}/reset/{BENCH_USER_ID}")
+
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+
+    return {"ready_seconds": ready, "first_request_seconds": first_request}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", nargs="+", choices=list(MODE_MODULES), default=["api", "bot"])
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--serve", action="store_true", help="Запускать API и ждать готовности /health")
+    parser.add_argument("--port", type=int, default=8777)
+    parser.add_argument("--timeout", type=float, default=600, help="Сколько ждать готовности API в секундах")
+    parser.add_argument("--output", help="Сохранить результаты в JSON")
+    args = parser.parse_args()
+
+    results = {"import": {}, "serve": {}}
+
+    print(f"{'mode':>6} {'import s':>9} {'max RSS MB':>11}  ML modules")
+    for mode in args.modes:
+        runs = [measure_import(mode) for _ in range(args.repeats)]
+        results["import"][mode] = runs
+        print(
+            f"{mode:>6} {np.median([r['seconds'] for r in runs]):>9.2f} "
+            f"{np.median([r['max_rss_mb'] for r in runs]):>11.0f}  {', '.join(runs[0]['ml_modules']) or '-'}"
+        )
+
+    if args.serve:
+        print(f"\n{'warm-up':>8} {'ready s':>8} {'first request s':>16}")
+        for warmup in (False, True):
+            runs = [measure_serve(args.port, warmup, args.timeout) for _ in range(args.repeats)]
+            results["serve"]["warmup" if warmup else "lazy"] = runs
+            print(
+                f"{'on' if warmup else 'off':>8} {np.median([r['ready_seconds'] for r in runs]):>8.2f} "
+                f"{np.median([r['first_request_seconds'] for r in runs]):>16.2f}"
+            )
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
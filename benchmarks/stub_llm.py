@@ -0,0 +1,144 @@
+"""
+Локальная заглушка LLM с OpenAI-совместимым /v1/chat/completions для бенчмарков
+без HF_TOKEN. Отвечает случайным текстом с заданной задержкой: время до первого
+токена плюс время на каждый токен; поддерживает потоковый режим (stream=true).
+На запрос переформулировок (промпт со словом "Перефразируй") отвечает нужным
+числом строк.
+
+Для проверки устойчивости клиента (app.services.llm_client) умеет с заданной
+вероятностью отвечать 500 или 429 с Retry-After и отвечать медленно (хвост задержек).
+
+Запуск отдельно (приложение подключается через LLM_BASE_URL=http://127.0.0.1:8090):
+    python -m benchmarks.stub_llm --port 8090 --ttft-ms 300 --token-ms 20 --tokens 60
+    python -m benchmarks.stub_llm --error-rate 0.05 --rate-limit-rate 0.05 --slow-rate 0.05 --slow-ms 5000
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import re
+import threading
+import time
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+WORDS = (
+    "документ", "ответ", "контекст", "поиск", "данные", "вопрос", "модель", "чанк",
+    "document", "answer", "context", "search", "data", "question", "model", "chunk",
+)
+
+def create_app(
+    ttft_ms: float,
+    token_ms: float,
+    tokens: int,
+    jitter: float = 0.0,
+    seed: int = 0,
+    error_rate: float = 0.0,
+    rate_limit_rate: float = 0.0,
+    slow_rate: float = 0.0,
+    slow_ms: float = 0.0,
+) -> FastAPI:
+    app = FastAPI(title="Stub LLM")
+    rng = random.Random(seed)
+
+    def delay(ms: float) -> float:
+        return ms * (1 + rng.uniform(-jitter, jitter)) / 1000
+
+    def completion_text(messages: list, max_tokens: int) -> list:
+        prompt = messages[-1]["content"] if messages else ""
+        match = re.search(r"Перефразируй этот вопрос (\d+)", prompt)
+        if match:
+            lines = [" ".join(rng.choices(WORDS, k=8)) + "?" for _ in range(int(match.group(1)))]
+            return [line + "\n" for line in lines]
+
+        return [word + " " for word in rng.choices(WORDS, k=min(tokens, max_tokens))]
+
+    def usage(messages: list, completion_tokens: int) -> dict:
+        prompt_tokens = sum(len(m["content"]) for m in messages) // 4
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
+        }
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+
+        fault = rng.random()
+        if fault < rate_limit_rate:
+            return JSONResponse(status_code=429, content={"error": "rate limited"}, headers={"Retry-After": "1"})
+        if fault < rate_limit_rate + error_rate:
+            return JSONResponse(status_code=500, content={"error": "injected failure"})
+
+        # Медленный ответ: задержка до первого токена увеличивается на slow_ms
+        first_delay = delay(ttft_ms) + (slow_ms / 1000 if rng.random() < slow_rate else 0.0)
+        messages = body.get("messages", [])
+        parts = completion_text(messages, body.get("max_tokens") or tokens)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        base = {"id": completion_id, "created": int(time.time()), "model": body.get("model", "stub")}
+
+        if body.get("stream"):
+            async def events():
+                await asyncio.sleep(first_delay)
+                for i, part in enumerate(parts):
+                    if i:
+                        await asyncio.sleep(delay(token_ms))
+                    chunk = {**base, "object": "chat.completion.chunk", "choices": [
+                        {"index": 0, "delta": {"role": "assistant", "content": part}, "finish_reason": None}
+                    ]}
+                    yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+
+                chunk = {**base, "object": "chat.completion.chunk", "choices": [
+                    {"index": 0, "delta": {}, "finish_reason": "stop"}
+                ]}
+                yield f"data: {json.dumps(chunk)}\n\n"
+                yield "data: [DONE]\n\n"
+
+            return StreamingResponse(events(), media_type="text/event-stream")
+
+        await asyncio.sleep(first_delay + delay(token_ms) * max(len(parts) - 1, 0))
+        return {**base, "object": "chat.completion", "choices": [
+            {"index": 0, "message": {"role": "assistant", "content": "".join(parts).strip()}, "finish_reason": "stop"}
+        ], "usage": usage(messages, len(parts))}
+
+    return app
+
+def start_in_thread(app: FastAPI, host: str, port: int) -> uvicorn.Server:
+    """Запускает uvicorn в фоновом потоке и ждет готовности сервера"""
+
+    server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+
+    while not server.started:
+        time.sleep(0.05)
+
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--ttft-ms", type=float, default=300, help="Задержка до первого токена")
+    parser.add_argument("--token-ms", type=float, default=20, help="Задержка на каждый следующий токен")
+    parser.add_argument("--tokens", type=int, default=60, help="Длина ответа в токенах")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Случайный разброс задержек, доля от 0 до 1")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Доля ответов 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Доля ответов 429 с Retry-After: 1")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="Доля медленных ответов")
+    parser.add_argument("--slow-ms", type=float, default=5000, help="Дополнительная задержка медленного ответа")
+    args = parser.parse_args()
+
+    app = create_app(
+        args.ttft_ms, args.token_ms, args.tokens, args.jitter,
+        error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate,
+        slow_rate=args.slow_rate, slow_ms=args.slow_ms
+    )
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Бенчмарк векторного поиска: задержка в зависимости от числа чанков пользователя
+с ANN-индексом и без него (точный перебор).
+
+Запуск (нужна БД из DATABASE_URL с расширением vector):
+    python -m benchmarks.vector_search --sizes 1000 10000 100000 --queries 50
+
+Данные создаются для отдельного тестового пользователя и удаляются в конце.
+"""
+
+import argparse
+import statistics
+import time
+
+import numpy as np
+from sqlalchemy import text
+
+from app import database
+from app.database import SessionLocal, Embedding, engine, init_db, vector_search_settings
+
+BENCH_USER_ID = 2_000_000_000
+NOISE_USER_ID = 2_000_000_001
+DIM = 768
+
+def fill(user_id: int, rows: int):
+    """Генерирует случайные векторы прямо в Postgres"""
+
+    with engine.begin() as conn:
+        conn.execute(text("INSERT INTO users (user_id) VALUES (:uid) ON CONFLICT DO NOTHING"), {"uid": user_id})
+        conn.execute(text(f"""
+            INSERT INTO embeddings (user_id, chunk_text, embedding, chunk_index, document_name)
+            SELECT :uid, 'bench ' || i,
+                   (SELECT array_agg(random() - 0.5) FROM generate_series(1, {DIM}) WHERE i > 0)::vector({DIM}),
+                   i, 'bench'
+            FROM generate_series(1, :rows) AS i
+        """), {"uid": user_id, "rows": rows})
+
+def cleanup():
+    with engine.begin() as conn:
+        conn.execute(text("DELETE FROM embeddings WHERE user_id IN (:a, :b)"), {"a": BENCH_USER_ID, "b": NOISE_USER_ID})
+        conn.execute(text("DELETE FROM users WHERE user_id IN (:a, :b)"), {"a": BENCH_USER_ID, "b": NOISE_USER_ID})
+
+def run_queries(queries, top_k: int, use_index: bool):
+    """Возвращает задержки в мс и найденные id для каждого запроса"""
+
+    latencies, found = [], []
+    for query in queries:
+        db = SessionLocal()
+        try:
+            start = time.perf_counter()
+            if use_index:
+                for statement in vector_search_settings(top_k):
+                    db.execute(text(statement))
+
+            else:
+                db.execute(text("SET LOCAL enable_indexscan = off"))
+
+            rows = db.query(Embedding.id).filter(Embedding.user_id == BENCH_USER_ID).order_by(
+                Embedding.embedding.cosine_distance(query)
+            ).limit(top_k).all()
+            latencies.append((time.perf_counter() - start) * 1000)
+            found.append({r.id for r in rows})
+
+        finally:
+            db.close()
+
+    return latencies, found
+
+def percentile(values, q):
+    return float(np.percentile(values, q))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 50_000])
+    parser.add_argument("--noise", type=int, default=0, help="Число чанков другого пользователя в той же таблице")
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--top-k", type=int, default=15)
+    args = parser.parse_args()
+
+    if database.VECTOR_INDEX_TYPE == "none":
+        parser.error("Укажите VECTOR_INDEX_TYPE=hnsw или ivfflat")
+
+    init_db()
+    cleanup()
+
+    rng = np.random.default_rng(0)
+    queries = [q / np.linalg.norm(q) for q in rng.standard_normal((args.queries, DIM)).astype(np.float32)]
+
+    print(f"index={database.VECTOR_INDEX_TYPE} top_k={args.top_k} queries={args.queries} noise={args.noise}")
+    print(f"{'rows':>10} {'exact p50':>10} {'exact p95':>10} {'ann p50':>10} {'ann p95':>10} {'recall':>8}")
+
+    try:
+        if args.noise:
+            fill(NOISE_USER_ID, args.noise)
+
+        loaded = 0
+        for size in sorted(args.sizes):
+            fill(BENCH_USER_ID, size - loaded)
+            loaded = size
+
+            # Перестраиваем индекс на актуальных данных (важно для ivfflat)
+            with engine.begin() as conn:
+                conn.execute(text(f"DROP INDEX IF EXISTS {database.vector_index_name(database.VECTOR_INDEX_TYPE)}"))
+                conn.execute(text("ANALYZE embeddings"))
+            database.create_vector_index()
+
+            exact, exact_ids = run_queries(queries, args.top_k, use_index=False)
+            ann, ann_ids = run_queries(queries, args.top_k, use_index=True)
+            recall = statistics.mean(len(a & e) / max(len(e), 1) for a, e in zip(ann_ids, exact_ids))
+
+            print(
+                f"{size:>10} {percentile(exact, 50):>10.2f} {percentile(exact, 95):>10.2f} "
+                f"{percentile(ann, 50):>10.2f} {percentile(ann, 95):>10.2f} {recall:>8.3f}"
+            )
+
+    finally:
+        cleanup()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""
+Сравнение форматов хранения эмбеддингов (VECTOR_STORAGE): full (float32 vector),
+half (float16 halfvec) и binary (битовая сигнатура + пересчет по halfvec).
+
+Для каждого формата строит ANN-индекс и считает задержку поиска, recall@k
+относительно точного поиска по float32 и занимаемое место (средний размер
+значения колонки и размер индекса).
+
+Запуск (нужна БД из DATABASE_URL с расширением vector >= 0.7.0; VECTOR_STORAGE=binary,
+чтобы в схеме были колонки всех форматов):
+    VECTOR_STORAGE=binary python -m benchmarks.vector_storage --rows 100000 --queries 50 --rescore-factors 4 10 20
+
+Данные создаются для отдельного тестового пользователя и удаляются в конце.
+"""
+
+import argparse
+import re
+import statistics
+import time
+
+import numpy as np
+from sqlalchemy import select, text
+from sqlalchemy.dialects import postgresql
+
+from app import database
+from app.database import (
+    SessionLocal, Embedding, engine, init_db, vector_search_settings, binary_query_signature, VECTOR_STORAGE_INDEX
+)
+from app.migrations import migrate_vector_storage
+from benchmarks.vector_search import BENCH_USER_ID, DIM, cleanup, fill, percentile
+
+def storage_query(storage: str, query, top_k: int, rescore_factor: int):
+    if storage == "binary":
+        candidates = select(Embedding.id, Embedding.embedding_half).filter(Embedding.user_id == BENCH_USER_ID).order_by(
+            Embedding.embedding_bits.hamming_distance(binary_query_signature(query))
+        ).limit(top_k * rescore_factor).subquery()
+
+        return select(candidates.c.id).order_by(candidates.c.embedding_half.cosine_distance(query)).limit(top_k)
+
+    column = Embedding.embedding_half if storage == "half" else Embedding.embedding
+    return select(Embedding.id).filter(Embedding.user_id == BENCH_USER_ID).order_by(
+        column.cosine_distance(query)
+    ).limit(top_k)
+
+def check_binary_query_sql():
+    """
+    Без явного приведения к halfvec вызов binary_quantize с параметром неоднозначен
+    (есть версии для vector и halfvec), и Postgres его отклоняет
+    """
+
+    sql = str(storage_query("binary", np.zeros(DIM, dtype=np.float32), 1, 1).compile(dialect=postgresql.dialect()))
+    if not re.search(rf"binary_quantize\(CAST\(%\(\w+\)s AS HALFVEC\({DIM}\)\)\)", sql):
+        raise SystemExit(f"binary_quantize is called without a halfvec cast:\n{sql}")
+
+def run_queries(storage: str, queries, top_k: int, rescore_factor: int = 1, exact: bool = False):
+    """Возвращает задержки в мс и найденные id для каждого запроса"""
+
+    latencies, found = [], []
+    for query in queries:
+        db = SessionLocal()
+        try:
+            start = time.perf_counter()
+            if exact:
+                db.execute(text("SET LOCAL enable_indexscan = off"))
+
+            else:
+                for statement in vector_search_settings(top_k * rescore_factor):
+                    db.execute(text(statement))
+
+            rows = db.execute(storage_query(storage, query, top_k, rescore_factor)).all()
+            latencies.append((time.perf_counter() - start) * 1000)
+            found.append({r.id for r in rows})
+
+        finally:
+            db.close()
+
+    return latencies, found
+
+def storage_size(storage: str) -> tuple:
+    """Средний размер значения колонки в байтах и размер индекса в МБ"""
+
+    column = VECTOR_STORAGE_INDEX[storage][0]
+    columns = "embedding_half, embedding_bits" if storage == "binary" else column
+
+    with engine.connect() as conn:
+        value_bytes = conn.execute(text(
+            f"SELECT avg({' + '.join(f'pg_column_size({c})' for c in columns.split(', '))}) "
+            "FROM embeddings WHERE user_id = :uid"
+        ), {"uid": BENCH_USER_ID}).scalar()
+        index_bytes = conn.execute(
+            text("SELECT coalesce(pg_relation_size(to_regclass(:name)), 0)"),
+            {"name": database.vector_index_name(database.VECTOR_INDEX_TYPE, storage)}
+        ).scalar()
+
+    return float(value_bytes or 0), index_bytes / 2**20
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=50_000)
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--top-k", type=int, default=15)
+    parser.add_argument("--rescore-factors", type=int, nargs="+", default=[4, 10, 20])
+    args = parser.parse_args()
+
+    if database.VECTOR_INDEX_TYPE == "none":
+        parser.error("Укажите VECTOR_INDEX_TYPE=hnsw или ivfflat")
+
+    if database.VECTOR_STORAGE != "binary":
+        parser.error("Укажите VECTOR_STORAGE=binary")
+
+    check_binary_query_sql()
+
+    init_db()
+    cleanup()
+
+    rng = np.random.default_rng(0)
+    queries = [q / np.linalg.norm(q) for q in rng.standard_normal((args.queries, DIM)).astype(np.float32)]
+
+    print(f"index={database.VECTOR_INDEX_TYPE} rows={args.rows} top_k={args.top_k} queries={args.queries}")
+    print(f"{'storage':>12} {'p50 ms':>8} {'p95 ms':>8} {'recall':>8} {'value B':>8} {'index MB':>9}")
+
+    try:
+        fill(BENCH_USER_ID, args.rows)
+        migrate_vector_storage()
+        with engine.begin() as conn:
+            conn.execute(text("ANALYZE embeddings"))
+
+        _, exact_ids = run_queries("full", queries, args.top_k, exact=True)
+
+        runs = [("full", 1), ("half", 1)] + [("binary", factor) for factor in args.rescore_factors]
+        for storage, factor in runs:
+            database.VECTOR_STORAGE = storage
+            database.create_vector_index()
+
+            latencies, ids = run_queries(storage, queries, args.top_k, factor)
+            recall = statistics.mean(len(a & e) / max(len(e), 1) for a, e in zip(ids, exact_ids))
+            value_bytes, index_mb = storage_size(storage)
+            name = f"binary x{factor}" if storage == "binary" else storage
+
+            print(
+                f"{name:>12} {percentile(latencies, 50):>8.2f} {percentile(latencies, 95):>8.2f} "
+                f"{recall:>8.3f} {value_bytes:>8.0f} {index_mb:>9.1f}"
+            )
+
+    finally:
+        cleanup()
+
+if __name__ == "__main__":
+    main()